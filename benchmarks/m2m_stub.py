@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+@brief: Local stub of the OOI uFrame M2M API for the benchmarks. Serves the inventory (nodes, sensors, delivery methods
+and streams) of any platform and CTDPF/FLORT data generated for the requested time window: a wire-following profiler
+going up and down every profile_minutes, sampled every sample_seconds. Like uFrame, requests for more than the limit
+are decimated to the limit, and windows without data return 404 with a message. Every response is delayed by latency
+seconds to simulate the network.
+
+@usage:
+server = StubServer(latency=0.05)  # starts serving in a background thread
+client = M2MClient('user', 'token', base_url=server.base_url)
+server.stop()
+python m2m_stub.py 8080 0.05  # serve on port 8080 with 50 ms latency until interrupted
+"""
+
+import _strptime  # import before the handler threads call strptime (Python 2 isn't thread-safe here)
+import datetime
+import json
+import sys
+import threading
+import time
+import numpy as np
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+
+API_PATH = '/api/m2m/12576/sensor/inv/'
+NTP_EPOCH = datetime.datetime(1900, 1, 1)
+NODES = {'WFP01': ['03-CTDPFK000', '04-FLORTK000']}
+METHODS = ['recovered_wfp', 'telemetered']
+STREAMS = {'CTDPF': ['ctdpf_ckl_wfp_instrument_recovered', 'ctdpf_ckl_wfp_metadata_recovered'],
+           'FLORT': ['flort_sample', 'flort_metadata']}
+
+
+def ntp_seconds(iso):
+    return (datetime.datetime.strptime(iso, '%Y-%m-%dT%H:%M:%S.%fZ') - NTP_EPOCH).total_seconds()
+
+
+class StubData(object):
+    def __init__(self, sample_seconds=1.0, profile_minutes=120, max_pres=500):
+        self.sample_seconds = sample_seconds
+        self.profile_minutes = profile_minutes
+        self.max_pres = max_pres
+
+    def records(self, sensor, begin, end, limit):
+        # Samples between begin and end (NTP seconds), decimated to exactly limit samples if there are more
+        first = np.ceil(begin / self.sample_seconds)
+        last = np.floor(end / self.sample_seconds)
+        n = int(max(last - first + 1, 0))
+        index = np.round(np.linspace(0, n - 1, limit)) if n > limit else np.arange(n)
+        t = (first + index) * self.sample_seconds
+        phase = (t % (self.profile_minutes * 60)) / (self.profile_minutes * 60)
+        pres = self.max_pres * (1 - np.abs(2 * phase - 1))
+        temp = 6 + 12 * (1 - np.tanh((pres - 60) / 30)) / 2 - pres / 1000
+        if 'CTD' in sensor:
+            sal = 35 - 2 * np.exp(-pres / 40)
+            cond = 2.9 + 0.09 * (temp - 6) + 0.03 * (sal - 33)
+            density = 1026 + 0.8 * (sal - 35) - 0.15 * (temp - 10) + pres / 2000
+            columns = [('ctdpf_ckl_seawater_pressure', pres), ('ctdpf_ckl_seawater_temperature', temp),
+                       ('ctdpf_ckl_seawater_conductivity', cond), ('practical_salinity', sal), ('density', density)]
+        else:
+            chla = 2 * np.exp(-((pres - 30) / 15) ** 2)
+            columns = [('int_ctd_pressure', pres), ('fluorometric_chlorophyll_a', chla)]
+        names = ['time'] + [c[0] for c in columns]
+        return [dict(zip(names, row)) for row in zip(t.tolist(), *[c[1].tolist() for c in columns])]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        if not url.path.startswith(API_PATH):
+            return self.send_json(404, {'message': 'Not found'})
+        parts = [p for p in url.path[len(API_PATH):].split('/') if p]
+        self.server.count += 1
+
+        if len(parts) == 1:
+            body = sorted(NODES.keys())
+        elif len(parts) == 2:
+            body = NODES.get(parts[1], [])
+        elif len(parts) == 3:
+            body = METHODS
+        elif len(parts) == 4:
+            body = STREAMS['CTDPF' if 'CTD' in parts[2] else 'FLORT']
+        else:
+            q = dict(parse_qsl(url.query))
+            body = self.server.data.records(parts[2], ntp_seconds(q['beginDT']), ntp_seconds(q['endDT']),
+                                            int(q.get('limit', 10000)))
+            if not body:
+                return self.send_json(404, {'message': 'No data available for the requested time range'})
+        self.send_json(200, body)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, data=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.data = data or StubData()
+        self.count = 0  # number of API requests served
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}{}'.format(self.server_port, API_PATH)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server = StubServer(port, latency)
+    print 'Serving the M2M stub at {}'.format(server.base_url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
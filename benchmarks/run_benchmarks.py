@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+@brief: Repeatable benchmarks of the cruise data tools on synthetic data (see synthetic_cnv.py) and a local stub of the
+M2M API (see m2m_stub.py), so performance changes can be measured without the alfresco WebDAV mount or ooinet:
+    convert: convert_cnv_files.main, all of the casts to .csv
+    update_attributes: update_cruise_CTD_attributes.main, time/lat/lon of all of the casts
+    update_mapping: update_cruise_platform_mapping.main, all of the asset management deployment sheets, with suggested
+    casts for the deployments/recoveries without one
+    compare: compare_cruise_CTD_profilers.main, the CTDPF and FLORT on every platform vs. the casts
+Each benchmark runs in a new process, and reports the wall and CPU time, the throughput and the peak resident memory
+(of the benchmark process and the processes it started). Caches and manifests are disabled so every run does the full
+work. The results are printed and saved to benchmark_results_<timestamp>.csv in the output directory.
+
+@usage:
+python run_benchmarks.py /tmp/cruise_data_bench
+python run_benchmarks.py /tmp/cruise_data_bench --casts 40 --rows 100000 --latency 0.1 --workers 4 --repeat 3
+python run_benchmarks.py /tmp/cruise_data_bench --only convert compare --no-plots
+"""
+
+import argparse
+import datetime
+import os
+import resource
+import shutil
+import sys
+import time
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+from synthetic_cnv import make_dataset
+from m2m_stub import StubServer
+from instrumentation import peak_rss_mb
+
+BENCHMARKS = ['convert', 'update_attributes', 'update_mapping', 'compare', 'compare_platform']
+
+
+def cpu_seconds():
+    usage = [resource.getrusage(w) for w in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def clean_dir(d):
+    shutil.rmtree(d, True)
+    os.makedirs(d)
+    return d
+
+
+def mapped_deployments(dataset, platform):
+    # deployments/recoveries of a platform with CTD casts in the mapping, and the number of casts
+    mapping = dataset['mapping']
+    rows = mapping[(mapping['platform'] == platform) & (mapping['CTDcast'].astype(str) != '')]
+    return rows['Deployment'].tolist(), sum(len(str(c).split(',')) for c in rows['CTDcast'])
+
+
+def bench_convert(dataset, outdir, args):
+    from convert_cnv_files import main
+    main(clean_dir(outdir), os.path.join(dataset['cruise_data'], 'cruise_CTDs.csv'), workers=args.workers,
+         manifest=None)
+    return len(dataset['casts']), 'casts'
+
+
+def bench_update_attributes(dataset, outdir, args):
+    from update_cruise_CTD_attributes import main
+    from cruise_catalog import CruiseCatalog
+    main(clean_dir(outdir), manifest=None, catalog=CruiseCatalog(dataset['cruise_data_unfilled']))
+    return len(dataset['casts']), 'casts'
+
+
+def bench_update_mapping(dataset, outdir, args):
+    from update_cruise_platform_mapping import main
+    from cruise_catalog import CruiseCatalog
+    main(dataset['asset_management'], clean_dir(outdir), workers=args.workers, state=None,
+         catalog=CruiseCatalog(dataset['cruise_data']), match_km=10, match_days=14)
+    return len(dataset['platforms']), 'sheets'
+
+
+def bench_compare(dataset, outdir, args):
+    from compare_cruise_CTD_profilers import main, SELECTION_RULES
+    from cruise_catalog import CruiseCatalog
+    catalog = CruiseCatalog(dataset['cruise_data'])
+    clean_dir(outdir)
+    ncasts = 0
+    for platform in dataset['platforms']:
+        deployments, n = mapped_deployments(dataset, platform)
+        for sensor in ['WFP01-03-CTDPFK000', 'WFP01-04-FLORTK000']:
+            main(outdir, 'user', 'token', '-'.join((platform, sensor)), deployments, workers=args.workers,
+                 rules=SELECTION_RULES, catalog=catalog, plots=args.plots, base_url=args.base_url, cache_dir=None)
+            ncasts += n
+    return ncasts, 'casts'
+
+
+def bench_compare_platform(dataset, outdir, args):
+    # same comparisons as bench_compare, one run per platform (each cast is read once for both instruments)
+    from compare_cruise_CTD_profilers import platform_main, SELECTION_RULES
+    from cruise_catalog import CruiseCatalog
+    catalog = CruiseCatalog(dataset['cruise_data'])
+    clean_dir(outdir)
+    ncasts = 0
+    for platform in dataset['platforms']:
+        deployments, n = mapped_deployments(dataset, platform)
+        platform_main(outdir, 'user', 'token', platform, deployments, workers=args.workers, rules=SELECTION_RULES,
+                      catalog=catalog, plots=args.plots, base_url=args.base_url, cache_dir=None)
+        ncasts += 2 * n
+    return ncasts, 'casts'
+
+
+def run(name, dataset, outdir, args, queue):
+    # Run one benchmark in this (new) process and send the measurements back
+    start_rss = peak_rss_mb()
+    cpu = cpu_seconds()
+    start = time.time()
+    items, unit = globals()['bench_' + name](dataset, outdir, args)
+    seconds = time.time() - start
+    queue.put(OrderedDict([('benchmark', name), ('items', items), ('unit', unit), ('seconds', round(seconds, 3)),
+                           ('throughput', round(items / seconds, 3) if seconds else None),
+                           ('cpu_seconds', round(cpu_seconds() - cpu, 3)), ('start_rss_mb', start_rss),
+                           ('peak_rss_mb', max(peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN)))]))
+
+
+def main(outdir, benchmarks=BENCHMARKS, casts=20, rows=50000, latency=0.05, workers=4, repeat=1, plots=True):
+    dataset = make_dataset(os.path.join(outdir, 'data'), casts, rows)
+    server = StubServer(latency=latency)
+    args = argparse.Namespace(workers=workers, plots=plots, base_url=server.base_url)
+
+    results = []
+    try:
+        for name in benchmarks:
+            for r in range(repeat):
+                queue = Queue()
+                p = Process(target=run, args=(name, dataset, os.path.join(outdir, 'output', name), args, queue))
+                p.start()
+                p.join()
+                if p.exitcode != 0 or queue.empty():
+                    print 'Benchmark {} failed (exit code {})'.format(name, p.exitcode)
+                    continue
+                result = queue.get()
+                result['repeat'] = r
+                results.append(result)
+    finally:
+        server.stop()
+
+    report = pd.DataFrame(results)
+    if not report.empty:
+        for k, v in [('casts', casts), ('rows', rows), ('latency', latency), ('workers', workers), ('plots', plots)]:
+            report[k] = v
+        fname = 'benchmark_results_{}.csv'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
+        report.to_csv(os.path.join(outdir, fname), index=False)
+        print '\n' + report[['benchmark', 'repeat', 'items', 'unit', 'seconds', 'throughput', 'cpu_seconds',
+                             'peak_rss_mb']].to_string(index=False)
+        print 'Results saved to {}'.format(os.path.join(outdir, fname))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cruise data tools on synthetic data')
+    parser.add_argument('outdir', help='directory for the synthetic data, the output of the tools and the results')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='benchmarks to run')
+    parser.add_argument('--casts', type=int, default=20, help='number of synthetic .cnv files')
+    parser.add_argument('--rows', type=int, default=50000, help='number of data rows in each .cnv file')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of the M2M stub server (seconds)')
+    parser.add_argument('--workers', type=int, default=4, help='processes/threads used by the tools')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each benchmark')
+    parser.add_argument('--no-plots', dest='plots', action='store_false', help='skip the plots in the comparison')
+    a = parser.parse_args()
+    main(a.outdir, a.only, a.casts, a.rows, a.latency, a.workers, a.repeat, a.plots)
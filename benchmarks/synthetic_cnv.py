@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+@brief: Synthetic test data for the benchmarks: Seabird .cnv files of any size and the cruise_data tables and asset
+management deployment sheets that refer to them. The .cnv files are written in the fixed-width ascii layout of SBE Data
+Processing, and cycle through the header variants found in the OOI cruise files:
+    conductivity: c0S/m (CNDC in seabird.cnv) or c1mS/cm (kept as c1mS/cm by seabird.cnv)
+    density: sigma-\xe900 (sigma-theta, with the non-utf-8 header character) or density00
+The data are a down and up cast with a thermocline, so they look like real profiles when plotted. The cruise_data
+tables match the deployment sheets, as in the OOI Datateam Database. All of the data are generated from a fixed seed,
+so the files are the same on every run.
+
+@usage:
+write_cnv('/tmp/cast001.cnv', nrows=100000, conductivity='mS/cm', density='sigma')
+dataset = make_dataset('/tmp/bench', ncasts=20, nrows=50000)  # paths of the casts, cruise_data and deployment sheets
+python synthetic_cnv.py /tmp/bench 20 50000
+"""
+
+import datetime
+import os
+import sys
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+START = datetime.datetime(2015, 3, 8, 12, 34, 56)
+PLATFORMS = ['CP02PMUO', 'CP02PMCI', 'CP02PMCO', 'CP04OSPM', 'GI02HYPM', 'GA02HYPM', 'GP02HYPM', 'GS02HYPM']
+ARRAYS = {'CP': 'Coastal_Pioneer', 'GI': 'Global_Irminger', 'GA': 'Global_Argentine_basin', 'GP': 'Global_Papa',
+          'GS': 'Global_Southern_Ocean'}
+CONDUCTIVITY = {'S/m': ('c0S/m', 'Conductivity [S/m]', 1.0),
+                'mS/cm': ('c1mS/cm', 'Conductivity, 2 [mS/cm]', 10.0)}
+DENSITY = {'sigma': ('sigma-\xe900', 'Density [sigma-theta, kg/m^3]', 0.0),
+           'density': ('density00', 'Density [density, kg/m^3]', 1000.0)}
+
+
+def nmea_position(value, hemispheres):
+    degrees = int(abs(value))
+    return '{:d} {:05.2f} {}'.format(degrees, (abs(value) - degrees) * 60, hemispheres[0 if value >= 0 else 1])
+
+
+def profile_data(nrows, max_pres, rs):
+    # down and up cast: pressure, temperature, conductivity (S/m), salinity, sigma-theta, chlorophyll, elapsed time
+    half = np.linspace(0, 1, nrows // 2 + 1)
+    shape = np.r_[half, half[::-1][1:]][:nrows]
+    pres = np.maximum(shape * max_pres + rs.normal(0, 0.05, nrows), 0)
+    temp = 6 + 12 * (1 - np.tanh((pres - 60) / 30)) / 2 - pres / 1000 + rs.normal(0, 0.01, nrows)
+    sal = 35 - 2 * np.exp(-pres / 40) + rs.normal(0, 0.002, nrows)
+    cond = 2.9 + 0.09 * (temp - 6) + 0.03 * (sal - 33) + rs.normal(0, 0.0005, nrows)
+    sigma = 26 + 0.8 * (sal - 35) - 0.15 * (temp - 10) + pres / 2000
+    chla = np.maximum(2 * np.exp(-((pres - 30) / 15) ** 2) + rs.normal(0, 0.05, nrows), 0)
+    elapsed = np.arange(nrows) / 24.0
+    return pres, temp, cond, sal, sigma, chla, elapsed
+
+
+def write_cnv(path, nrows, conductivity='S/m', density='sigma', lat=40.13, lon=-70.78, start=START, max_pres=500,
+              seed=0):
+    cname, cdesc, cfactor = CONDUCTIVITY[conductivity]
+    dname, ddesc, doffset = DENSITY[density]
+    names = [('prDM', 'Pressure, Digiquartz [db]'), ('t090C', 'Temperature [ITS-90, deg C]'), (cname, cdesc),
+             ('sal00', 'Salinity, Practical [PSU]'), (dname, ddesc), ('flECO-AFL', 'Fluorescence, WET Labs ECO-AFL/FL '
+             '[mg/m^3]'), ('timeS', 'Time, Elapsed [seconds]'), ('flag', '0.000e+00')]
+    stime = start.strftime('%b %d %Y %H:%M:%S')
+    header = ['* Sea-Bird SBE 9 Data File:',
+              '* FileName = {}'.format(os.path.basename(path).replace('.cnv', '.hex')),
+              '* NMEA Latitude = {}'.format(nmea_position(lat, 'NS')),
+              '* NMEA Longitude = {}'.format(nmea_position(lon, 'EW')),
+              '* NMEA UTC (Time) = {}'.format(stime),
+              '** Station: {}'.format(os.path.basename(path)),
+              '# nquan = {}'.format(len(names)),
+              '# nvalues = {}'.format(nrows),
+              '# units = specified']
+    header += ['# name {} = {}: {}'.format(i, n, d) for i, (n, d) in enumerate(names)]
+    header += ['# start_time = {} [NMEA time, header]'.format(stime), '# bad_flag = -9.990e-29',
+               '# file_type = ascii', '*END*']
+
+    rs = np.random.RandomState(seed)
+    pres, temp, cond, sal, sigma, chla, elapsed = profile_data(nrows, max_pres, rs)
+    data = np.column_stack((pres, temp, cond * cfactor, sal, sigma + doffset, chla, elapsed, np.zeros(nrows)))
+    with open(path, 'wb') as fh:
+        fh.write(('\r\n'.join(header) + '\r\n').encode('latin-1') if not isinstance(header[0], bytes)
+                 else '\r\n'.join(header) + '\r\n')
+        np.savetxt(fh, data, fmt=['%11.3f', '%11.4f', '%11.6f', '%11.4f', '%11.4f', '%11.4f', '%11.3f', '%11.3e'],
+                   delimiter='', newline='\r\n')
+    return path
+
+
+def nmea_value(value):
+    # position as read back from the NMEA header written by nmea_position (minutes rounded to 2 decimals)
+    degrees = int(abs(value))
+    return round((degrees + round((abs(value) - degrees) * 60, 2) / 60) * (1 if value >= 0 else -1), 6)
+
+
+def deployment_times(ndeployments, start=START):
+    # (startDateTime, stopDateTime) of each deployment: 180 days apart, recovered after 179 days
+    return [(start + datetime.timedelta(days=180 * d), start + datetime.timedelta(days=180 * d + 179))
+            for d in range(ndeployments)]
+
+
+def deployment_sheet(platform, ndeployments, lat, lon, start):
+    rows = []
+    for d, (begin, end) in enumerate(deployment_times(ndeployments, start), 1):
+        rows.append(OrderedDict([('CUID_Deploy', 'AT-{}'.format(d)), ('deployedBy', ''),
+                                 ('CUID_Recover', 'AT-{}'.format(d + 1)), ('recoveredBy', ''),
+                                 ('Reference Designator', '{}-WFP01-03-CTDPFK000'.format(platform)),
+                                 ('deploymentNumber', d), ('versionNumber', 1),
+                                 ('startDateTime', begin.strftime('%Y-%m-%dT%H:%M:%S')),
+                                 ('stopDateTime', end.strftime('%Y-%m-%dT%H:%M:%S')),
+                                 ('mooring.uid', ''), ('node.uid', ''), ('sensor.uid', ''), ('lat', lat), ('lon', lon),
+                                 ('orbit', ''), ('deployment_depth', ''), ('water_depth', ''), ('notes', '')]))
+    return pd.DataFrame(rows)
+
+
+def make_dataset(outdir, ncasts=20, nrows=50000, ndeployments=4, seed=0):
+    # One asset management deployment sheet per platform, and the platform_CTDcast_mapping.csv rows of each
+    # deployment/recovery in the sheets (so reconciling them with the sheets finds no changes). The casts are done
+    # within hours and about a km of the deployments/recoveries, spread over the platforms, and have their date and
+    # location filled in cruise_CTDs.csv. One in four deployments/recoveries with a cast has the CTD cast columns left
+    # blank in the mapping, for update_cruise_platform_mapping to suggest. cruise_data_unfilled has the same tables
+    # with the cast date and location blank, for update_cruise_CTD_attributes.
+    castdir = os.path.join(outdir, 'casts')
+    cruisedir = os.path.join(outdir, 'cruise_data')
+    unfilleddir = os.path.join(outdir, 'cruise_data_unfilled')
+    amdir = os.path.join(outdir, 'asset-management', 'deployment')
+    for d in [castdir, cruisedir, unfilleddir, amdir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    rs = np.random.RandomState(seed)
+    platforms = PLATFORMS[:max(1, min(len(PLATFORMS), ncasts // (2 * ndeployments) or 1))]
+    locations = dict((p, (round(40.1 + 0.1 * i, 2), round(-70.8 + 0.1 * i, 2))) for i, p in enumerate(platforms))
+    times = deployment_times(ndeployments)
+    entries = OrderedDict()  # (platform, Deployment): mapping row
+    for platform in platforms:
+        for d, (begin, end) in enumerate(times, 1):
+            for kind, date, cruise in [('D', begin, d), ('R', end, d + 1)]:
+                entries[(platform, '{}{:05d}'.format(kind, d))] = OrderedDict([
+                    ('Array', ARRAYS[platform[0:2]]), ('platform', platform), ('deploymentNumber', d),
+                    ('Deployment', '{}{:05d}'.format(kind, d)), ('lat', locations[platform][0]),
+                    ('lon', locations[platform][1]), ('CUID', 'AT-{}'.format(cruise)),
+                    ('AM_Date', date.strftime('%Y-%m-%dT%H:%M:%S')), ('CTD_CruiseName', ''), ('CTD_CruiseLeg', ''),
+                    ('CTDcast', ''), ('notes', ''), ('date', date)])
+
+    casts = []
+    for i in range(ncasts):
+        platform = platforms[i % len(platforms)]
+        keys = [k for k in entries if k[0] == platform]
+        entry = entries[keys[i // len(platforms) % len(keys)]]
+        start = entry['date'] + datetime.timedelta(hours=i % 12 + 1)
+        lat, lon = locations[platform][0] + rs.normal(0, 0.01), locations[platform][1] + rs.normal(0, 0.01)
+        fname = 'cast{:03d}.cnv'.format(i + 1)
+        path = os.path.join(castdir, fname)
+        if not os.path.isfile(path):
+            write_cnv(path, nrows, conductivity=['S/m', 'mS/cm'][i % 2], density=['sigma', 'density'][i // 2 % 2],
+                      lat=lat, lon=lon, start=start, seed=seed + i)
+        cruise = entry['CUID']
+        casts.append(OrderedDict([('CUID', cruise), ('CTD_CruiseName', cruise), ('CTD_CruiseLeg', ''),
+                                  ('CTDcast', i + 1), ('CTD_Date', start.strftime('%Y-%m-%dT%H:%M:%S')),
+                                  ('CTD_lat', nmea_value(lat)), ('CTD_lon', nmea_value(lon)),
+                                  ('filepath_primary', castdir + '/'), ('CTD_rawdata_filepath', fname)]))
+        if entry['CTDcast'] == '':
+            entry['CTD_CruiseName'], entry['CTDcast'] = cruise, str(i + 1)
+        else:
+            entry['CTD_CruiseName'] += ', ' + cruise
+            entry['CTDcast'] += ', ' + str(i + 1)
+
+    with_casts = [e for e in entries.values() if e['CTDcast'] != '']
+    for entry in with_casts[3::4]:
+        entry['CTD_CruiseName'], entry['CTDcast'] = '', ''
+    mapping = pd.DataFrame(list(entries.values())).drop('date', axis=1)
+    casts = pd.DataFrame(casts)
+    for d, table in [(cruisedir, casts), (unfilleddir, casts.assign(CTD_Date='', CTD_lat='', CTD_lon=''))]:
+        table.to_csv(os.path.join(d, 'cruise_CTDs.csv'), index=False)
+        mapping.to_csv(os.path.join(d, 'platform_CTDcast_mapping.csv'), index=False)
+    for platform in platforms:
+        sheet = deployment_sheet(platform, ndeployments, locations[platform][0], locations[platform][1], START)
+        sheet.to_csv(os.path.join(amdir, '{}_Deploy.csv'.format(platform)), index=False)
+
+    return {'casts': [os.path.join(castdir, f) for f in casts['CTD_rawdata_filepath']], 'cruise_data': cruisedir,
+            'cruise_data_unfilled': unfilleddir, 'asset_management': amdir, 'platforms': platforms,
+            'mapping': mapping}
+
+
+if __name__ == '__main__':
+    outdir = sys.argv[1]
+    ncasts = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    nrows = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+    dataset = make_dataset(outdir, ncasts, nrows)
+    print 'Wrote {} casts of {} rows to {}'.format(len(dataset['casts']), nrows, outdir)
@@ -0,0 +1,15 @@
+import os
+from setuptools import setup
+
+setup(
+    name='cruise_data',
+    version='0.1.0',
+    description='Tools to work with OOI cruise shipboard CTD data and compare them to uFrame profiler data',
+    author='Lori Garzio',
+    url='https://github.com/ooi-data-review/cruise_data',
+    package_dir={'': 'tools'},
+    py_modules=sorted(os.path.splitext(f)[0] for f in os.listdir('tools') if f.endswith('.py')),
+    install_requires=['geopy', 'matplotlib', 'numpy', 'pandas', 'requests', 'seabird'],
+    extras_require={'arrow': ['pyarrow']},  # feather and parquet output formats
+    entry_points={'console_scripts': ['cruise-data = cruise_data_cli:main']},
+)
@@ -0,0 +1,81 @@
+import os
+import shutil
+import sys
+import tempfile
+from io import StringIO
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+from cnv_reader import read_cnv
+from cast_formats import write_cast
+
+HEADER = ['* Sea-Bird SBE 9 Data File:',
+          '* NMEA Latitude = 40 07.06 N',
+          '* NMEA Longitude = 070 46.80 W',
+          '* NMEA UTC (Time) = Mar 08 2015 12:34:56',
+          '# nquan = 5',
+          '# name 0 = scan: Scan Count',
+          '# name 1 = prDM: Pressure, Digiquartz [db]',
+          '# name 2 = t090C: Temperature [ITS-90, deg C]',
+          '# name 3 = nbin: number of scans per bin',
+          '# name 4 = flag:  0.000e+00',
+          '*END*']
+ROWS = [(1, 12.0, 10.1234, 24, 0.0), (2, 13.0, 10.0456, 24, 0.0), (3, 14.5, 9.9876, 23, 0.0)]
+
+
+def write_file(path, fixed_width=True):
+    if fixed_width:
+        lines = ['{:11d}{:11.3f}{:11.4f}{:11d}{:11.3e}'.format(*row) for row in ROWS]
+    else:
+        lines = ['{:d} {:.3f} {:.4f} {:d} {:.3e}'.format(*row) for row in ROWS]
+    with open(path, 'wb') as fh:
+        fh.write('\r\n'.join(HEADER + lines + ['']).encode('latin-1'))
+
+
+def baseline_csv(f):
+    # conversion of the original convert_cnv_files.py (pandas.read_table of the data block)
+    ctdfile = StringIO(open(f, 'rb').read().decode(encoding='utf-8', errors='replace'))
+    header1, header2 = [], []
+    for k, line in enumerate(ctdfile.readlines()):
+        if '# name ' in line:
+            name, desc = line.rstrip('\r\n').split('=')[1].split(':')
+            header1.append(str(name).lstrip())
+            header2.append(str(desc).lstrip())
+        if '*END*' in line:
+            skiprows = k + 1
+    ctdfile.seek(0)
+    df = pd.read_table(ctdfile, header=None, names=header1, index_col=None, skiprows=skiprows, delim_whitespace=True)
+    df.columns = pd.MultiIndex.from_tuples(list(zip(df.columns, header2)))
+    return df.to_csv(index=False)
+
+
+def check_csv(fixed_width):
+    tmp = tempfile.mkdtemp()
+    try:
+        f = os.path.join(tmp, 'cast.cnv')
+        write_file(f, fixed_width)
+        outfile = write_cast(read_cnv(f), {}, os.path.join(tmp, 'cast'), 'csv')
+        with open(outfile) as fh:
+            assert fh.read() == baseline_csv(f)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_integer_columns():
+    tmp = tempfile.mkdtemp()
+    try:
+        f = os.path.join(tmp, 'cast.cnv')
+        write_file(f)
+        df = read_cnv(f)
+        assert [str(t) for t in df.dtypes] == ['int64', 'float64', 'float64', 'int64', 'float64']
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_csv_matches_baseline_fixed_width():
+    check_csv(True)
+
+
+def test_csv_matches_baseline_whitespace():
+    check_csv(False)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+from profile_segments import direction_changes, segment_profiles, closest_profiles
+
+
+def profiler(nprofiles=6, n=2000, depth=(10, 200), noise=0.0, seed=0):
+    # Pressure of a profiler going down and up between depth, one point per 10 s, with noise (dbar)
+    down = np.linspace(depth[0], depth[1], n, endpoint=False)
+    up = np.linspace(depth[1], depth[0], n, endpoint=False)
+    pres = np.concatenate([down if i % 2 == 0 else up for i in range(nprofiles)])
+    pres += np.random.RandomState(seed).uniform(-noise, noise, len(pres))
+    time = np.datetime64('2018-06-01T00:00:00') + np.arange(len(pres)) * np.timedelta64(10, 's')
+    return time, pres
+
+
+def test_clean_profiles():
+    time, pres = profiler()
+    segments = segment_profiles(time, pres)
+    assert len(segments) == 6
+    assert (segments[1:, 0] == segments[:-1, 1]).all()
+
+
+def test_noisy_profiles():
+    # 0.1-0.3 dbar of noise is larger than the pressure change between two points (0.095 dbar)
+    time, pres = profiler(noise=0.3)
+    breaks = direction_changes(pres, 5.0)
+    assert len(breaks) == 5
+    assert (np.abs(breaks - np.arange(2000, 12000, 2000)) < 50).all()
+
+    segments = segment_profiles(time, pres)
+    assert len(segments) == 6
+    ind = closest_profiles(time, segments, time[5000], n=2)
+    assert len(ind) < 5000
+    assert ind[0] <= 5000 <= ind[-1]
+
+
+def test_parked_profiler():
+    # excursions of less than min_range at the bottom don't split the profile
+    time, pres = profiler(nprofiles=2)
+    pres = np.insert(pres, 2000, 200 + np.tile([0, 2, 0, -2], 50))
+    time = np.datetime64('2018-06-01T00:00:00') + np.arange(len(pres)) * np.timedelta64(10, 's')
+    assert len(segment_profiles(time, pres)) == 2
+
+
+def test_no_profiles():
+    time, pres = profiler(nprofiles=1, depth=(100, 102), noise=0.3)
+    assert len(direction_changes(pres, 5.0)) == 0
+    assert segment_profiles(time, pres).tolist() == [[0, len(pres)]]
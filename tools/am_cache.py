@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+@brief: Persistent local state of the asset management deployment sheets
+(https://github.com/ooi-integration/asset-management/tree/master/deployment) that were read by
+update_cruise_platform_mapping. Each sheet is keyed by its path and fingerprinted by size and modification time (and
+optionally an md5 hash of its content) like the .cnv manifest in cnv_cache.py, and the state records the
+platform deployment/recovery entries extracted from the sheet. Only the sheets that were added or changed since the last
+run need to be read again, and the entries of sheets that were deleted are dropped.
+
+@usage:
+state = AMSheetCache()  # or AMSheetCache(state_file, use_hash=True)
+entry, fp = state.lookup(f)  # entry is None if the sheet is new or has changed
+...read the sheet...
+state.record(f, fp, records)  # records: {'CP02PMUO_D00010': {'deploymentNumber': 10, 'lat': ...}, ...}
+state.prune()  # forget the sheets that no longer exist
+dfile_dict = state.records(sheets)
+state.save()
+"""
+
+import os
+from cnv_cache import CNVCache
+
+DEFAULT_STATE = os.path.join(os.path.expanduser('~'), '.cruise_data', 'am_deployment_state.json')
+
+
+class AMSheetCache(CNVCache):
+    def __init__(self, manifest=DEFAULT_STATE, use_hash=False):
+        super(AMSheetCache, self).__init__(manifest, use_hash)
+
+    def record(self, f, fp, records=None):
+        # Add or replace the entry for a sheet that was read
+        if fp is None:
+            return
+        self.entries[f] = dict(fp, records=records or {})
+
+    def prune(self):
+        # Remove the entries of sheets that no longer exist (deleted upstream). Returns the removed sheets.
+        removed = [f for f in self.entries if not os.path.isfile(f)]
+        for f in removed:
+            del self.entries[f]
+        return removed
+
+    def records(self, sheets):
+        # The platform deployment/recovery entries of all of the sheets, combined in one dictionary
+        combined = {}
+        for f in sheets:
+            entry = self.entries.get(f)
+            if entry is not None:
+                combined.update(entry['records'])
+        return combined
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+@brief: Consolidated local archive of converted cruise shipboard CTD casts. The data of all of the casts are
+concatenated into one contiguous .npy file per variable, and a metadata table (casts.csv) records the cruise, leg, cast,
+CUID, date, location, .cnv file and converted file of each cast with its offset and length in the variable arrays. The
+arrays are opened as memory maps, so selecting casts by cruise/leg/cast, time range or bounding box and reading their
+data only touches the bytes of those casts on local disk.
+
+Archive directory layout:
+    casts.csv: one row per cast (metadata, .cnv file, offset, length)
+    variables.json: variable name -> array file and units
+    v000.npy, v001.npy, ...: float64 data of each variable. Casts without the variable are filled with NaN.
+    sources.json: size and modification time of the converted files and the metadata the archive was built from. The
+    archive is only rebuilt when they change.
+
+@usage:
+build_archive(archive_dir, [(converted_file, metadata), ...])  # metadata: see CAST_METADATA in convert_cnv_files.py
+archive = CastArchive(archive_dir)
+casts = archive.select(cruise='AT-37', begin='2017-06-01', end='2017-07-01', bbox=(-71, 39.5, -70, 40.5))
+for cast_id, row in casts.iterrows():
+    data = archive.data(cast_id, ['prDM', 't090C'])  # {'prDM': array, ...} views of the memory-mapped arrays
+cast_id = archive.find('/path/to/at2630007.cnv')  # None if the .cnv file isn't in the archive
+"""
+
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from cast_formats import load_cast, cast_shape, unique_names
+from cruise_catalog import key_str
+
+METADATA_COLUMNS = ['cruise', 'leg', 'cast', 'CUID', 'datetime', 'lat', 'lon', 'cnv', 'source']
+
+
+def cast_columns(columns):
+    # variable names (unique within the cast) and units of the (name, unit) columns of a converted cast
+    return unique_names([c[0] for c in columns]), [c[1] for c in columns]
+
+
+def archive_sources(casts):
+    # size and modification time of the converted files and the metadata the archive is built from
+    sources = []
+    for f, metadata in casts:
+        st = os.stat(f)
+        sources.append([f, st.st_size, st.st_mtime, sorted((metadata or {}).items())])
+    return json.dumps(sources, default=str)
+
+
+def archive_current(archive_dir, sources):
+    # True if the archive in archive_dir was built from the same sources
+    try:
+        with open(os.path.join(archive_dir, 'sources.json')) as fh:
+            if fh.read() != sources:
+                return False
+        with open(os.path.join(archive_dir, 'variables.json')) as fh:
+            files = [v['file'] for v in json.load(fh)]
+    except (IOError, OSError, ValueError):
+        return False
+    return all(os.path.isfile(os.path.join(archive_dir, f)) for f in ['casts.csv'] + files)
+
+
+def build_archive(archive_dir, casts):
+    # Build the archive from converted cast files (any format written by cast_formats.write_cast). casts is a list of
+    # (file, metadata); metadata from the cruise CTD sheet takes precedence over the metadata stored in the file.
+    # The sizes and variables are read first without loading the data (see cast_formats.cast_shape) so the arrays can
+    # be preallocated on disk, then the data of each cast is copied. If none of the files or metadata changed since
+    # the archive was built, the existing archive is kept.
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    sources = archive_sources(casts)
+    if archive_current(archive_dir, sources):
+        print 'The cast archive in {} is up to date'.format(archive_dir)
+        return CastArchive(archive_dir).casts
+
+    rows = []
+    variables = OrderedDict()
+    offset = 0
+    for f, metadata in casts:
+        nrows, columns, stored = cast_shape(f)
+        meta = dict(stored)
+        meta.update(metadata or {})
+        names, units = cast_columns(columns)
+        for name, unit in zip(names, units):
+            variables.setdefault(name, unit)
+        row = OrderedDict((k, meta.get(k, '')) for k in METADATA_COLUMNS)
+        for k in ['cruise', 'leg', 'cast', 'CUID']:
+            row[k] = key_str(row[k])
+        row['source'] = f
+        row['offset'] = offset
+        row['length'] = nrows
+        rows.append(row)
+        offset += nrows
+    table = pd.DataFrame(rows, columns=METADATA_COLUMNS + ['offset', 'length'])
+    if offset == 0:
+        print 'No cast data to archive'
+        return table
+
+    # preallocate one array per variable
+    files = OrderedDict((name, 'v{:03d}.npy'.format(i)) for i, name in enumerate(variables))
+    arrays = OrderedDict()
+    for name, fname in files.items():
+        arrays[name] = np.lib.format.open_memmap(os.path.join(archive_dir, fname + '.tmp'), mode='w+',
+                                                 dtype=np.float64, shape=(offset,))
+        arrays[name][:] = np.nan
+
+    for (f, metadata), (i, row) in zip(casts, table.iterrows()):
+        df, stored = load_cast(f)
+        names, units = cast_columns(df.columns)
+        start, stop = row['offset'], row['offset'] + row['length']
+        for j, name in enumerate(names):
+            arrays[name][start:stop] = df.iloc[:, j].values
+
+    # replace the previous archive files only once all of the new ones are written
+    for name, fname in list(files.items()):
+        arrays[name].flush()
+        del arrays[name]
+        os.rename(os.path.join(archive_dir, fname + '.tmp'), os.path.join(archive_dir, fname))
+    with open(os.path.join(archive_dir, 'variables.json'), 'w') as fh:
+        json.dump([OrderedDict([('name', n), ('file', files[n]), ('units', variables[n])]) for n in files], fh,
+                  indent=1)
+    table.to_csv(os.path.join(archive_dir, 'casts.csv'), index_label='cast_id')
+    with open(os.path.join(archive_dir, 'sources.json'), 'w') as fh:
+        fh.write(sources)
+    print 'Archived {} casts ({} data rows, {} variables) in {}'.format(len(table), offset, len(files), archive_dir)
+    return table
+
+
+class CastArchive(object):
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.casts = pd.read_csv(os.path.join(archive_dir, 'casts.csv'), index_col='cast_id',
+                                 dtype={'cruise': str, 'leg': str, 'cast': str, 'CUID': str}).fillna('')
+        with open(os.path.join(archive_dir, 'variables.json')) as fh:
+            self.variables = OrderedDict((v['name'], v) for v in json.load(fh))
+        self._arrays = {}
+        self._cnv = None
+
+    def units(self, name):
+        return self.variables[name]['units']
+
+    def array(self, name):
+        # Memory-mapped data of one variable for all of the casts
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.archive_dir, self.variables[name]['file']), mmap_mode='r')
+        return self._arrays[name]
+
+    def select(self, cruise=None, leg=None, cast=None, begin=None, end=None, bbox=None):
+        # Casts matching all of the criteria. begin/end: dates (inclusive), bbox: (lon_min, lat_min, lon_max, lat_max)
+        mask = np.ones(len(self.casts), dtype=bool)
+        for col, value in [('cruise', cruise), ('leg', leg), ('cast', cast)]:
+            if value is not None:
+                mask &= (self.casts[col].map(key_str) == key_str(value)).values
+        if begin is not None or end is not None:
+            times = pd.to_datetime(self.casts['datetime'], errors='coerce')
+            if begin is not None:
+                mask &= (times >= pd.Timestamp(begin)).values
+            if end is not None:
+                mask &= (times <= pd.Timestamp(end)).values
+        if bbox is not None:
+            lat = pd.to_numeric(self.casts['lat'], errors='coerce').values
+            lon = pd.to_numeric(self.casts['lon'], errors='coerce').values
+            with np.errstate(invalid='ignore'):
+                mask &= (lon >= bbox[0]) & (lat >= bbox[1]) & (lon <= bbox[2]) & (lat <= bbox[3])
+        return self.casts[mask]
+
+    def find(self, cnv):
+        # cast_id of the cast converted from the .cnv file, or None if it isn't in the archive
+        if self._cnv is None:
+            cnv_files = self.casts['cnv'] if 'cnv' in self.casts else []
+            self._cnv = dict((f, cast_id) for cast_id, f in zip(self.casts.index, cnv_files) if f)
+        return self._cnv.get(cnv)
+
+    def data(self, cast_id, names=None):
+        # Data of one cast: variable name -> view of the memory-mapped array (no data is copied)
+        row = self.casts.loc[cast_id]
+        start, stop = row['offset'], row['offset'] + row['length']
+        data = OrderedDict()
+        for name in names or self.variables.keys():
+            data[name] = self.array(name)[start:stop]
+        return data
+
+    def frame(self, cast_id, names=None):
+        # Data of one cast as a DataFrame with a (name, unit) MultiIndex on the columns
+        data = self.data(cast_id, names)
+        columns = pd.MultiIndex.from_tuples([(n, self.units(n)) for n in data])
+        return pd.DataFrame(np.column_stack(list(data.values())) if data else None, columns=columns)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+@brief: In-memory LRU cache of decoded cruise shipboard CTD casts, bounded by the memory used by the cached arrays. The
+instruments on one platform (e.g. the CTDPF and FLORT on a profiler) are compared to the same casts, so a comparison run
+over a platform reads and parses each cast file once however many instruments use it. When the cached casts take more
+than max_mb, the least recently used casts are evicted.
+
+@usage:
+casts = CastCache(max_mb=256)
+cast = casts.get(f, read_cast)  # calls read_cast(f) only if f isn't cached
+casts.hits, casts.misses, casts.evictions
+"""
+
+from collections import OrderedDict
+import threading
+import instrumentation
+
+
+def value_nbytes(value):
+    # Approximate memory used by the arrays in a decoded cast (nested dicts/lists of numpy arrays)
+    if isinstance(value, dict):
+        return sum(value_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_nbytes(v) for v in value)
+    return getattr(value, 'nbytes', 0)
+
+
+class CastCache(object):
+    def __init__(self, max_mb=256):
+        self.max_bytes = int(max_mb * 1048576)
+        self.entries = OrderedDict()  # key: (value, nbytes), least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, loader):
+        # Returns the cached value of key, or loader(key) after adding it to the cache
+        with self.lock:
+            if key in self.entries:
+                value, nbytes = self.entries.pop(key)
+                self.entries[key] = (value, nbytes)  # most recently used
+                self.hits += 1
+                instrumentation.count('cast cache hits')
+                return value
+            self.misses += 1
+
+        value = loader(key)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        nbytes = value_nbytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return  # larger than the whole cache, don't evict everything else for it
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                old, (v, n) = self.entries.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
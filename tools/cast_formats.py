@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+@brief: Writers and readers for converted cruise shipboard CTD casts. Besides the .csv format with a two-row name/unit
+header, casts can be saved in binary columnar formats that keep the dtypes and store the units and the cast metadata
+(lat, lon, datetime, cruise, leg, cast) in the file itself, so loading a cast doesn't require parsing any text:
+    csv: comma-separated text with the variable names and units in the first two rows (no cast metadata)
+    npz: compressed NumPy archive
+    npy: uncompressed NumPy array with a .json sidecar for the names, units and metadata. Loaded as a memory map.
+    feather: uncompressed Arrow IPC (Feather V2) file. Read through a memory map. Requires pyarrow.
+    parquet: compressed Parquet file. Requires pyarrow.
+
+@usage:
+outfile = write_cast(df, metadata, '/path/to/at2630007', 'npy')  # df has a (name, unit) MultiIndex on the columns
+df, metadata = load_cast(outfile)
+nrows, columns, metadata = cast_shape(outfile)  # without loading the data
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+FORMATS = ['csv', 'npz', 'npy', 'feather', 'parquet']
+METADATA_KEY = 'cruise_data'
+
+
+def format_ext(fmt):
+    if fmt not in FORMATS:
+        raise ValueError('Unknown output format {}. Choose from: {}'.format(fmt, ', '.join(FORMATS)))
+    return '.' + fmt
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('pyarrow is required for the feather and parquet output formats: pip install pyarrow')
+    return pyarrow
+
+
+def unique_names(names):
+    # Columnar formats need unique column names (e.g. there can be two 'sigma' columns in a .cnv file)
+    output = []
+    for n in names:
+        name = n
+        i = 1
+        while name in output:
+            name = '{}_{}'.format(n, i)
+            i += 1
+        output.append(name)
+    return output
+
+
+def cast_metadata(df, metadata):
+    # numpy scalars read from the cruise CTD sheet aren't JSON serializable
+    cast = {}
+    for k, v in (metadata or {}).items():
+        cast[k] = v.item() if isinstance(v, np.generic) else v
+    return {'names': [c[0] for c in df.columns], 'units': [c[1] for c in df.columns], 'cast': cast}
+
+
+def write_cast(df, metadata, outbase, fmt='csv'):
+    # Save a cast to outbase + the extension of the format. Returns the path of the file that was written.
+    outfile = outbase + format_ext(fmt)
+    if fmt == 'csv':
+        df.to_csv(outfile, index=False, encoding='utf-8')
+        return outfile
+
+    meta = cast_metadata(df, metadata)
+    data = np.ascontiguousarray(df.values, dtype=np.float64)
+    if fmt == 'npz':
+        np.savez_compressed(outfile, data=data, metadata=np.array(json.dumps(meta)))
+    elif fmt == 'npy':
+        np.save(outfile, data)
+        with open(outbase + '.json', 'w') as fh:
+            json.dump(meta, fh)
+    else:
+        pa = import_pyarrow()
+        columns = [pa.array(data[:, i]) for i in range(data.shape[1])]
+        table = pa.Table.from_arrays(columns, unique_names(meta['names']))
+        table = table.replace_schema_metadata({METADATA_KEY: json.dumps(meta)})
+        if fmt == 'parquet':
+            pa.parquet.write_table(table, outfile, compression='snappy')
+        else:
+            writer = pa.RecordBatchFileWriter(outfile, table.schema)
+            writer.write_table(table)
+            writer.close()
+
+    return outfile
+
+
+def cast_shape(f):
+    # Number of rows, (name, unit) columns and metadata of a cast saved by write_cast, without loading the data (only
+    # the array header, the sidecar or the file metadata is read; the rows of csv files are counted)
+    fmt = os.path.splitext(f)[1][1:]
+    if fmt == 'csv':
+        columns = list(pd.read_csv(f, header=[0, 1], nrows=1).columns)
+        with open(f, 'rb') as fh:
+            lines = sum(chunk.count(b'\n') for chunk in iter(lambda: fh.read(1048576), b''))
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) != b'\n':
+                lines += 1
+        return lines - 2, columns, {}
+
+    if fmt == 'npz':
+        with np.load(f) as npz:
+            meta = json.loads(str(npz['metadata']))
+            fh = npz.zip.open('data.npy')
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape = np.lib.format.read_array_header_1_0(fh)[0]
+            else:
+                shape = np.lib.format.read_array_header_2_0(fh)[0]
+            fh.close()
+        nrows = shape[0]
+    elif fmt == 'npy':
+        nrows = np.load(f, mmap_mode='r').shape[0]
+        with open(os.path.splitext(f)[0] + '.json') as fh:
+            meta = json.load(fh)
+    elif fmt in ['feather', 'parquet']:
+        pa = import_pyarrow()
+        if fmt == 'parquet':
+            pq = pa.parquet.ParquetFile(f)
+            nrows, schema = pq.metadata.num_rows, pq.schema_arrow
+        else:
+            reader = pa.ipc.open_file(pa.memory_map(f))
+            nrows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+            schema = reader.schema
+        meta = json.loads(schema.metadata[METADATA_KEY.encode()])
+    else:
+        format_ext(fmt)
+
+    return nrows, list(zip(meta['names'], meta['units'])), meta['cast']
+
+
+def load_cast(f):
+    # Load a cast saved by write_cast. Returns a DataFrame with a (name, unit) MultiIndex on the columns and the
+    # cast metadata. Data in npy files are memory-mapped rather than read into memory.
+    fmt = os.path.splitext(f)[1][1:]
+    if fmt == 'csv':
+        return pd.read_csv(f, header=[0, 1]), {}
+
+    if fmt == 'npz':
+        with np.load(f) as npz:
+            data = npz['data']
+            meta = json.loads(str(npz['metadata']))
+    elif fmt == 'npy':
+        data = np.load(f, mmap_mode='r')
+        with open(os.path.splitext(f)[0] + '.json') as fh:
+            meta = json.load(fh)
+    elif fmt in ['feather', 'parquet']:
+        pa = import_pyarrow()
+        if fmt == 'parquet':
+            table = pa.parquet.read_table(f, memory_map=True)
+        else:
+            table = pa.ipc.open_file(pa.memory_map(f)).read_all()
+        meta = json.loads(table.schema.metadata[METADATA_KEY.encode()])
+        data = np.column_stack([c.to_numpy() for c in table.columns]) if table.num_columns else np.empty((0, 0))
+    else:
+        format_ext(fmt)
+
+    columns = pd.MultiIndex.from_tuples(list(zip(meta['names'], meta['units'])))
+    return pd.DataFrame(data, columns=columns, copy=False), meta['cast']
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+@brief: Spatio-temporal index of the cruise shipboard CTD casts in cruise_CTDs.csv
+(https://github.com/seagrinch/data-team-python/tree/master/cruise_data). The casts are sorted by time, so the casts done
+within a number of days of a platform deployment/recovery are found with a binary search, and the great-circle
+(haversine) distances to those candidate casts are calculated with NumPy for all of the deployments at once.
+
+@usage:
+index = CastIndex(casts)  # casts: DataFrame of cruise_CTDs.csv with CTD_Date, CTD_lat, CTD_lon
+matches = index.query(lats, lons, times, km=10, days=14)  # one row for each (query point, cast) match
+matches = index.match(mapping, km=10, days=14)  # matches for every row of platform_CTDcast_mapping.csv
+"""
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088  # mean Earth radius
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Great-circle distance in km between points given in radians (arrays are broadcast)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def to_float(values):
+    return pd.to_numeric(pd.Series(values), errors='coerce').values.astype(np.float64)
+
+
+def to_datetime64(values):
+    # Date strings (e.g. 2017-06-01T14:30:00) to datetime64[s]. Blank or invalid dates are NaT.
+    return pd.to_datetime(pd.Series(values), errors='coerce').values.astype('datetime64[s]')
+
+
+class CastIndex(object):
+    def __init__(self, casts):
+        # Casts without a date or location (e.g. not yet filled in by update_cruise_CTD_attributes) aren't indexed
+        lat = to_float(casts['CTD_lat'])
+        lon = to_float(casts['CTD_lon'])
+        times = to_datetime64(casts['CTD_Date'])
+        valid = ~(np.isnan(lat) | np.isnan(lon) | pd.isnull(times))
+        order = np.argsort(times[valid], kind='mergesort')
+
+        self.casts = casts
+        self.labels = casts.index.values[valid][order]
+        self.times = times[valid][order]
+        self.lat = np.radians(lat[valid][order])
+        self.lon = np.radians(lon[valid][order])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def query(self, lats, lons, times, km, days):
+        # Casts within km and days of each query point. Returns a DataFrame with the position of the query point, the
+        # row label of the cast in the casts table, the distance (km) and the time difference (days, cast - query).
+        lat = np.radians(to_float(lats))
+        lon = np.radians(to_float(lons))
+        times = to_datetime64(times)
+        valid = ~(np.isnan(lat) | np.isnan(lon) | pd.isnull(times))
+
+        # candidate casts of each query point: a contiguous slice of the time axis
+        window = np.timedelta64(int(round(days * 86400)), 's')
+        lo = np.zeros(len(times), dtype=np.int64)
+        hi = np.zeros(len(times), dtype=np.int64)
+        lo[valid] = np.searchsorted(self.times, times[valid] - window, side='left')
+        hi[valid] = np.searchsorted(self.times, times[valid] + window, side='right')
+
+        # expand the slices to (query, cast) pairs and calculate all of the distances at once
+        n = hi - lo
+        q = np.repeat(np.arange(len(times)), n)
+        c = np.repeat(lo, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        distance = haversine_km(lat[q], lon[q], self.lat[c], self.lon[c])
+        keep = distance <= km
+        q, c, distance = q[keep], c[keep], distance[keep]
+        dt = (self.times[c] - times[q]).astype(np.float64) / 86400
+
+        return pd.DataFrame({'query': q, 'cast': self.labels[c], 'distance_km': distance, 'days': dt},
+                            columns=['query', 'cast', 'distance_km', 'days'])
+
+    def match(self, mapping, km, days, date_column='AM_Date'):
+        # Casts within km and days of the location and date of each platform deployment/recovery in
+        # platform_CTDcast_mapping.csv. Returns the matches with the platform, deployment, cruise, leg and cast,
+        # closest casts first.
+        matches = self.query(mapping['lat'], mapping['lon'], mapping[date_column], km, days)
+        rows = mapping.iloc[matches['query'].values]
+        casts = self.casts.loc[matches['cast'].values]
+        matches['mapping'] = rows.index.values
+        for col in ['platform', 'Deployment']:
+            matches[col] = rows[col].values
+        for col in ['CTD_CruiseName', 'CTD_CruiseLeg', 'CTDcast', 'CTD_Date']:
+            matches[col] = casts[col].values
+        return matches.sort_values(['query', 'distance_km', 'days']).reset_index(drop=True)
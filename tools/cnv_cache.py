@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+@brief: Persistent local manifest of the cruise shipboard CTD .cnv files that have already been processed. Each file is
+keyed by its path and fingerprinted by size and modification time (and optionally an md5 hash of its content), and the
+manifest records the header attributes parsed from the file and the location of the converted output. Re-runs of
+convert_cnv_files and update_cruise_CTD_attributes use it to skip files that haven't changed since they were last read.
+
+@usage:
+cache = CNVCache()  # or CNVCache(manifest, use_hash=True) to also compare file content when the mtime changed
+entry, fp = cache.lookup(f)  # entry is None if the file is new or has changed
+...process the file...
+cache.record(f, fp, attributes={'CTD_lat': 40.1}, output=(sDir, [outfile]))
+cache.save()
+"""
+
+import hashlib
+import json
+import os
+
+DEFAULT_MANIFEST = os.path.join(os.path.expanduser('~'), '.cruise_data', 'cnv_manifest.json')
+
+
+def file_md5(f, blocksize=1 << 20):
+    md5 = hashlib.md5()
+    with open(f, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class CNVCache(object):
+    def __init__(self, manifest=DEFAULT_MANIFEST, use_hash=False):
+        self.manifest = manifest
+        self.use_hash = use_hash
+        self.entries = {}
+        if os.path.isfile(manifest):
+            with open(manifest) as fh:
+                self.entries = json.load(fh)
+
+    def fingerprint(self, f):
+        # Returns None if the file can't be accessed
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def lookup(self, f):
+        # Returns the cached entry for the file (None if the file is new or has changed) and its current fingerprint.
+        # Pass the fingerprint back to record() so that a file modified while it was being processed is re-read on
+        # the next run.
+        fp = self.fingerprint(f)
+        if fp is None:
+            return None, fp
+
+        entry = self.entries.get(f)
+        if entry is not None and entry['size'] == fp['size'] and entry['mtime'] == fp['mtime']:
+            return entry, fp
+
+        if self.use_hash:
+            # hash the file before it is processed so the hash matches the content that was read
+            fp['md5'] = file_md5(f)
+            if entry is not None and entry.get('md5') == fp['md5']:
+                # the file was touched (e.g. copied to the server again) but the content is the same
+                entry['mtime'] = fp['mtime']
+                return entry, fp
+
+        return None, fp
+
+    def record(self, f, fp, attributes=None, output=None):
+        # Add or update the entry for a processed file. output is a tuple of (output directory, list of output files).
+        if fp is None:
+            return
+        entry = self.entries.get(f)
+        if entry is None or entry['size'] != fp['size'] or entry['mtime'] != fp['mtime']:
+            entry = dict(fp, attributes={}, outputs={})
+            self.entries[f] = entry
+
+        if attributes:
+            entry['attributes'].update(attributes)
+        if output:
+            entry['outputs'][output[0]] = output[1]
+
+    def output(self, entry, sDir):
+        # Returns the output files previously written to sDir for an unchanged entry, if they all still exist
+        if entry is None:
+            return None
+        outfiles = entry['outputs'].get(sDir)
+        if outfiles and all(os.path.isfile(o) for o in outfiles):
+            return outfiles
+
+    def save(self):
+        manifest_dir = os.path.dirname(self.manifest)
+        if manifest_dir and not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.entries, fh, indent=1, sort_keys=True)
+        os.rename(tmp, self.manifest)  # replace the manifest in one step so an interrupted run doesn't corrupt it
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+@brief: Streaming reader for OOI cruise shipboard CTD .cnv files. The header is scanned once up to the *END* marker and
+the data block is loaded straight into NumPy columns through a memory map, using the fixed-width layout that Seabird
+writes (11 characters per value). Files that don't follow the fixed-width layout fall back to a chunked
+whitespace-delimited parse.
+
+The cast time, lat and lon can be read from the header alone (a few KB) without loading the data block.
+
+@usage:
+from cnv_reader import read_cnv, read_cnv_attributes
+df = read_cnv(f)  # pandas DataFrame with a (name, unit) MultiIndex on the columns. Integer columns are int64.
+attributes = read_cnv_attributes(f)  # {'datetime': datetime, 'LATITUDE': float, 'LONGITUDE': float}
+"""
+
+import datetime
+import mmap
+import os
+import re
+import numpy as np
+import pandas as pd
+import instrumentation
+
+CHUNK_ROWS = 100000  # number of data rows converted at a time
+SIGMA_NAMES = [u'sigma-\ufffd00', u'sigma-\ufffd11']  # sigma-theta names garbled by the non-utf-8 header character
+
+# header patterns, following the parsing rules of seabird.cnv.fCNV
+LAT_RE = re.compile(r'(?:Latitude:?)?\ *(?P<degree>\d{1,2})\ +(?P<minute>\d{1,2}[\.|\,]\d{1,3})\ *'
+                    r'(?P<hemisphere>[N|n|S|s])')
+LON_RE = re.compile(r'(?:Latitude:?)?\ *(?P<degree>\d{1,3})\ +(?P<minute>\d{1,2}[\.|\,]\d{1,3})\ *'
+                    r'(?P<hemisphere>[W|w|E|e])')
+
+
+def read_cnv_header(f):
+    # Scan the header of a .cnv file up to the *END* marker. Returns the header lines, the variable names and units
+    # from the '# name' lines and the byte offset where the data block starts.
+    header = {'lines': [], 'names': [], 'units': [], 'data_offset': None}
+    offset = 0
+    with open(f, 'rb') as ctdfile:
+        for line in ctdfile:
+            offset += len(line)
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            header['lines'].append(line)
+            if line.startswith('# name '):
+                name, desc = line.split('=', 1)[1].split(':', 1)
+                name = name.strip()
+                if name in SIGMA_NAMES:
+                    name = 'sigma'
+                header['names'].append(name)
+                header['units'].append(desc.lstrip())
+
+            if line.startswith('*END*'):
+                header['data_offset'] = offset
+                break
+
+    if header['data_offset'] is None:
+        raise ValueError('No *END* marker found in {}'.format(f))
+
+    return header
+
+
+def header_value(lines, prefix):
+    for line in lines:
+        if line.startswith(prefix):
+            return line[len(prefix):].strip()
+
+
+def header_position(lines, prefix, pattern, negative):
+    # Position in decimal degrees from an NMEA header line, or from the '**' notes if the NMEA line is missing or
+    # doesn't match. Returns None if it can't be found.
+    value = header_value(lines, prefix)
+    match = pattern.search(value) if value else None
+    if not match:
+        match = pattern.search('\n'.join(l for l in lines if l.startswith('**')))
+    if not match:
+        return None
+    try:
+        position = int(match.group('degree')) + float(match.group('minute')) / 60.
+    except ValueError:
+        return None  # e.g. a comma as the decimal separator
+    if match.group('hemisphere') in negative:
+        position = -position
+    return position
+
+
+def header_attributes(header):
+    # The cast time, lat and lon from the header of a .cnv file. Attributes that can't be found or parsed are None.
+    lines = header['lines']
+    attributes = {'datetime': None,
+                  'LATITUDE': header_position(lines, '* NMEA Latitude =', LAT_RE, ['S', 's']),
+                  'LONGITUDE': header_position(lines, '* NMEA Longitude =', LON_RE, ['W', 'w'])}
+
+    start_time = header_value(lines, '# start_time =')
+    if start_time:
+        try:
+            attributes['datetime'] = datetime.datetime.strptime(start_time[:20], '%b %d %Y %H:%M:%S')
+        except ValueError:
+            pass
+    return attributes
+
+
+def read_cnv_attributes(f):
+    return header_attributes(read_cnv_header(f))
+
+
+def fixed_width_layout(mm, start, ncols):
+    # Determine the line length, field width and end-of-line characters from the first data line. Returns None if
+    # the data block doesn't follow a fixed-width layout.
+    first_eol = mm.find(b'\n', start)
+    if first_eol == -1 or ncols == 0:
+        return None
+    eol = 2 if mm[first_eol - 1:first_eol] == b'\r' else 1
+    line_len = first_eol + 1 - start
+    width = (line_len - eol) // ncols
+    if width == 0 or width * ncols + eol != line_len:
+        return None
+
+    nrows = (len(mm) - start) // line_len
+    if mm[start + nrows * line_len:].strip():  # anything besides whitespace after the last full line
+        return None
+    if mm[start + line_len - 1:start + nrows * line_len:line_len].count(b'\n') != nrows:  # rows of different length
+        return None
+
+    return width, eol, nrows
+
+
+def parse_fixed_width(mm, start, ncols, layout, chunk_rows):
+    width, eol, nrows = layout
+    dtype = np.dtype([('f{}'.format(i), 'S{}'.format(width)) for i in range(ncols)] + [('eol', 'S{}'.format(eol))])
+    rows = np.frombuffer(mm, dtype=dtype, count=nrows, offset=start)
+    data = np.empty((nrows, ncols), dtype=np.float64)
+    try:
+        for s in range(0, nrows, chunk_rows):
+            chunk = rows[s:s + chunk_rows]
+            for i in range(ncols):
+                data[s:s + chunk_rows, i] = chunk['f{}'.format(i)].astype(np.float64)
+    finally:
+        del rows
+    return data
+
+
+def parse_whitespace(mm, start, ncols, chunk_rows):
+    chunk_bytes = max(chunk_rows * ncols * 11, mmap.ALLOCATIONGRANULARITY)
+    values = []
+    pos = start
+    while pos < len(mm):
+        end = mm.find(b'\n', min(pos + chunk_bytes, len(mm) - 1))
+        end = len(mm) if end == -1 else end + 1
+        values.append(np.fromstring(mm[pos:end], dtype=np.float64, sep=' '))
+        pos = end
+
+    data = np.concatenate(values) if values else np.empty(0)
+    if ncols == 0 or data.size % ncols != 0:
+        raise ValueError('Number of values in the data block is not a multiple of the {} variables'.format(ncols))
+    return data.reshape(-1, ncols)
+
+
+def read_cnv_data(f, header, chunk_rows=CHUNK_ROWS):
+    # Load the data block of a .cnv file into a 2D float array (rows x variables)
+    ncols = len(header['names'])
+    start = header['data_offset']
+    with open(f, 'rb') as ctdfile:
+        ctdfile.seek(0, 2)
+        if ctdfile.tell() <= start:
+            return np.empty((0, ncols), dtype=np.float64)
+
+        mm = mmap.mmap(ctdfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            layout = fixed_width_layout(mm, start, ncols)
+            if layout:
+                try:
+                    return parse_fixed_width(mm, start, ncols, layout, chunk_rows)
+                except ValueError:
+                    pass  # a field that isn't a number, try splitting on whitespace instead
+            return parse_whitespace(mm, start, ncols, chunk_rows)
+        finally:
+            mm.close()
+
+
+def integer_columns(f, header, data):
+    # Columns that pandas would read as integers (e.g. scan or nbin): written without a decimal point or exponent in
+    # the first data line, and integral in every row
+    with open(f, 'rb') as ctdfile:
+        ctdfile.seek(header['data_offset'])
+        tokens = ctdfile.readline().split()
+    if len(tokens) != data.shape[1] or len(data) == 0:
+        return []
+    columns = []
+    for i, token in enumerate(tokens):
+        if token.lstrip(b'+-').isdigit():
+            values = data[:, i]
+            if np.isfinite(values).all() and (values == np.floor(values)).all():
+                columns.append(i)
+    return columns
+
+
+def read_cnv(f, chunk_rows=CHUNK_ROWS):
+    with instrumentation.span('read header'):
+        header = read_cnv_header(f)
+    with instrumentation.span('parse'):
+        data = read_cnv_data(f, header, chunk_rows)
+        ints = integer_columns(f, header, data)
+    instrumentation.count('bytes read', os.path.getsize(f))
+    instrumentation.count('rows parsed', len(data))
+    df = pd.DataFrame(data)
+    for i in ints:
+        df[i] = df[i].astype(np.int64)
+    df.columns = pd.MultiIndex.from_tuples(list(zip(header['names'], header['units'])))
+    return df
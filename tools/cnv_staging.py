@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+@brief: Local staging of the cruise shipboard CTD .cnv files on the alfresco WebDAV mount. The files a run needs (e.g.
+every file in cruise_CTDs.csv, or the casts of a comparison) are queued, and a bounded window of them (at most lookahead
+files and about max_mb) is prefetched concurrently into a local cache directory ahead of the reader. The tools read the
+local copies, so the transfer of the next files overlaps with the parsing of the current one and files that were
+already staged aren't transferred again. A staged copy is used as long as the size and modification time of the file on
+the mount haven't changed. The cache directory is capped at max_mb: the least recently used files are evicted (files
+that were prefetched but not read yet, or that are being read, are kept until they are released).
+
+mount_root, local_root: read the files under mount_root from local_root instead (e.g. a local copy of part of the
+WebDAV mount), to run the tools without a connection to the server.
+
+@usage:
+stage = CNVStage(max_mb=2048, workers=4)  # or CNVStage(mount_root='/Volumes/webdav/', local_root='/data/webdav/')
+stage.prefetch(files)
+for f in files:
+    df = read_cnv(stage.get(f))  # local path of the staged copy
+    stage.release(f)  # the staged copy can be evicted
+for f, local in stage.staged(files):  # same, prefetching and waiting for the released files to stay under the cap
+    ...
+stage.close()
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import instrumentation
+
+DEFAULT_STAGING_DIR = os.path.join(os.path.expanduser('~'), '.cruise_data', 'staging')
+
+
+class CNVStage(object):
+    def __init__(self, staging_dir=DEFAULT_STAGING_DIR, max_mb=2048, workers=4, mount_root=None, local_root=None,
+                 lookahead=None):
+        # lookahead: number of files prefetched ahead of the reader (default 2 * workers)
+        self.staging_dir = staging_dir
+        self.max_bytes = int(max_mb * 1048576)
+        self.workers = workers
+        self.lookahead = lookahead or 2 * workers
+        self.mount_root = mount_root
+        self.local_root = local_root
+        self.pool = None
+        self.queue = deque()  # files to prefetch, in order
+        self.queued = set()
+        self.pending = {}  # file: AsyncResult of the prefetches that haven't been read yet
+        self.in_use = {}  # file: number of get() that haven't been released
+        self.lock = threading.Condition()
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+
+        # size and last use of the staged copies, read once from the staging directory
+        self.index = {}  # local path: [atime, size]
+        self.total = 0
+        for root, dirs, fnames in os.walk(staging_dir):
+            for fname in fnames:
+                if fname.endswith('.tmp'):
+                    continue
+                st = os.stat(os.path.join(root, fname))
+                self.index[os.path.join(root, fname)] = [st.st_atime, st.st_size]
+                self.total += st.st_size
+
+    def source(self, f):
+        # path of the file on the mount, or in local_root if it stands in for the mount
+        if self.mount_root and self.local_root and f.startswith(self.mount_root):
+            return os.path.join(self.local_root, f[len(self.mount_root):].lstrip('/'))
+        return f
+
+    def path(self, f):
+        # path of the staged copy: one directory per source path, so files with the same name don't collide
+        key = hashlib.md5(f if isinstance(f, bytes) else f.encode('utf-8')).hexdigest()
+        return os.path.join(self.staging_dir, key, os.path.basename(f))
+
+    def size(self, f):
+        # size of the staged copy of f, or the average size of the staged files if it isn't staged yet
+        entry = self.index.get(self.path(f))
+        if entry:
+            return entry[1]
+        return self.total // len(self.index) if self.index else 0
+
+    def stage(self, f):
+        # Copy a file to the staging directory unless the staged copy is up to date. Returns the local path.
+        src = self.source(f)
+        local = self.path(f)
+        st = os.stat(src)
+        if os.path.isfile(local):
+            lst = os.stat(local)
+            if lst.st_size == st.st_size and int(lst.st_mtime) == int(st.st_mtime):
+                instrumentation.count('staged files reused')
+                with self.lock:
+                    if local not in self.index:
+                        self.index[local] = [lst.st_atime, lst.st_size]
+                        self.total += lst.st_size
+                return local
+
+        if not os.path.isdir(os.path.dirname(local)):
+            try:
+                os.makedirs(os.path.dirname(local))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(local)):
+                    raise
+        tmp = '{}.{}.{}.tmp'.format(local, os.getpid(), threading.current_thread().ident)
+        with instrumentation.span('stage file'):
+            shutil.copyfile(src, tmp)
+        os.rename(tmp, local)
+        # the staged copy keeps the mtime of the source, its atime records when it was last used (for eviction)
+        now = time.time()
+        os.utime(local, (now, st.st_mtime))
+        instrumentation.count('bytes staged', st.st_size)
+        with self.lock:
+            previous = self.index.get(local)
+            self.total += st.st_size - (previous[1] if previous else 0)
+            self.index[local] = [now, st.st_size]
+        self.evict()
+        return local
+
+    def fill(self):
+        # Start prefetching the next queued files, up to lookahead files and, with the files being read, about
+        # max_bytes ahead of the reader
+        with self.lock:
+            while self.queue and len(self.pending) < self.lookahead:
+                ahead = sum(self.size(f) for f in list(self.pending) + list(self.in_use))
+                if self.pending and ahead + self.size(self.queue[0]) > self.max_bytes:
+                    break
+                if not self.index and len(self.pending) >= self.workers:
+                    break  # no size to go by until the first files are staged
+                f = self.queue.popleft()
+                if f not in self.queued:
+                    continue  # already read
+                self.queued.discard(f)
+                if f not in self.pending:
+                    if self.pool is None:
+                        self.pool = ThreadPool(self.workers)
+                    self.pending[f] = self.pool.apply_async(self.stage, (f,))
+
+    def prefetch(self, files):
+        # Queue the files to be staged in the background, in order
+        with self.lock:
+            for f in files:
+                if f not in self.queued and f not in self.pending:
+                    self.queue.append(f)
+                    self.queued.add(f)
+        self.fill()
+
+    def staged(self, files):
+        # Generator of (file, local path) in the order of files, prefetching ahead. Each file has to be released when
+        # it has been read; the next file is only handed out once the files being read are under lookahead and
+        # max_bytes. If a file can't be staged the local path is the file itself, so the error is raised where the
+        # file is read.
+        self.prefetch(files)
+        for f in files:
+            with self.lock:
+                while self.in_use and (len(self.in_use) >= self.lookahead or
+                                       sum(self.size(u) for u in self.in_use) >= self.max_bytes):
+                    self.lock.wait()
+            try:
+                yield f, self.get(f)
+            except (IOError, OSError) as e:
+                print 'Failed to stage {}: {}'.format(f, e)
+                yield f, self.source(f)
+
+    def get(self, f):
+        # Local path of the staged copy of f, waiting for the prefetch if there is one. The staged copy isn't evicted
+        # until release(f).
+        with self.lock:
+            self.queued.discard(f)
+            pending = self.pending.pop(f, None)
+            self.in_use[f] = self.in_use.get(f, 0) + 1
+        try:
+            if pending is not None:
+                with instrumentation.span('wait for stage'):
+                    local = pending.get()
+            else:
+                local = self.stage(f)
+        except Exception:
+            self.release(f)
+            raise
+        now = time.time()
+        os.utime(local, (now, os.stat(local).st_mtime))
+        with self.lock:
+            if local in self.index:
+                self.index[local][0] = now
+        self.fill()
+        return local
+
+    def release(self, f):
+        with self.lock:
+            n = self.in_use.pop(f, 0) - 1
+            if n > 0:
+                self.in_use[f] = n
+            self.lock.notify_all()
+        self.evict()
+        self.fill()
+
+    def evict(self):
+        # Remove the least recently used files until the staging directory is under max_bytes. The files that are
+        # being read and the prefetched files that haven't been read yet are never removed.
+        with self.lock:
+            if self.total <= self.max_bytes:
+                return self.total
+            keep = set(self.path(f) for f in list(self.pending) + list(self.in_use))
+            for local, (atime, size) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                if self.total <= self.max_bytes:
+                    break
+                if local in keep:
+                    continue
+                try:
+                    os.remove(local)
+                    os.rmdir(os.path.dirname(local))
+                except OSError:
+                    pass
+                del self.index[local]
+                self.total -= size
+                instrumentation.count('staged files evicted')
+            return self.total
+
+    def close(self):
+        # Stop the prefetches that are still running or waiting
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        with self.lock:
+            self.queue.clear()
+            self.queued.clear()
+            self.pending = {}
+            self.in_use = {}
+            self.lock.notify_all()
+        # partial copies of the prefetches that were stopped
+        for root, dirs, fnames in os.walk(self.staging_dir):
+            for fname in fnames:
+                if fname.endswith('.tmp') and '.{}.'.format(os.getpid()) in fname:
+                    os.remove(os.path.join(root, fname))
+        self.evict()
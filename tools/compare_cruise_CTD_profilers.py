@@ -14,40 +14,123 @@ api_token: OOI API password
 refdes: reference designator of interest
 deployment: deployment of interest (e.g. D00001 = compare data from the instrument to the CTD cast that  was done at
 deployment #1; R00001 = compare data from the instrument to the CTD cast that was done at recovery #1)
+rules: rules to choose the delivery method and stream without prompting (see SELECTION_RULES). If None, the delivery
+method and stream are chosen interactively for each CTD cast.
+window: time range of the uFrame data compared to the cast, in days relative to the date of the cast (default (0, 1) =
+the day of the cast, (1, 2) = the day after the cast, (-1, 2) = the day before to the day after the cast). Each range
+is requested whole, and ranges that reach the uFrame limit of 10000 data points are split in half until every request
+is under the limit. shard_hours: split the ranges into sub-windows of at most shard_hours up front (default None).
+plots: set to False to only calculate the comparison statistics. The plots are rendered by render_processes processes
+(see profile_plots.py).
+nprofiles: only plot the nprofiles up/down profiles of the profiler that are closest in time to the CTD cast (default
+None = all of the profiles in the window). The profiler data are decimated to about max_points points per plot (see
+profile_segments.py); the statistics use all of the data.
+base_url, cache_dir: M2M API url (e.g. a local stub server for testing) and directory of the cached responses (see
+m2m_client.py)
+stage: CNVStage the CTD cast files are read through (see cnv_staging.py). The casts of the run are prefetched into a
+local cache directory while the first casts are compared. Set to None (default) to read them directly from the mount.
+archive: CastArchive, or its directory, of the converted casts (see cast_archive.py). The casts in the archive are read
+from its memory-mapped arrays instead of parsing the .cnv files; only the .cnv header is read for the cast time and
+location. Casts that aren't in the archive, or changed since it was built, are parsed from the .cnv files.
+converted: output directory of convert_cnv_files.py. Casts converted to .npy or .npz there are loaded from those files
+the same way (see cast_formats.py).
+profile, trace_memory: profile the run with cProfile and/or trace the memory allocations (see instrumentation.py)
+
+platform_main compares every CTDPF and FLORT on a platform (or a list of reference designators) in one run. Each CTD
+cast is read once and shared by the instruments that are compared to it, through an in-memory cache of the decoded
+casts that holds at most cast_cache_mb (see cast_cache.py). batch_main runs one platform per process, with the same
+options. The delivery method and stream are chosen once per reference designator.
+
+The summary .csv includes the bias (uFrame - cruise CTD), RMSE and correlation of each variable after both profiles are
+averaged onto a common pressure grid (see profile_stats.py), so comparisons with large differences can be found without
+looking at every plot. The time spent in each stage of the run (metadata, read cast, HTTP requests, decode,
+statistics, plot, write) and the bytes and rows processed are saved to sDir (see instrumentation.py).
 """
 
 import pandas as pd
 from seabird.cnv import fCNV
-import requests
 import datetime
-import matplotlib.pyplot as plt
 import os
 from geopy.distance import geodesic
 from collections import OrderedDict
 import numpy as np
-
-
-def data_request_url(session, rd):
-    API_BASE_URL = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv/'
-    refdes_url = '{:s}{:s}/{:s}/{:s}-{:s}'.format(API_BASE_URL, rd[0], rd[1], rd[2], rd[3])
-
-    mlist = return_uframe_response(refdes_url, session, api_key, api_token)
+import traceback
+from multiprocessing import Pool
+from m2m_client import M2MClient, API_BASE_URL, DEFAULT_CACHE_DIR
+from cruise_catalog import CruiseCatalog, key_str
+from cast_cache import CastCache
+from cast_archive import CastArchive
+from cast_formats import load_cast
+from cnv_reader import read_cnv_attributes
+from convert_cnv_files import output_base
+from request_planner import fetch_ranges, iso_str
+from profile_stats import compare_profiles, DEFAULT_BIN_SIZE
+from profile_plots import RenderQueue
+from profile_segments import segment_profiles, closest_profiles, decimate, DEFAULT_MAX_POINTS
+import instrumentation
+
+# Rules for choosing the delivery method and stream in batch mode. Delivery methods are tried in order of preference.
+# Streams with any of the excluded words in the name are never chosen; of the rest, the first stream that contains one
+# of the preferred names for the instrument class is chosen, otherwise the first remaining stream.
+SELECTION_RULES = {
+    'methods': ['recovered_wfp', 'recovered_inst', 'recovered_cspp', 'recovered_host', 'telemetered', 'streamed'],
+    'stream_exclude': ['metadata', 'engineering', 'power', 'status', 'config', 'hardware'],
+    'streams': {'CTDPF': ['ctdpf_ckl_wfp_instrument', 'ctdpf_ckl_wfp', 'ctdpf'],
+                'FLORT': ['flort_sample', 'flort_kn', 'flort']}
+}
+INSTRUMENTS = ['CTDPF', 'FLORT']  # instrument classes compared in batch mode
+# .cnv variable names in converted casts -> names given by seabird.cnv.fCNV (from the seabird rules/refnames.json).
+# cnv_reader.py renames the sigma-theta columns to sigma.
+CNV_NAMES = {'prDM': 'PRES', 't090C': 'TEMP', 'T090C': 'TEMP', 'c0S/m': 'CNDC', 'sal00': 'PSAL',
+             'density00': 'density', 'density11': 'density', 'sigma': 'sigma-\xe900'}
+CONVERTED_FORMATS = ['.npy', '.npz']  # converted cast files read by read_cast, fastest to load first
+
+
+def choose_method_stream(client, rd, rules):
+    # Choose the delivery method and stream with the selection rules. Returns None, None if there isn't a match.
+    mlist = filter(lambda k: 'bad' not in k, client.inventory(rd) or [])
+    mlist = sorted(mlist, key=lambda m: rules['methods'].index(m) if m in rules['methods'] else len(rules['methods']))
+    preferred = []
+    for inst, streams in rules['streams'].items():
+        if inst in rd[3]:
+            preferred = streams
+    for method in mlist:
+        slist = [x for x in client.inventory(rd, method) or [] if not any(e in x for e in rules['stream_exclude'])]
+        for name in preferred:
+            match = [x for x in slist if name in x]
+            if match:
+                return method, match[0]
+        if slist:
+            return method, slist[0]
+    return None, None
+
+
+def data_request_url(client, rd, rules=None):
+    refdes = '-'.join(rd)
+    if rules:
+        method, stream = choose_method_stream(client, rd, rules)
+        if method is None:
+            return None, None, None
+        print 'Selected {} {} for {}'.format(method, stream, refdes)
+        return method, stream, client.data_url(rd, method, stream)
+
+    mlist = client.inventory(rd)
     mlist = filter(lambda k: 'bad' not in k, mlist)  # don't show 'bad' delivery methods
     print 'Delivery methods listed in uFrame for {}: '.format(refdes)
     print mlist
     method = raw_input('\nPlease choose one delivery method for your data request: ')
-    murl = '{:s}/{:s}'.format(refdes_url, method)
 
-    slist = return_uframe_response(murl, session, api_key, api_token)
+    slist = client.inventory(rd, method)
     print 'Streams listed in uFrame for {}-{}'.format(refdes, method)
     print slist
     stream = raw_input('\nPlease choose one stream for your data request: ')
-    request_url = '{:s}/{:s}'.format(murl, stream)
+    request_url = client.data_url(rd, method, stream)
 
     return method, stream, request_url
 
 
 def format_str(input):
+    input = key_str(input)  # cast numbers are read as floats when the column has blanks
     if input == '':
         output = [input]
         length = len(output)
@@ -62,63 +145,197 @@ def format_str(input):
     return output, length
 
 
-def ntp_seconds_to_datetime(ntp_seconds):
-    ntp_epoch = datetime.datetime(1900, 1, 1)
-    unix_epoch = datetime.datetime(1970, 1, 1)
-    ntp_delta = (unix_epoch - ntp_epoch).total_seconds()
-    return datetime.datetime.utcfromtimestamp(ntp_seconds - ntp_delta).replace(microsecond=0)
-
-
-def profile_plot_panel(cast_args, uF_args, units, labels, ptitle, sfile, uFdate):
-    fig, (ax1, ax2) = plt.subplots(1, 2, sharey=True)
-    ax1.plot(cast_args[1], cast_args[0], 'b')
-    ax1.plot(uF_args[1], uF_args[0], 'r.', markersize=.75)
-    ax1.set_ylabel('Pressure ({})'.format(units[0]))
-    ax1.set_xlabel(labels[0] + ' ({})'.format(units[1]))
-    ax1.invert_yaxis()
-    ax1.grid()
-
-    ax2.plot(cast_args[2], cast_args[0], 'b', label='Cruise CTD')
-    ax2.plot(uF_args[2], uF_args[0], 'r.', markersize=.75, label='Profiler')
-    ax2.set_xlabel(labels[1] + ' ({})'.format(units[2]))
-    ax2.legend()
-    ax2.grid()
-
-    fig.suptitle(('{} vs. Shipboard CTD'.format(refdes) + '\n' + ptitle + '\n' + 'uFrame Profiler data: {}'.format(uFdate)), fontsize=10)
-    fig.subplots_adjust(top=0.875)
-    plt.savefig(str(sfile))
-    plt.close()
-
-
-def profile_plot_single(cast_args, uF_args, units, label, ptitle, sfile, uFdate):
-    fix, ax = plt.subplots()
-    ax.plot(cast_args[1], cast_args[0], 'b', label='Cruise CTD')
-    ax.plot(uF_args[1], uF_args[0], 'r.', markersize=1.5, label='Profiler')
-    ax.set_ylabel('Pressure ({})'.format(units[0]))
-    ax.set_xlabel(label + ' ({})'.format(units[1]))
-    #plt.xlim(0, 1.5)
-    #plt.ylim(0, 150)
-    ax.invert_yaxis()
-    ax.legend()
-    ax.grid()
-
-    ax.set_title(('{} vs. Shipboard CTD'.format(refdes) + '\n' + ptitle + '\n' + 'uFrame Profiler data: {}'.format(uFdate)), fontsize=10)
-    plt.savefig(str(sfile))
-    plt.close()
-
-
-def return_uframe_response(url, session, username, token):
-    r = session.get(url, auth=(username, token))
-    if r.status_code == 200:
-        response = r.json()
-        return response
+def plot_points(uF, names, ind, max_points):
+    # Profiler pressure and variables to plot: the selected points, decimated to about max_points
+    with instrumentation.span('decimate'):
+        sel = decimate(uF['pres'], [uF[n] for n in names], max_points, ind)
+    return tuple(uF[n][sel] for n in ['pres'] + list(names))
+
+
+def cast_list(info):
+    # (cruise, leg, cast) of each CTD cast identified for a platform deployment in the mapping table. The second value
+    # is False if the lengths of the CTD_CruiseName, CTD_CruiseLeg and CTDcast lists don't match up.
+    cruise, cruise_len = format_str(info['CTD_CruiseName'])
+    cruiseleg, cruiseleg_len = format_str(info['CTD_CruiseLeg'])
+    cast, cast_len = format_str(info['CTDcast'])
+
+    cast_info_list = []
+    matched = True
+    if cruise_len == cruiseleg_len == cast_len:
+        cast_info_list = zip(cruise, cruiseleg, cast)
     else:
-        print 'Request failed'
+        if cruise_len != cruiseleg_len and cruiseleg_len == cast_len:
+            cast_info_list = zip(cruise * cruiseleg_len, cruiseleg, cast)
+        if cruise_len == cruiseleg_len and cruiseleg_len != cast_len:
+            cast_info_list = zip(cruise * cast_len, cruiseleg * cast_len, cast)
+        if cruiseleg == [''] and cruise_len == cast_len:
+            cast_info_list = zip(cruise, cruiseleg * cruise_len, cast)
+        else:
+            matched = False
+    return cast_info_list, matched
 
 
-def main(sDir, api_key, api_token, refdes, deployments):
+def cast_files(catalog, platform, deployments):
+    # .cnv files of the CTD casts identified for the platform deployments, e.g. to stage them ahead of the comparison
+    files = []
+    for deployment in deployments:
+        info = catalog.deployment(platform, deployment)
+        if info is None or info['CTDcast'] == '':
+            continue
+        for c in cast_list(info)[0]:
+            CTDcast_info = catalog.cast(c[0], c[1], c[2])
+            if CTDcast_info is not None:
+                f = ''.join([CTDcast_info['filepath_primary'], CTDcast_info['CTD_rawdata_filepath']])
+                if f not in files:
+                    files.append(f)
+    return files
+
+
+def cast_variables(profile):
+    # The attributes and the variables used in the comparison, from a parsed cruise CTD cast. profile: variable name
+    # -> values (raises KeyError for missing variables), with an attributes dict like seabird.cnv.fCNV
+
+    # Try variations in variable names
+    param_notes = []
+    try:
+        conductivity = profile['CNDC'].data
+    except KeyError:
+        try:
+            conductivity = profile['c1mS/cm'].data / 10
+        except KeyError:
+            print 'No conductivity variable found in the cruise CTD file'
+            param_notes.append('No conductivity variable found in the cruise CTD file')
+            conductivity = []
+
+    try:
+        density = profile['density'].data
+    except KeyError:
+        try:
+            density = profile['sigma-\xe900'].data + 1000
+        except KeyError:
+            print 'No density variable found in the cruise CTD file'
+            param_notes.append('No density variable found in the cruise CTD file')
+            density = []
+
+    CTDcast_data = {
+        'pres': {'values': profile['PRES'].data, 'units': 'db'},
+        'temp': {'values': profile['TEMP'].data, 'units': 'deg C'},
+        'cond': {'values': conductivity, 'units': 'S/m'},
+        'sal': {'values': profile['PSAL'].data, 'units': 'PSU'},
+        'den': {'values': density, 'units': 'kg/m^3'},
+        'chla': {'values': profile['flECO-AFL'].data, 'units': 'ug/L'}  # mg/m^3 is the same as ug/L
+    }
+    attributes = dict((k, profile.attributes[k]) for k in ['LATITUDE', 'LONGITUDE', 'datetime'])
+    return {'attributes': attributes, 'data': CTDcast_data, 'notes': param_notes}
+
+
+class ConvertedCast(object):
+    # A converted cast (see convert_cnv_files.py) with the variable names and attributes of seabird.cnv.fCNV, so it can
+    # be passed to cast_variables. columns: (name, values) of the converted variables. The attributes are read from the
+    # header of the .cnv file.
+    def __init__(self, columns, fCTD):
+        self.variables = OrderedDict()
+        for name, values in columns:
+            values = np.asarray(values, dtype=np.float64)
+            if not np.isnan(values).all():  # casts without the variable are filled with NaN in the archive
+                self.variables.setdefault(CNV_NAMES.get(name, name), values)
+        self.attributes = read_cnv_attributes(fCTD)
+
+    def __getitem__(self, name):
+        return np.ma.array(self.variables[name])
+
+
+def current(f, fCTD):
+    # True if f was written after the last change to the .cnv file fCTD
+    try:
+        return os.path.getmtime(f) >= os.path.getmtime(fCTD)
+    except OSError:
+        return False
+
+
+def archive_cast_id(archive, fCTD):
+    # cast_id of fCTD in the CastArchive, if it is there and up to date
+    cast_id = archive.find(fCTD) if archive is not None else None
+    if cast_id is not None and current(os.path.join(archive.archive_dir, 'casts.csv'), fCTD):
+        return cast_id
+
+
+def converted_file(converted, fCTD):
+    # Up to date .npy or .npz file of fCTD in the output directory of convert_cnv_files.py
+    if converted is not None:
+        outbase = output_base(converted, fCTD)
+        for ext in CONVERTED_FORMATS:
+            if current(outbase + ext, fCTD):
+                return outbase + ext
+
+
+def converted_cast(fCTD, archive=None, converted=None):
+    # The cast from the CastArchive, or else from a converted file, without parsing the .cnv data. Returns None if the
+    # cast hasn't been converted or its header attributes can't be read.
+    with instrumentation.span('read cast'):
+        cast_id = archive_cast_id(archive, fCTD)
+        if cast_id is not None:
+            columns = archive.data(cast_id).items()
+        else:
+            f = converted_file(converted, fCTD)
+            if f is None:
+                return None
+            df = load_cast(f)[0]
+            columns = [(name, df.iloc[:, i].values) for i, name in enumerate(df.columns.get_level_values(0))]
+        profile = ConvertedCast(columns, fCTD)
+    if any(v is None for v in profile.attributes.values()):
+        return None
+    instrumentation.count('converted casts read')
+    return cast_variables(profile)
+
+
+def read_cast(fCTD, archive=None, converted=None, stage=None):
+    # Read a cruise CTD cast: from the CastArchive (see cast_archive.py) or the directory of the converted .npy/.npz
+    # files (see convert_cnv_files.py) when the cast is there, otherwise by parsing the .cnv file (through the
+    # CNVStage if there is one, see cnv_staging.py)
+    cast = converted_cast(fCTD, archive, converted)
+    if cast is not None:
+        return cast
+    if stage is None:
+        return parse_cast(fCTD)
+    try:
+        return parse_cast(stage.get(fCTD))
+    finally:
+        stage.release(fCTD)
+
+
+def parse_cast(fCTD):
+    # Parse a cruise CTD file into the attributes and the variables used in the comparison
+    with instrumentation.span('read cast'):
+        profile = fCNV(fCTD)
+    instrumentation.count('bytes read', os.path.getsize(fCTD))
+    return cast_variables(profile)
+
+
+def compare_refdes(client, sDir, refdes, deployments, rules=None, catalog=None, bin_size=DEFAULT_BIN_SIZE,
+                   window=(0, 1), shard_hours=None, renderer=None, nprofiles=None, max_points=DEFAULT_MAX_POINTS,
+                   casts=None, stage=None, request=None, archive=None, converted=None):
+    # renderer: RenderQueue the plots are submitted to. If None, the plots are rendered here before returning.
+    # request: (method, stream, request_url) of refdes. If None, they are chosen (with the rules, or interactively)
+    # when the first cast is found, once for all of the casts.
+    # casts: CastCache of the casts already read in this run (e.g. shared by the instruments on a platform)
+    # stage: CNVStage the cast files are read through (see cnv_staging.py). If None, they are read from the mount.
+    # archive, converted: CastArchive (or its directory) and output directory of convert_cnv_files.py the casts are
+    # read from when they have been converted. The other casts are parsed from the .cnv files.
+    catalog = catalog or CruiseCatalog()
+    casts = casts if casts is not None else CastCache()
+    if isinstance(archive, basestring):
+        archive = CastArchive(archive)
+    loader = lambda f: read_cast(f, archive, converted, stage)
+    if stage:
+        stage.prefetch([f for f in cast_files(catalog, refdes.split('-')[0], deployments) if f not in casts and
+                        archive_cast_id(archive, f) is None and converted_file(converted, f) is None])
+    own_renderer = renderer is None
+    if own_renderer:
+        renderer = RenderQueue(processes=0)
     rd = refdes.split('-')
     summary = OrderedDict()
+    jobs = []
 
     count = 0
     for deployment in deployments:
@@ -126,14 +343,17 @@ def main(sDir, api_key, api_token, refdes, deployments):
         count += 1
         # Get information from the cruise CTD-to-platform mapping files to grab the cruise CTD data that would overlap
         # with some data from the selected platform
-        cruisedata_repo = 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/cruise_data'
-        p_CTD_map = pd.read_csv('/'.join((cruisedata_repo, 'platform_CTDcast_mapping.csv'))).fillna('')
-        CTDcasts = pd.read_csv('/'.join((cruisedata_repo, 'cruise_CTDs.csv'))).fillna('')
-
-        info = p_CTD_map.loc[(p_CTD_map.platform == rd[0]) & (p_CTD_map.Deployment == deployment)]
-        ploc = [info.iloc[0]['lat'], info.iloc[0]['lon']]  # platform deployment location from asset management
+        info = catalog.deployment(rd[0], deployment)
+        if info is None:
+            print '{} {} not found in platform_CTDcast_mapping.csv'.format(rd[0], deployment)
+            summary[count] = OrderedDict()
+            summary[count]['refdes'] = refdes
+            summary[count]['deployment'] = deployment
+            summary[count]['notes'] = '{} {} not found in platform_CTDcast_mapping.csv'.format(rd[0], deployment)
+            continue
+        ploc = [info['lat'], info['lon']]  # platform deployment location from asset management
 
-        if info.iloc[0]['CTDcast'] == '':
+        if info['CTDcast'] == '':
             print 'No CTD cast identified for {} {}'.format(rd[0], deployment)
             summary[count] = OrderedDict()
             summary[count]['refdes'] = refdes
@@ -141,89 +361,47 @@ def main(sDir, api_key, api_token, refdes, deployments):
             summary[count]['notes'] = 'No CTD cast identified for {} {}'.format(rd[0], deployment)
             continue
 
-        cruise, cruise_len = format_str(info.iloc[0]['CTD_CruiseName'])
-        cruiseleg, cruiseleg_len = format_str(info.iloc[0]['CTD_CruiseLeg'])
-        cast, cast_len = format_str(info.iloc[0]['CTDcast'])
-
-        if cruise_len == cruiseleg_len == cast_len:
-            cast_info_list = zip(cruise, cruiseleg, cast)
-        else:
-            if cruise_len != cruiseleg_len and cruiseleg_len == cast_len:
-                cast_info_list = zip(cruise * cruiseleg_len, cruiseleg, cast)
-            if cruise_len == cruiseleg_len and cruiseleg_len != cast_len:
-                cast_info_list = zip(cruise * cast_len, cruiseleg * cast_len, cast)
-            if cruiseleg == [''] and cruise_len == cast_len:
-                cast_info_list = zip(cruise, cruiseleg * cruise_len, cast)
-            else:
-                print "!! Check CTD_CruiseName, CTD_CruiseLeg, CTDcast info. Lengths of lists don't match up !!"
+        cast_info_list, matched = cast_list(info)
+        if not matched:
+            print "!! Check CTD_CruiseName, CTD_CruiseLeg, CTDcast info. Lengths of lists don't match up !!"
 
         for i, c in enumerate(cast_info_list):
             # select the information from the CTD cast identified in the mapping table
-            CTDcast_info = CTDcasts.loc[(CTDcasts.CTD_CruiseName == c[0]) & (CTDcasts.CTD_CruiseLeg == c[1]) & (CTDcasts.CTDcast == str(c[2]))]
+            CTDcast_info = catalog.cast(c[0], c[1], c[2])
+            if CTDcast_info is None:
+                print 'Cruise {} leg {} cast {} not found in cruise_CTDs.csv'.format(c[0], c[1], c[2])
+                continue
 
-            fCTD = ''.join([CTDcast_info.iloc[0]['filepath_primary'], CTDcast_info.iloc[0]['CTD_rawdata_filepath']])
+            fCTD = ''.join([CTDcast_info['filepath_primary'], CTDcast_info['CTD_rawdata_filepath']])
             print 'CTD filename: {}'.format(fCTD)
 
-            # Open the raw CTD file
-            profile = fCNV(fCTD)
+            # Open the raw CTD file (once per run, see cast_cache.py)
+            profile = casts.get(fCTD, loader)
+            param_notes = list(profile['notes'])
+            CTDcast_data = profile['data']
 
             # CTD cast information
-            CTDloc = [profile.attributes['LATITUDE'], profile.attributes['LONGITUDE']]  # CTD cast location
+            CTDloc = [profile['attributes']['LATITUDE'], profile['attributes']['LONGITUDE']]  # CTD cast location
             diff_loc = round(geodesic(ploc, CTDloc).kilometers,4)
             print 'The CTD cast was done {} km from the mooring location'.format(diff_loc)
-            CTDdate = profile.attributes['datetime'].strftime('%Y-%m-%dT%H:%M:%S')
+            CTDdate = profile['attributes']['datetime'].strftime('%Y-%m-%dT%H:%M:%S')
 
             if c[1] == '':
-                ptitle = 'Cruise ' + CTDcast_info.iloc[0]['CUID'] + ' Cast ' + str(c[2]) + ': ' + CTDdate + \
+                ptitle = 'Cruise ' + CTDcast_info['CUID'] + ' Cast ' + str(c[2]) + ': ' + CTDdate + \
                          ' (distance {} km)'.format(diff_loc)
             else:
-                ptitle = 'Cruise ' + CTDcast_info.iloc[0]['CUID'] + ' Leg ' + c[1] + ' Cast ' + str(c[2]) + ': ' + CTDdate + \
+                ptitle = 'Cruise ' + CTDcast_info['CUID'] + ' Leg ' + c[1] + ' Cast ' + str(c[2]) + ': ' + CTDdate + \
                          ' (distance {} km)'.format(diff_loc)
 
-            # Try variations in variable names
-            param_notes = []
-            try:
-                conductivity = profile['CNDC'].data
-            except KeyError:
-                try:
-                    conductivity = profile['c1mS/cm'].data / 10
-                except KeyError:
-                    print 'No conductivity variable found in the cruise CTD file'
-                    param_notes.append('No conductivity variable found in the cruise CTD file')
-                    conductivity = []
-
-            try:
-                density = profile['density'].data
-            except KeyError:
-                try:
-                    density = profile['sigma-\xe900'].data + 1000
-                except KeyError:
-                    print 'No density variable found in the cruise CTD file'
-                    param_notes.append('No density variable found in the cruise CTD file')
-                    density = []
-
-
-            CTDcast_data = {
-                'pres': {'values': profile['PRES'].data, 'units': 'db'},
-                'temp': {'values': profile['TEMP'].data, 'units': 'deg C'},
-                'cond': {'values': conductivity, 'units': 'S/m'},
-                'sal': {'values': profile['PSAL'].data, 'units': 'PSU'},
-                'den': {'values': density, 'units': 'kg/m^3'},
-                'chla': {'values': profile['flECO-AFL'].data, 'units': 'ug/L'}  # mg/m^3 is the same as ug/L
-            }
-
-            # specify the date of the cruise CTD cast for the uFrame API request
-            params = {
-                'beginDT': profile.attributes['datetime'].strftime('%Y-%m-%dT00:00:00.000Z'),
-                'endDT': (profile.attributes['datetime'] + datetime.timedelta(days=1)).strftime('%Y-%m-%dT00:00:00.000Z'),
-                #'beginDT': (profile.attributes['datetime'] + datetime.timedelta(days=1)).strftime('%Y-%m-%dT00:00:00.000Z'), # take the day after the cruise CTD
-                #'endDT': (profile.attributes['datetime'] + datetime.timedelta(days=2)).strftime('%Y-%m-%dT00:00:00.000Z'),
-                'limit': 10000
-            }
+            # specify the time range of the uFrame API request, relative to the date of the cruise CTD cast
+            cast_day = profile['attributes']['datetime'].replace(hour=0, minute=0, second=0, microsecond=0)
+            begin = cast_day + datetime.timedelta(days=window[0])
+            end = cast_day + datetime.timedelta(days=window[1])
 
             # Build the url for the data request from uFrame
-            session = requests.session()
-            method, stream, request_url = data_request_url(session, rd)
+            if request is None:
+                request = data_request_url(client, rd, rules)
+            method, stream, request_url = request
 
             id = str(count) + str(i)
             summary[id] = OrderedDict()
@@ -233,84 +411,243 @@ def main(sDir, api_key, api_token, refdes, deployments):
             summary[id]['deployment'] = deployment
             summary[id]['platform_lat_lon'] = ploc
             summary[id]['cruise'] = c[0]
-            summary[id]['CUID'] = CTDcast_info.iloc[0]['CUID']
+            summary[id]['CUID'] = CTDcast_info['CUID']
             summary[id]['cruiseleg'] = c[1]
             summary[id]['cast'] = str(c[2])
-            summary[id]['cruiseCTDcast_date'] = profile.attributes['datetime'].strftime('%Y-%m-%dT%H:%M:%SZ')
+            summary[id]['cruiseCTDcast_date'] = profile['attributes']['datetime'].strftime('%Y-%m-%dT%H:%M:%SZ')
             summary[id]['cruiseCTDcast_lat_lon'] = CTDloc
             summary[id]['cruiseCTDcast_platform_loc_diff_km'] = diff_loc
             summary[id]['cruiseCTDcast_filename'] = fCTD
             summary[id]['notes'] = param_notes
-            summary[id]['uframe_data_date'] = params['beginDT']
-
-            # Request data from uFrame
-            print 'Requesting data from uFrame'
-            r = session.get(request_url, params=params, auth=(api_key, api_token))
-
-            if r.status_code != 200:
-                print r.json()['message']
-                summary[id]['uframe_message'] = r.json()['message']
-            elif r.status_code == 200:
-                summary[id]['uframe_message'] = 'Data request successful'
-                data = r.json()
-
-                uF = {}
-
-                if 'CTD' in refdes:
-                    keys = ['time', 'pres', 'temp', 'cond', 'sal', 'den']
-                    for k in keys:
-                        uF.setdefault(k, [])
-
-                    for i in range(len(data)):
-                        uF['time'].append(ntp_seconds_to_datetime(data[i]['time']))
-                        uF['pres'].append(data[i]['ctdpf_ckl_seawater_pressure'])
-                        uF['temp'].append(data[i]['ctdpf_ckl_seawater_temperature'])
-                        uF['cond'].append(data[i]['ctdpf_ckl_seawater_conductivity'])
-                        uF['sal'].append(data[i]['practical_salinity'])
-                        uF['den'].append(data[i]['density'])
-
-                    print 'Plotting CTD data'
-                    cast_args = (CTDcast_data['pres']['values'], CTDcast_data['cond']['values'], CTDcast_data['temp']['values'])
-                    uF_args = (uF['pres'], uF['cond'], uF['temp'])
-                    units = (CTDcast_data['pres']['units'], CTDcast_data['cond']['units'], CTDcast_data['temp']['units'])
-                    labels = ('Conductivity', 'Temperature')
-                    fname = '_'.join((refdes, deployment, method, c[0], c[1], c[2], 'cond_temp'))
-                    sfile = os.path.join(sDir,fname)
-                    profile_plot_panel(cast_args, uF_args, units, labels, ptitle, sfile, params['beginDT'][0:10])
-
-                    if len(CTDcast_data['den']['values']) == 0:
-                        den_values = np.asarray([None] * len(CTDcast_data['pres']['values']))
-                    else:
-                        den_values = CTDcast_data['den']['values']
-                    cast_args = (CTDcast_data['pres']['values'], CTDcast_data['sal']['values'], den_values)
-                    uF_args = (uF['pres'], uF['sal'], uF['den'])
-                    units = (CTDcast_data['pres']['units'], CTDcast_data['sal']['units'], CTDcast_data['den']['units'])
-                    labels = ('Salinity', 'Density')
-                    fname = '_'.join((refdes, deployment, method, c[0], c[1], c[2], 'sal_den'))
-                    sfile = os.path.join(sDir,fname)
-                    profile_plot_panel(cast_args, uF_args, units, labels, ptitle, sfile, params['beginDT'][0:10])
-
-                if 'FLOR' in refdes:
-                    keys = ['time', 'pres', 'chla']
-                    for k in keys:
-                        uF.setdefault(k, [])
-
-                    for i in range(len(data)):
-                        uF['time'].append(ntp_seconds_to_datetime(data[i]['time']))
-                        uF['pres'].append(data[i]['int_ctd_pressure'])
-                        uF['chla'].append(data[i]['fluorometric_chlorophyll_a'])
-
-                    print 'Plotting FLOR data'
-                    cast_args = (CTDcast_data['pres']['values'], CTDcast_data['chla']['values'])
-                    uF_args = (uF['pres'], uF['chla'])
-                    units = (CTDcast_data['pres']['units'], CTDcast_data['chla']['units'])
-                    label = 'Fluorometric Chlorophyll-a'
-                    fname = '_'.join((refdes, deployment, method, c[0], c[1], c[2], 'chla'))
-                    sfile = os.path.join(sDir, fname)
-                    profile_plot_single(cast_args, uF_args, units, label, ptitle, sfile, params['beginDT'][0:10])
-
-    sname = refdes + '_cruise_CTD_summary_{}.csv'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
-    pd.DataFrame.from_dict(summary, orient='index').to_csv(os.path.join(sDir, sname), index=False)
+            summary[id]['uframe_data_date'] = iso_str(begin)
+            summary[id]['uframe_data_end'] = iso_str(end)
+
+            if request_url is None:
+                summary[id]['uframe_message'] = 'No delivery method and stream matching the selection rules'
+                continue
+
+            jobs.append({'id': id, 'deployment': deployment, 'method': method, 'cast': c, 'ptitle': ptitle,
+                         'CTDcast_data': CTDcast_data, 'begin': begin, 'end': end, 'request_url': request_url,
+                         'cast_time': profile['attributes']['datetime']})
+
+    # Request data from uFrame for all of the casts at once. Time ranges with more data points than the uFrame limit
+    # are split into several requests (see request_planner.py).
+    print 'Requesting data from uFrame for {} CTD casts'.format(len(jobs))
+    responses = fetch_ranges(client, [(job['request_url'], refdes, job['begin'], job['end']) for job in jobs],
+                             shard_hours=shard_hours)
+
+    for job, (status, message, uF) in zip(jobs, responses):
+        id, deployment, method, c, ptitle = job['id'], job['deployment'], job['method'], job['cast'], job['ptitle']
+        CTDcast_data, data_date = job['CTDcast_data'], iso_str(job['begin'])[0:10]
+        summary[id]['uframe_message'] = message
+        if status != 200:
+            print message
+        else:
+            cast_vars = dict((k, v['values']) for k, v in CTDcast_data.items())
+            with instrumentation.span('statistics'):
+                summary[id].update(compare_profiles(CTDcast_data['pres']['values'], cast_vars, uF['pres'], uF,
+                                                    bin_size))
+            instrumentation.count('rows compared', len(uF['pres']))
+
+            # profiler data points to plot
+            ind = None
+            if nprofiles and renderer.enabled:
+                segments = segment_profiles(uF['time'], uF['pres'])
+                ind = closest_profiles(uF['time'], segments, job['cast_time'], nprofiles)
+
+            if 'CTD' in refdes:
+                print 'Plotting CTD data' if renderer.enabled else 'Skipping CTD plots'
+                cast_args = (CTDcast_data['pres']['values'], CTDcast_data['cond']['values'], CTDcast_data['temp']['values'])
+                uF_args = plot_points(uF, ('cond', 'temp'), ind, max_points)
+                units = (CTDcast_data['pres']['units'], CTDcast_data['cond']['units'], CTDcast_data['temp']['units'])
+                labels = ('Conductivity', 'Temperature')
+                fname = '_'.join((refdes, deployment, method, c[0], c[1], c[2], 'cond_temp'))
+                sfile = os.path.join(sDir,fname)
+                renderer.submit('panel', refdes, cast_args, uF_args, units, labels, ptitle, sfile, data_date)
+
+                if len(CTDcast_data['den']['values']) == 0:
+                    den_values = np.asarray([None] * len(CTDcast_data['pres']['values']))
+                else:
+                    den_values = CTDcast_data['den']['values']
+                cast_args = (CTDcast_data['pres']['values'], CTDcast_data['sal']['values'], den_values)
+                uF_args = plot_points(uF, ('sal', 'den'), ind, max_points)
+                units = (CTDcast_data['pres']['units'], CTDcast_data['sal']['units'], CTDcast_data['den']['units'])
+                labels = ('Salinity', 'Density')
+                fname = '_'.join((refdes, deployment, method, c[0], c[1], c[2], 'sal_den'))
+                sfile = os.path.join(sDir,fname)
+                renderer.submit('panel', refdes, cast_args, uF_args, units, labels, ptitle, sfile, data_date)
+
+            if 'FLOR' in refdes:
+                print 'Plotting FLOR data' if renderer.enabled else 'Skipping FLOR plots'
+                cast_args = (CTDcast_data['pres']['values'], CTDcast_data['chla']['values'])
+                uF_args = plot_points(uF, ('chla',), ind, max_points)
+                units = (CTDcast_data['pres']['units'], CTDcast_data['chla']['units'])
+                label = 'Fluorometric Chlorophyll-a'
+                fname = '_'.join((refdes, deployment, method, c[0], c[1], c[2], 'chla'))
+                sfile = os.path.join(sDir, fname)
+                renderer.submit('single', refdes, cast_args, uF_args, units, label, ptitle, sfile, data_date)
+
+    if own_renderer:
+        renderer.close()
+    return summary
+
+
+def main(sDir, api_key, api_token, refdes, deployments, workers=8, refresh=False, rules=None, catalog=None,
+         window=(0, 1), shard_hours=None, plots=True, render_processes=4, nprofiles=None, max_points=DEFAULT_MAX_POINTS,
+         base_url=API_BASE_URL, cache_dir=DEFAULT_CACHE_DIR, stage=None, archive=None, converted=None, profile=False,
+         trace_memory=False):
+    run = instrumentation.start_run(refdes + '_cruise_CTD_comparison', profile, trace_memory)
+    renderer = RenderQueue(render_processes, enabled=plots)
+    client = M2MClient(api_key, api_token, base_url=base_url, workers=workers, refresh=refresh, cache_dir=cache_dir)
+    try:
+        summary = compare_refdes(client, sDir, refdes, deployments, rules, catalog, window=window,
+                                 shard_hours=shard_hours, renderer=renderer, nprofiles=nprofiles, max_points=max_points,
+                                 stage=stage, archive=archive, converted=converted)
+    finally:
+        renderer.close()
+
+    now = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    sname = refdes + '_cruise_CTD_summary_{}.csv'.format(now)
+    with instrumentation.span('write'):
+        pd.DataFrame.from_dict(summary, orient='index').to_csv(os.path.join(sDir, sname), index=False)
+    tname = refdes + '_uframe_request_timings_{}.csv'.format(now)
+    with instrumentation.span('write'):
+        pd.DataFrame(client.timings).to_csv(os.path.join(sDir, tname), index=False)
+    run.finish(sDir)
+
+
+def platform_instruments(client, platform):
+    # reference designators of the CTDPF and FLORT on a platform
+    return [r for r in client.instruments(platform) if any(i in r for i in INSTRUMENTS)]
+
+
+def compare_platform(client, sDir, refdes_list, deployments, rules=SELECTION_RULES, catalog=None, casts=None,
+                     **kwargs):
+    # Compare several reference designators (e.g. every instrument on a platform) in one pass, sharing the casts that
+    # were already read (see cast_cache.py). Returns the summary rows. Errors are caught so one instrument doesn't stop
+    # the others. kwargs are passed to compare_refdes.
+    catalog = catalog or CruiseCatalog()
+    casts = casts if casts is not None else CastCache()
+    if isinstance(kwargs.get('archive'), basestring):
+        kwargs['archive'] = CastArchive(kwargs['archive'])
+    rows = []
+    for refdes in refdes_list:
+        try:
+            summary = compare_refdes(client, sDir, refdes, deployments, rules, catalog, casts=casts, **kwargs)
+            rows.extend(summary.values())
+        except Exception as e:
+            traceback.print_exc()
+            rows.append(OrderedDict([('refdes', refdes),
+                                     ('notes', 'Comparison failed: {}: {}'.format(type(e).__name__, e))]))
+    print 'Read {} CTD casts for {} reference designators ({} cached reads)'.format(casts.misses, len(refdes_list),
+                                                                                   casts.hits)
+    return rows
+
+
+def refdes_list_name(refdes_list):
+    # name of the output files of a list of reference designators: the platform if they are all on the same one
+    platforms = sorted(set(r.split('-')[0] for r in refdes_list))
+    return platforms[0] if len(platforms) == 1 else 'multiplatform'
+
+
+def platform_main(sDir, api_key, api_token, platform, deployments=None, workers=8, refresh=False,
+                  rules=SELECTION_RULES, catalog=None, window=(0, 1), shard_hours=None, plots=True, render_processes=4,
+                  nprofiles=None, max_points=DEFAULT_MAX_POINTS, base_url=API_BASE_URL, cache_dir=DEFAULT_CACHE_DIR,
+                  cast_cache_mb=256, stage=None, archive=None, converted=None, profile=False, trace_memory=False):
+    # platform: platform code (every CTDPF and FLORT on the platform is compared) or a list of reference designators
+    # deployments: None = every deployment/recovery of the platform in platform_CTDcast_mapping.csv
+    name = platform if isinstance(platform, basestring) else refdes_list_name(platform)
+    run = instrumentation.start_run(name + '_cruise_CTD_comparison', profile, trace_memory)
+    catalog = catalog or CruiseCatalog()
+    client = M2MClient(api_key, api_token, base_url=base_url, workers=workers, refresh=refresh, cache_dir=cache_dir)
+    if isinstance(platform, basestring):
+        refdes_list = platform_instruments(client, platform)
+    else:
+        refdes_list = list(platform)
+    if deployments is None:
+        p_CTD_map = catalog.mapping
+        platforms = set(r.split('-')[0] for r in refdes_list)
+        deployments = p_CTD_map.loc[p_CTD_map['platform'].isin(platforms), 'Deployment'].unique().tolist()
+    print 'Comparing {} reference designators to the cruise CTD casts'.format(len(refdes_list))
+
+    renderer = RenderQueue(render_processes, enabled=plots)
+    try:
+        rows = compare_platform(client, sDir, refdes_list, deployments, rules, catalog, CastCache(cast_cache_mb),
+                                window=window, shard_hours=shard_hours, renderer=renderer, nprofiles=nprofiles,
+                                max_points=max_points, stage=stage, archive=archive, converted=converted)
+    finally:
+        renderer.close()
+
+    now = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    sname = name + '_cruise_CTD_summary_{}.csv'.format(now)
+    with instrumentation.span('write'):
+        pd.DataFrame(rows).to_csv(os.path.join(sDir, sname), index=False)
+    tname = name + '_uframe_request_timings_{}.csv'.format(now)
+    with instrumentation.span('write'):
+        pd.DataFrame(client.timings).to_csv(os.path.join(sDir, tname), index=False)
+    run.finish(sDir)
+
+
+def batch_compare(args):
+    # Compare the instruments on one platform in a worker process, reading each cast once
+    sDir, api_key, api_token, refdes_list, deployments, rules, catalog, client_kwargs, compare_kwargs = args
+    client = M2MClient(api_key, api_token, **client_kwargs)
+    # the batch already runs one process per platform, render the plots in this process
+    rows = compare_platform(client, sDir, refdes_list, deployments, rules, catalog,
+                            CastCache(compare_kwargs.pop('cast_cache_mb')),
+                            renderer=RenderQueue(0, enabled=compare_kwargs.pop('plots')), **compare_kwargs)
+    return rows, client.timings, instrumentation.drain()
+
+
+def batch_main(sDir, api_key, api_token, refdes_list=None, deployments=None, rules=SELECTION_RULES, processes=4,
+               workers=8, refresh=False, catalog=None, window=(0, 1), shard_hours=None, plots=True, nprofiles=None,
+               max_points=DEFAULT_MAX_POINTS, base_url=API_BASE_URL, cache_dir=DEFAULT_CACHE_DIR, cast_cache_mb=256,
+               archive=None, converted=None, profile=False, trace_memory=False):
+    # archive: directory of the CastArchive, opened in each worker process
+    run = instrumentation.start_run('batch_cruise_CTD_comparison', profile, trace_memory)
+    catalog = catalog or CruiseCatalog()
+    p_CTD_map = catalog.mapping
+    catalog.casts  # load the tables once, before the catalog is sent to the worker processes
+    client_kwargs = dict(base_url=base_url, workers=workers, refresh=refresh, cache_dir=cache_dir)
+    compare_kwargs = dict(window=window, shard_hours=shard_hours, plots=plots, nprofiles=nprofiles,
+                          max_points=max_points, cast_cache_mb=cast_cache_mb, archive=archive, converted=converted)
+
+    if refdes_list is None:
+        # every CTDPF and FLORT on the platforms that have at least one CTD cast identified
+        client = M2MClient(api_key, api_token, **client_kwargs)
+        platforms = p_CTD_map.loc[p_CTD_map['CTDcast'].map(key_str) != '', 'platform'].unique().tolist()
+        refdes_list = [r for p in platforms for r in platform_instruments(client, p)]
+    print 'Comparing {} reference designators to the cruise CTD casts'.format(len(refdes_list))
+
+    # one task per platform, so the instruments on a platform share the casts that were read
+    by_platform = OrderedDict()
+    for refdes in refdes_list:
+        by_platform.setdefault(refdes.split('-')[0], []).append(refdes)
+    tasks = []
+    for platform, platform_refdes in by_platform.items():
+        platform_deployments = p_CTD_map.loc[p_CTD_map['platform'] == platform, 'Deployment'].tolist()
+        if deployments is not None:
+            platform_deployments = [d for d in platform_deployments if d in deployments]
+        tasks.append((sDir, api_key, api_token, platform_refdes, platform_deployments, rules, catalog, client_kwargs,
+                      dict(compare_kwargs)))
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(batch_compare, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    for r in results:
+        run.merge(r[2])
+    rows = [row for r in results for row in r[0]]
+    timings = [t for r in results for t in r[1]]
+    now = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    sname = 'batch_cruise_CTD_summary_{}.csv'.format(now)
+    pd.DataFrame(rows).to_csv(os.path.join(sDir, sname), index=False)
+    tname = 'batch_uframe_request_timings_{}.csv'.format(now)
+    pd.DataFrame(timings).to_csv(os.path.join(sDir, tname), index=False)
+    run.finish(sDir)
 
 
 if __name__ == '__main__':
@@ -318,5 +655,6 @@ if __name__ == '__main__':
     api_key = 'username'
     api_token = 'token'
     refdes = 'CP02PMUO-WFP01-03-CTDPFK000'
-    deployment = ['D00010', 'R00010']
+    deployments = ['D00010', 'R00010']
     main(sDir, api_key, api_token, refdes, deployments)
+    #batch_main(sDir, api_key, api_token)  # compare every CTDPF and FLORT in platform_CTDcast_mapping.csv
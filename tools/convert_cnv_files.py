@@ -3,17 +3,48 @@
 Created on Apr 18 2018
 
 @author: Lori Garzio
-@brief: Convert OOI cruise shipboard CTD .cnv files to .csv files. Requires server connection to 
+@brief: Convert OOI cruise shipboard CTD .cnv files to .csv (or binary columnar) files. Requires server connection to 
 alfresco.ooi.rutgers.edu on local machine if directly accessing the OOI shipboard CTD files.
 @usage:
 sDir: Directory where output files are saved
 CTDfiles: two acceptable formats: 1) path to an individual *.cnv file, or 2) .csv file containing CTD files to be
 converted (e.g. https://github.com/seagrinch/data-team-python/blob/master/cruise_data/cruise_CTDs.csv)
+workers: number of files converted in parallel (default 1 = convert serially in this process)
+threads: use a pool of threads instead of processes (useful when most of the time is spent waiting on the WebDAV mount)
+manifest: local manifest of the files that were already converted (see cnv_cache.py). Files that haven't changed since
+they were converted to sDir are skipped. Set to None to convert every file.
+use_hash: also compare the md5 of files whose modification time changed, to skip files that were touched but not edited
+formats: output formats (see cast_formats.py): csv, npz, npy, feather, parquet. The binary formats also store the units
+and the cast metadata from the cruise CTD sheet (lat, lon, datetime, cruise, leg, cast).
+archive: directory of a consolidated, memory-mapped archive of all of the converted casts (see cast_archive.py) that is
+rebuilt at the end of the run. Set to None (default) to skip it.
+
+stage: CNVStage the .cnv files are read through (see cnv_staging.py). The files are prefetched into a local cache
+directory while the first files are converted. Set to None (default) to read them directly from the mount.
+profile, trace_memory: profile the run with cProfile and/or trace the memory allocations (see instrumentation.py)
+
+A report of the files that were converted or failed, with timings, is saved to sDir at the end of each run, along with
+the time spent in each stage of the run (metadata, read header, parse, write, archive) and the bytes and rows read.
 """
 
 import pandas as pd
-from io import StringIO
 import os
+import datetime
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from cnv_reader import read_cnv
+from cnv_cache import CNVCache, DEFAULT_MANIFEST
+from cast_formats import write_cast, format_ext
+from cast_archive import build_archive
+from cruise_catalog import read_table
+import instrumentation
+
+ARCHIVE_FORMATS = ['.npy', '.feather', '.npz', '.parquet', '.csv']  # fastest to load first
+# cast metadata saved in the binary output formats: metadata key, column in the cruise CTD sheet
+CAST_METADATA = OrderedDict([('cruise', 'CTD_CruiseName'), ('leg', 'CTD_CruiseLeg'), ('cast', 'CTDcast'),
+                             ('CUID', 'CUID'), ('datetime', 'CTD_Date'), ('lat', 'CTD_lat'), ('lon', 'CTD_lon')])
 
 
 def create_dir(new_dir):
@@ -28,54 +59,155 @@ def create_dir(new_dir):
                 raise
 
 
-def ctd_files_lst(CTD_files):
-    flist = []
+def output_base(sDir, f):
+    # Path of the converted files of the .cnv file f, without the extension. The directories of f below the mount point
+    # are kept under sDir.
+    return os.path.join('/'.join((sDir, '/'.join(f.split('/')[4:-1]))), f.split('/')[-1].split('.')[0])
+
+
+def ctd_files_info(CTD_files):
+    # Returns the CTD files to be converted, with the cast metadata from the cruise CTD sheet when it is provided
+    finfo = OrderedDict()
     if CTD_files.endswith('.csv'):
-        CTDfiles = pd.read_csv(CTD_files).fillna('')
+        CTDfiles = read_table(CTD_files)
         for row in CTDfiles.iterrows():
             if row[-1]['CTD_rawdata_filepath'].endswith('.cnv'):
                 f = ''.join((row[-1]['filepath_primary'], row[-1]['CTD_rawdata_filepath']))
-                flist.append(f)
+                finfo[f] = OrderedDict([('filename', f)])
+                for k, col in CAST_METADATA.items():
+                    if col in row[-1]:
+                        finfo[f][k] = row[-1][col]
     elif CTD_files.endswith('.cnv'):
-        flist.append(CTD_files)
+        finfo[CTD_files] = OrderedDict([('filename', CTD_files)])
     else:
         print 'CTD_files input not in correct format'
-    return flist
-
-
-def main(sDir, CTD_files):
-    flist = ctd_files_lst(CTD_files)
-    for i, f in enumerate(flist):
-        print 'Converting {} of {} files'.format(i, len(flist))
-        save_dir = '/'.join((sDir, '/'.join(f.split('/')[4:-1])))
-        create_dir(save_dir)
-
-        # open the file and write to .csv
-        ctdfile = open(f, 'rb')
-        ctdfile = StringIO(ctdfile.read().decode(encoding='utf-8', errors='replace'))
-        header1, header2 = [], []
-        for k, line in enumerate(ctdfile.readlines()):
-            if '# name ' in line:
-                line = line.rstrip('\r\n')
-                name, desc = line.split('=')[1].split(':')
-                if name in [u' sigma-\ufffd00', u' sigma-\ufffd11']:
-                    name = 'sigma'
-                header1.append(str(name).lstrip())
-                header2.append(str(desc).lstrip())
-
-            if '*END*' in line:
-                skiprows = k + 1
-
-        ctdfile.seek(0)
-        df = pd.read_table(ctdfile, header=None, names=header1, index_col=None, skiprows=skiprows, delim_whitespace=True)
-        df.columns = pd.MultiIndex.from_tuples(zip(df.columns, header2))
-        fname = '.'.join((f.split('/')[-1].split('.')[0], 'csv'))
-        df.to_csv(os.path.join(save_dir, fname), index=False)
-        ctdfile.close()
+    return finfo
+
+
+def ctd_files_lst(CTD_files):
+    return list(ctd_files_info(CTD_files).keys())
+
+
+def convert_file(args):
+    # Convert one .cnv file to each of the output formats. Any error is caught and returned so that one bad file
+    # doesn't stop the batch.
+    sDir, f, formats, metadata, local = args
+    start = time.time()
+    result = OrderedDict([('file', f), ('status', 'success'), ('output', ''), ('seconds', None), ('error', '')])
+    try:
+        outbase = output_base(sDir, f)
+        create_dir(os.path.dirname(outbase))
+
+        # parse the file and write the output files
+        df = read_cnv(local)
+        with instrumentation.span('write'):
+            result['output'] = ';'.join(write_cast(df, metadata, outbase, fmt) for fmt in formats)
+        instrumentation.count('files converted')
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        print 'Failed to convert {}: {}'.format(f, result['error'])
+    result['seconds'] = round(time.time() - start, 3)
+    result['stages'] = instrumentation.drain()
+    return result
+
+
+def staged_args(stage, args):
+    # Conversion arguments with the local copy of each file, staged ahead of the conversion (see cnv_staging.py)
+    staged = stage.staged([a[1] for a in args])
+    for a in args:
+        f, local = next(staged)
+        yield a[:4] + (local,)
+
+
+def write_report(sDir, results):
+    report = pd.DataFrame(results, columns=['file', 'status', 'output', 'seconds', 'error'])
+    fname = 'cnv_conversion_report_{}.csv'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
+    report.to_csv(os.path.join(sDir, fname), index=False)
+    nfailed = len(report[report['status'] == 'failed'])
+    nskipped = len(report[report['status'] == 'unchanged'])
+    print 'Converted {} of {} files ({} unchanged, {} failed) in {} s. Report saved to {}'.format(
+        len(report) - nfailed - nskipped, len(report), nskipped, nfailed, round(report['seconds'].sum(), 3), fname)
+    return report
+
+
+def archive_casts(archive, finfo, results):
+    # Build the cast archive from one output file of each converted cast
+    casts = []
+    for result in results:
+        if result['status'] in ['success', 'unchanged']:
+            outfiles = sorted(result['output'].split(';'), key=lambda o: ARCHIVE_FORMATS.index(os.path.splitext(o)[1]))
+            metadata = dict((k, v) for k, v in finfo[result['file']].items() if k in CAST_METADATA)
+            metadata['cnv'] = result['file']
+            casts.append((outfiles[0], metadata))
+    return build_archive(archive, casts)
+
+
+def main(sDir, CTD_files, workers=1, threads=False, manifest=DEFAULT_MANIFEST, use_hash=False, formats=('csv',),
+         archive=None, stage=None, profile=False, trace_memory=False):
+    run = instrumentation.start_run('cnv_conversion', profile, trace_memory)
+    finfo = ctd_files_info(CTD_files)
+    flist = list(finfo.keys())
+    exts = set(format_ext(fmt) for fmt in formats)
+    create_dir(sDir)
+    cache = CNVCache(manifest, use_hash) if manifest else None
+
+    # skip the files that haven't changed since they were last converted to sDir
+    results = []
+    fingerprints = {}
+    args = []
+    for f in flist:
+        if cache:
+            entry, fingerprints[f] = cache.lookup(f)
+            outfiles = cache.output(entry, sDir)
+            if outfiles and exts.issubset(os.path.splitext(o)[1] for o in outfiles):
+                results.append(OrderedDict([('file', f), ('status', 'unchanged'), ('output', ';'.join(outfiles)),
+                                            ('seconds', 0.0), ('error', '')]))
+                continue
+        args.append((sDir, f, formats, finfo[f], f))
+    print '{} of {} files are new or have changed since the last conversion'.format(len(args), len(flist))
+    tasks = staged_args(stage, args) if stage else args
+
+    if workers > 1:
+        pool = ThreadPool(workers) if threads else Pool(workers)
+        try:
+            for i, result in enumerate(pool.imap_unordered(convert_file, tasks)):
+                print 'Converted {} of {} files: {} ({})'.format(i + 1, len(args), result['file'], result['status'])
+                run.merge(result.pop('stages'))
+                results.append(result)
+                if stage:
+                    stage.release(result['file'])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i, a in enumerate(tasks):
+            print 'Converting {} of {} files'.format(i, len(args))
+            result = convert_file(a)
+            result.pop('stages')
+            results.append(result)
+            if stage:
+                stage.release(result['file'])
+
+    if cache:
+        for result in results:
+            if result['status'] == 'success':
+                cache.record(result['file'], fingerprints[result['file']], output=(sDir, result['output'].split(';')))
+        cache.save()
+
+    order = dict((f, i) for i, f in enumerate(flist))
+    results.sort(key=lambda r: order[r['file']])
+    if archive:
+        with instrumentation.span('archive'):
+            archive_casts(archive, finfo, results)
+    report = write_report(sDir, results)
+    run.finish(sDir)
+    return report
 
 
 if __name__ == '__main__':
     sDir = '/Users/lgarzio/Documents/OOI/CruiseData/processed_files'
     CTD_files = 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/cruise_data/cruise_CTDs.csv'
     #CTD_files = '/Volumes/webdav/OOI/Global Argentine Basin Array/Cruise Data/Argentine_Basin-01_AT-26-30_2015-03-08/Ship Data/at26-30/ctd/process/at2630007.cnv'
-    main(sDir, CTD_files)
+    workers = 4
+    main(sDir, CTD_files, workers)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+@brief: Catalog of the OOI Datateam Database cruise data tables
+(https://github.com/seagrinch/data-team-python/tree/master/cruise_data): platform_CTDcast_mapping.csv and
+cruise_CTDs.csv. Each table is loaded once, from a local clone of the repo or from a local copy of the remote file that
+is refreshed after ttl seconds, and indexed so that looking up a platform deployment or a cruise CTD cast doesn't scan
+the whole table.
+
+@usage:
+catalog = CruiseCatalog()  # or CruiseCatalog('/path/to/data-team-python/cruise_data')
+info = catalog.deployment('CP02PMUO', 'D00010')  # row of platform_CTDcast_mapping.csv, or None
+cast = catalog.cast('Pioneer-10', '1', '7')  # row of cruise_CTDs.csv (CTD_CruiseName, CTD_CruiseLeg, CTDcast), or None
+matches = catalog.cast_index.match(catalog.mapping, km=10, days=14)  # casts near each deployment (see cast_index.py)
+"""
+
+import os
+import time
+import pandas as pd
+import instrumentation
+from cast_index import CastIndex
+
+CRUISEDATA_REPO = 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/cruise_data'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cruise_data', 'catalog')
+
+
+def key_str(value):
+    # Table values as strings for the index keys (e.g. a cast number read as 7.0 and the string '7' match)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, (str, type(u''))):
+        value = str(value)
+    return value.strip()
+
+
+def read_table(source, cache_dir=DEFAULT_CACHE_DIR, ttl=86400, refresh=False):
+    # Read a .csv file from a local path, or from a URL through a local copy that is downloaded again when it is
+    # older than ttl seconds
+    if source.startswith(('http://', 'https://')):
+        local = os.path.join(cache_dir, source.split('/')[-1])
+        if refresh or not os.path.isfile(local) or time.time() - os.path.getmtime(local) > ttl:
+            import requests  # only needed for remote sources
+            with instrumentation.span('http request'):
+                r = requests.get(source, timeout=120)
+            r.raise_for_status()
+            instrumentation.count('bytes downloaded', len(r.content))
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp = '{}.{}.tmp'.format(local, os.getpid())
+            with open(tmp, 'wb') as fh:
+                fh.write(r.content)
+            os.rename(tmp, local)
+        source = local
+    with instrumentation.span('metadata'):
+        return pd.read_csv(source).fillna('')
+
+
+def build_index(df, columns):
+    # Dictionary of (column values) -> row label. If there are duplicate keys the first row is kept.
+    index = {}
+    keys = zip(*[df[c].map(key_str) for c in columns])
+    for key, label in zip(keys, df.index):
+        index.setdefault(key, label)
+    return index
+
+
+class CruiseCatalog(object):
+    def __init__(self, source=CRUISEDATA_REPO, cache_dir=DEFAULT_CACHE_DIR, ttl=86400, refresh=False):
+        # source: URL of the cruise_data folder of the Datateam Database, or a local clone of it
+        self.source = source
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.refresh = refresh
+        self._mapping = None
+        self._casts = None
+        self._mapping_index = None
+        self._casts_index = None
+        self._cast_index = None
+
+    def path(self, fname):
+        if self.source.startswith(('http://', 'https://')):
+            return '/'.join((self.source.rstrip('/'), fname))
+        return os.path.join(self.source, fname)
+
+    @property
+    def mapping(self):
+        if self._mapping is None:
+            self._mapping = read_table(self.path('platform_CTDcast_mapping.csv'), self.cache_dir, self.ttl,
+                                       self.refresh)
+            self._mapping_index = build_index(self._mapping, ['platform', 'Deployment'])
+        return self._mapping
+
+    @property
+    def casts(self):
+        if self._casts is None:
+            self._casts = read_table(self.path('cruise_CTDs.csv'), self.cache_dir, self.ttl, self.refresh)
+            self._casts_index = build_index(self._casts, ['CTD_CruiseName', 'CTD_CruiseLeg', 'CTDcast'])
+        return self._casts
+
+    @property
+    def cast_index(self):
+        # spatio-temporal index of the casts
+        if self._cast_index is None:
+            self._cast_index = CastIndex(self.casts)
+        return self._cast_index
+
+    def deployment(self, platform, deployment):
+        mapping = self.mapping
+        label = self._mapping_index.get((key_str(platform), key_str(deployment)))
+        if label is not None:
+            return mapping.loc[label]
+
+    def cast(self, cruise, leg, cast):
+        casts = self.casts
+        label = self._casts_index.get((key_str(cruise), key_str(leg), key_str(cast)))
+        if label is not None:
+            return casts.loc[label]
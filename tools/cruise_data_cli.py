@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+@brief: Command line interface to the cruise data tools, with one subcommand per tool:
+    convert: convert_cnv_files.py
+    update-attributes: update_cruise_CTD_attributes.py
+    update-mapping: update_cruise_platform_mapping.py
+    compare: compare_cruise_CTD_profilers.py (one reference designator, every instrument on a platform, or a batch)
+Each subcommand only imports the modules it needs when it runs (e.g. update-attributes doesn't import matplotlib), so
+short jobs start quickly from cron or shell loops.
+
+Options can also be read from a JSON config file (--config). Top-level keys apply to every subcommand and a section
+named after a subcommand applies to that subcommand only. Options given on the command line take precedence. Keys are
+the option names with underscores, e.g.:
+    {"cruise_data": "/path/to/data-team-python/cruise_data",
+     "compare": {"api_key": "username", "api_token": "token", "workers": 8}}
+
+@usage:
+python cruise_data_cli.py convert sDir CTD_files [--workers 4] [--formats csv npy] [--archive dir]
+python cruise_data_cli.py update-attributes sDir
+python cruise_data_cli.py update-mapping AMdir sDir [--arrays CP G] [--workers 4]
+python cruise_data_cli.py compare sDir --refdes CP02PMUO-WFP01-03-CTDPFK000 --deployments D00010 R00010
+python cruise_data_cli.py compare sDir --platform CP02PMUO --config ooi.json [--archive dir]
+python cruise_data_cli.py compare sDir --batch --config ooi.json
+Installing the repo (pip install .) also installs the cruise-data command, e.g. cruise-data convert sDir CTD_files
+"""
+
+import argparse
+import json
+import os
+import sys
+
+INTERNAL_OPTIONS = ['help', 'config', 'command', 'func', 'check']  # not settable from the config file
+
+
+def catalog_arg(args, refresh=False):
+    # CruiseCatalog of the cruise_data tables in --cruise-data (a local directory or URL), or None for the default.
+    # refresh: download the remote tables again (the update tools write updated copies of them)
+    kwargs = {}
+    if args.cruise_data:
+        kwargs['source'] = args.cruise_data
+    if refresh or getattr(args, 'refresh_catalog', None):
+        kwargs['refresh'] = True
+    if getattr(args, 'catalog_ttl', None) is not None:
+        kwargs['ttl'] = args.catalog_ttl
+    if kwargs:
+        from cruise_catalog import CruiseCatalog
+        return CruiseCatalog(**kwargs)
+
+
+def stage_arg(args):
+    # CNVStage the .cnv files are read through if --staging-dir is given (see cnv_staging.py)
+    if args.staging_dir:
+        from cnv_staging import CNVStage
+        return CNVStage(args.staging_dir, args.staging_mb, args.staging_workers, args.mount_root, args.local_root)
+
+
+def options(args, names):
+    # keyword arguments of the options that were set, so the tools' own defaults apply to the others
+    return dict((n, getattr(args, n)) for n in names if getattr(args, n) is not None)
+
+
+def run_convert(args):
+    import convert_cnv_files
+    kwargs = options(args, ['workers', 'threads', 'use_hash', 'formats', 'archive', 'profile', 'trace_memory'])
+    if args.no_manifest:
+        kwargs['manifest'] = None
+    elif args.manifest:
+        kwargs['manifest'] = args.manifest
+    stage = stage_arg(args)
+    try:
+        report = convert_cnv_files.main(args.sDir, args.CTD_files, stage=stage, **kwargs)
+    finally:
+        if stage:
+            stage.close()
+    return 1 if (report['status'] == 'failed').any() else 0
+
+
+def run_update_attributes(args):
+    import update_cruise_CTD_attributes
+    kwargs = options(args, ['use_hash', 'profile', 'trace_memory'])
+    if args.no_manifest:
+        kwargs['manifest'] = None
+    elif args.manifest:
+        kwargs['manifest'] = args.manifest
+    stage = stage_arg(args)
+    try:
+        update_cruise_CTD_attributes.main(args.sDir, catalog=catalog_arg(args, refresh=True), stage=stage, **kwargs)
+    finally:
+        if stage:
+            stage.close()
+    return 0
+
+
+def run_update_mapping(args):
+    import update_cruise_platform_mapping
+    kwargs = options(args, ['arrays', 'workers', 'use_hash', 'match_km', 'match_days', 'profile', 'trace_memory'])
+    if args.no_state:
+        kwargs['state'] = None
+    elif args.state:
+        kwargs['state'] = args.state
+    update_cruise_platform_mapping.main(args.AMdir, args.sDir, catalog=catalog_arg(args, refresh=True), **kwargs)
+    return 0
+
+
+def check_compare(args, parser):
+    # reject the combinations of options that compare can't run
+    if not args.api_key or not args.api_token:
+        parser.error('the OOI API username and token are required (--api-key, --api-token or --config)')
+    if args.platform and args.refdes:
+        parser.error('give either --refdes or --platform')
+    if args.batch:
+        if args.platform:
+            parser.error('--platform can\'t be used with --batch (use --refdes to choose the reference designators)')
+        if args.interactive:
+            parser.error('--interactive can\'t be used with --batch (the batch runs in worker processes)')
+        if args.render_processes is not None:
+            parser.error('--render-processes can\'t be used with --batch (each batch process renders its own plots)')
+        if args.staging_dir:
+            parser.error('--staging-dir can\'t be used with --batch')
+    elif args.processes is not None:
+        parser.error('--processes is only used with --batch')
+    elif not args.platform and not args.refdes:
+        parser.error('give one or more reference designators, --platform or --batch')
+    elif not args.platform and len(args.refdes) == 1 and not args.deployments:
+        parser.error('--deployments is required to compare one reference designator')
+
+
+def run_compare(args):
+    import compare_cruise_CTD_profilers as compare
+    kwargs = options(args, ['workers', 'refresh', 'shard_hours', 'plots', 'nprofiles', 'max_points', 'base_url',
+                            'archive', 'converted', 'profile', 'trace_memory'])
+    rules = None if args.interactive else compare.SELECTION_RULES
+    if args.window:
+        kwargs['window'] = tuple(args.window)
+    if args.no_cache:
+        kwargs['cache_dir'] = None
+    elif args.cache_dir:
+        kwargs['cache_dir'] = args.cache_dir
+    catalog = catalog_arg(args)
+
+    if args.batch:
+        kwargs.update(options(args, ['processes', 'cast_cache_mb']))
+        compare.batch_main(args.sDir, args.api_key, args.api_token, args.refdes or None, args.deployments, rules,
+                           catalog=catalog, **kwargs)
+        return 0
+
+    kwargs.update(options(args, ['render_processes']))
+    stage = stage_arg(args)
+    try:
+        if args.platform or len(args.refdes) > 1:
+            kwargs.update(options(args, ['cast_cache_mb']))
+            compare.platform_main(args.sDir, args.api_key, args.api_token, args.platform or args.refdes,
+                                  args.deployments, rules=rules, catalog=catalog, stage=stage, **kwargs)
+        else:
+            compare.main(args.sDir, args.api_key, args.api_token, args.refdes[0], args.deployments, rules=rules,
+                         catalog=catalog, stage=stage, **kwargs)
+    finally:
+        if stage:
+            stage.close()
+    return 0
+
+
+def add_common(parser, staging=False, catalog=True):
+    parser.add_argument('--config', help='JSON file of options (see the module docstring)')
+    if catalog:
+        parser.add_argument('--cruise-data', dest='cruise_data',
+                            help='directory or URL of platform_CTDcast_mapping.csv and cruise_CTDs.csv (default: the '
+                                 'OOI Datateam Database on GitHub)')
+    parser.add_argument('--profile', action='store_const', const=True, help='profile the run with cProfile')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_const', const=True,
+                        help='record the peak memory use (and the largest allocations on Python 3)')
+    if staging:
+        parser.add_argument('--staging-dir', dest='staging_dir',
+                            help='stage the .cnv files in this local cache directory (see cnv_staging.py)')
+        parser.add_argument('--staging-mb', dest='staging_mb', type=float, default=2048,
+                            help='size cap of the staging directory (default 2048)')
+        parser.add_argument('--staging-workers', dest='staging_workers', type=int, default=4,
+                            help='number of files staged concurrently (default 4)')
+        parser.add_argument('--mount-root', dest='mount_root', help='root of the WebDAV mount in the .cnv paths')
+        parser.add_argument('--local-root', dest='local_root', help='local directory that stands in for --mount-root')
+
+
+def add_manifest(parser, name='manifest', what='the .cnv files that were already read'):
+    parser.add_argument('--' + name, help='local state of {} (default: in ~/.cruise_data)'.format(what))
+    parser.add_argument('--no-' + name, dest='no_' + name, action='store_true', help='read every file')
+    parser.add_argument('--use-hash', dest='use_hash', action='store_const', const=True,
+                        help='also compare the md5 of files whose modification time changed')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='OOI cruise data tools')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+
+    p = subparsers.add_parser('convert', help='convert shipboard CTD .cnv files')
+    p.add_argument('sDir', help='directory where the converted files are saved')
+    p.add_argument('CTD_files', help='path to a .cnv file or a .csv file listing the files (e.g. cruise_CTDs.csv)')
+    p.add_argument('--workers', type=int, help='number of files converted in parallel (default 1)')
+    p.add_argument('--threads', action='store_const', const=True, help='use threads instead of processes')
+    p.add_argument('--formats', nargs='+', choices=['csv', 'npz', 'npy', 'feather', 'parquet'],
+                   help='output formats (default csv)')
+    p.add_argument('--archive', help='directory of the consolidated cast archive (see cast_archive.py)')
+    add_manifest(p, what='the files that were already converted')
+    add_common(p, staging=True, catalog=False)
+    p.set_defaults(func=run_convert)
+
+    p = subparsers.add_parser('update-attributes', help='fill the time, lat and lon in cruise_CTDs.csv')
+    p.add_argument('sDir', help='directory where the updated cruise_CTDs.csv is saved')
+    add_manifest(p)
+    add_common(p, staging=True)
+    p.set_defaults(func=run_update_attributes)
+
+    p = subparsers.add_parser('update-mapping', help='update platform_CTDcast_mapping.csv from asset management')
+    p.add_argument('AMdir', help='deployment directory of a clone of the asset management repo')
+    p.add_argument('sDir', help='directory where the updated platform_CTDcast_mapping.csv is saved')
+    p.add_argument('--arrays', nargs='+', help='prefixes of the deployment sheets to read (default CP G)')
+    p.add_argument('--workers', type=int, help='number of deployment sheets read in parallel (default 1)')
+    p.add_argument('--match-km', dest='match_km', type=float,
+                   help='suggest CTD casts within this distance in the suggested_* columns (default: no suggestions)')
+    p.add_argument('--match-days', dest='match_days', type=float, help='time of suggested CTD casts (default 14)')
+    add_manifest(p, 'state', 'the deployment sheets that were already read')
+    add_common(p)
+    p.set_defaults(func=run_update_mapping)
+
+    p = subparsers.add_parser('compare', help='compare profiler data in uFrame to the cruise CTD casts')
+    p.add_argument('sDir', help='directory where the plots and summaries are saved')
+    p.add_argument('--refdes', nargs='+', default=[], help='reference designators (several are compared in one run)')
+    p.add_argument('--platform', help='compare every CTDPF and FLORT on this platform')
+    p.add_argument('--batch', action='store_true',
+                   help='compare the reference designators (default: every CTDPF and FLORT with a CTD cast) with one '
+                        'process per platform (not with --platform, --interactive, --render-processes or '
+                        '--staging-dir)')
+    p.add_argument('--deployments', nargs='+', help='e.g. D00010 R00010 (default: every deployment of the platform)')
+    p.add_argument('--api-key', dest='api_key', help='OOI API username')
+    p.add_argument('--api-token', dest='api_token', help='OOI API token')
+    p.add_argument('--interactive', action='store_true',
+                   help='choose the delivery method and stream at a prompt instead of with the selection rules')
+    p.add_argument('--window', nargs=2, type=float, help='days of uFrame data relative to the cast (default 0 1)')
+    p.add_argument('--shard-hours', dest='shard_hours', type=float,
+                   help='split the data requests into windows of this length (default: split only the requests that '
+                        'reach the uFrame limit)')
+    p.add_argument('--no-plots', dest='plots', action='store_const', const=False, help='only save the statistics')
+    p.add_argument('--render-processes', dest='render_processes', type=int, help='plot processes (default 4)')
+    p.add_argument('--nprofiles', type=int, help='only plot the profiles closest in time to the cast')
+    p.add_argument('--max-points', dest='max_points', type=int, help='profiler points per plot (default 20000)')
+    p.add_argument('--cast-cache-mb', dest='cast_cache_mb', type=float, help='memory of decoded casts (default 256)')
+    p.add_argument('--archive', help='read the casts in this cast archive instead of the .cnv files (see convert)')
+    p.add_argument('--converted', help='read the casts converted to npy or npz in this directory (see convert)')
+    p.add_argument('--workers', type=int, help='concurrent uFrame requests (default 8)')
+    p.add_argument('--processes', type=int, help='batch worker processes (default 4)')
+    p.add_argument('--refresh', action='store_const', const=True, help='ignore the cached uFrame responses')
+    p.add_argument('--base-url', dest='base_url', help='M2M API url (e.g. a local stub server)')
+    p.add_argument('--cache-dir', dest='cache_dir', help='directory of the cached uFrame responses')
+    p.add_argument('--refresh-catalog', dest='refresh_catalog', action='store_const', const=True,
+                   help='download the cruise_data tables again instead of using the local copy')
+    p.add_argument('--catalog-ttl', dest='catalog_ttl', type=float,
+                   help='seconds the local copy of the cruise_data tables is used for (default 86400)')
+    p.add_argument('--no-cache', dest='no_cache', action='store_true', help="don't cache the uFrame responses")
+    add_common(p, staging=True)
+    p.set_defaults(func=run_compare, check=check_compare)
+    return parser, subparsers
+
+
+def load_config(fname, command, parser):
+    # Options for command from a JSON config file: the top-level keys, then the section of the command
+    with open(fname) as fh:
+        config = json.load(fh)
+    # only the options of the command line (not the positional arguments, which are always given on the command line)
+    known = set(a.dest for a in parser._actions if a.option_strings) - set(INTERNAL_OPTIONS)
+    values = dict((k, v) for k, v in config.items() if not isinstance(v, dict))
+    values.update(config.get(command, {}))
+    unknown = sorted(set(values) - known)
+    if unknown:
+        print 'Ignoring unknown options in {} for {}: {}'.format(fname, command, ', '.join(unknown))
+    return dict((k, v) for k, v in values.items() if k in known)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser, subparsers = build_parser()
+    args = parser.parse_args(argv)
+    if args.config:
+        # options in the config file become the defaults, so the command line still takes precedence
+        subparser = subparsers.choices[args.command]
+        subparser.set_defaults(**load_config(os.path.expanduser(args.config), args.command, subparser))
+        args = parser.parse_args(argv)
+    if getattr(args, 'check', None):
+        args.check(args, subparsers.choices[args.command])
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
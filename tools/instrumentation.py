@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+@brief: Timing and profiling instrumentation shared by the tools. Each stage of a run (metadata load, file read, parse,
+HTTP request, decode, plot, write...) is timed with a span, and counters record the bytes, rows, files and requests
+processed. At the end of a run the totals per stage and the counters are printed and saved as JSON to the output
+directory (<name>_timing_<timestamp>.json), so a slow run shows where the time went.
+
+Spans and counters are recorded in the current run of each process (thread-safe). Tasks run in a pool of worker
+processes return drain() with their results, and the main process merge()s it into its run.
+
+Opt-in profiling: profile=True runs cProfile over the whole run (the stats are saved to <name>_profile_<timestamp>.prof
+and the top functions are printed), trace_memory=True records the peak and the top memory allocations with tracemalloc.
+tracemalloc requires Python 3: on Python 2 the peak resident set size of the process (and of its finished worker
+processes) is recorded instead, from resource.getrusage.
+
+@usage:
+run = start_run('cnv_conversion', profile=False, trace_memory=False)
+with span('parse'):
+    ...
+count('rows', len(df))
+run.finish(sDir)
+"""
+
+import cProfile
+import datetime
+import json
+import multiprocessing
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+class Run(object):
+    def __init__(self, name='run', profile=False, trace_memory=False):
+        self.name = name
+        self.pid = os.getpid()
+        self.started = datetime.datetime.now()
+        self.start = time.time()
+        self.stages = OrderedDict()  # stage: [count, seconds]
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.tracemalloc = None
+        self.trace_rss = False
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if trace_memory:
+            try:
+                import tracemalloc
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                print 'tracemalloc requires Python 3, only the peak memory use of the process will be recorded'
+                self.trace_rss = True
+
+    def add(self, stage, seconds, n=1):
+        with self.lock:
+            entry = self.stages.setdefault(stage, [0, 0.0])
+            entry[0] += n
+            entry[1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def span(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def snapshot(self):
+        # Stages and counters of this process, to be merged into the run of the main process
+        with self.lock:
+            return {'stages': dict((k, list(v)) for k, v in self.stages.items()), 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        if not snapshot:
+            return
+        for stage, (n, seconds) in snapshot['stages'].items():
+            self.add(stage, seconds, n)
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+
+    def report(self):
+        seconds = time.time() - self.start
+        stages = OrderedDict()
+        for stage, (n, s) in self.stages.items():
+            stages[stage] = OrderedDict([('count', n), ('seconds', round(s, 3))])
+        return OrderedDict([('run', self.name), ('started', self.started.strftime('%Y-%m-%dT%H:%M:%S')),
+                            ('seconds', round(seconds, 3)), ('stages', stages), ('counters', self.counters)])
+
+    def finish(self, sDir=None):
+        # Stop the profilers, print the report and save it to sDir. Returns the report.
+        report = self.report()
+        now = self.started.strftime('%Y%m%dT%H%M%S')
+        if self.profiler is not None:
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            if sDir:
+                pname = os.path.join(sDir, '{}_profile_{}.prof'.format(self.name, now))
+                stats.dump_stats(pname)
+                report['profile'] = pname
+            stats.sort_stats('cumulative').print_stats(25)
+        if self.tracemalloc is not None:
+            top = self.tracemalloc.take_snapshot().statistics('lineno')[:10]
+            report['memory'] = OrderedDict([('peak_mb', round(self.tracemalloc.get_traced_memory()[1] / 1048576.0, 1)),
+                                            ('top', [str(s) for s in top])])
+            self.tracemalloc.stop()
+        elif self.trace_rss:
+            # the peak over the life of the process, which includes any earlier runs in the same process
+            report['memory'] = OrderedDict([('peak_rss_mb', peak_rss_mb()),
+                                            ('children_rss_mb', peak_rss_mb(resource.RUSAGE_CHILDREN))])
+
+        print '\n{} finished in {} s'.format(self.name, report['seconds'])
+        for stage, s in report['stages'].items():
+            # stages that overlap (e.g. concurrent requests, worker processes) can add up to more than the run time
+            print '  {:<16} {:>8} x {:>10.3f} s'.format(stage, s['count'], s['seconds'])
+        for name, n in report['counters'].items():
+            print '  {:<16} {:>8}'.format(name, n)
+        for name, mb in report.get('memory', {}).items():
+            if name != 'top':
+                print '  {:<16} {:>8}'.format(name, mb)
+
+        if sDir:
+            fname = os.path.join(sDir, '{}_timing_{}.json'.format(self.name, now))
+            with open(fname, 'w') as fh:
+                json.dump(report, fh, indent=1)
+            report['file'] = fname
+        return report
+
+
+_run = Run()
+
+
+def start_run(name, profile=False, trace_memory=False):
+    # Start a new run in this process. Spans and counters recorded from now on go to this run.
+    global _run
+    _run = Run(name, profile, trace_memory)
+    return _run
+
+
+def current_run():
+    # A process forked from the main process starts with a copy of its run: record in a new one instead
+    global _run
+    if _run.pid != os.getpid():
+        _run = Run(_run.name)
+    return _run
+
+
+def drain():
+    # In a worker process: the stages and counters recorded since the last drain(), to be merged into the run of the
+    # main process. Returns None in the main process, where they are already recorded in the current run.
+    global _run
+    if multiprocessing.current_process().name == 'MainProcess':
+        return None
+    run = current_run()
+    _run = Run(run.name)
+    return run.snapshot()
+
+
+def span(stage):
+    return current_run().span(stage)
+
+
+def count(name, n=1):
+    current_run().count(name, n)
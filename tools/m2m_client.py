@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+@brief: Client for the OOI uFrame Machine to Machine (M2M) API. All requests share one connection pool, requests that
+fail with a server error (5xx), a timeout or a dropped connection are retried with exponential backoff, and the time
+taken by each request is recorded. Independent requests (e.g. the data requests for every cast of a comparison run) can
+be sent concurrently with fetch_many.
+
+Successful responses are cached on disk (gzipped JSON, keyed by the request URL and parameters). Data requests for a
+time window that has already ended are kept indefinitely, everything else (e.g. inventory listings) expires after
+inventory_ttl seconds.
+Pass refresh=True to ignore and overwrite the cached responses, or cache_dir=None to disable the cache.
+
+@usage:
+client = M2MClient(api_key, api_token)  # base_url can point to a local stub server for testing
+methods = client.inventory(rd)  # rd = refdes.split('-')
+streams = client.inventory(rd, method)
+refdes_list = client.instruments('CP02PMUO')
+results = client.fetch_many([(client.data_url(rd, method, stream), params), ...])  # list of (status, json)
+client.timings  # url, params, status, seconds and attempt for every request
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+import instrumentation
+try:
+    import ujson as json_parser  # much faster than json for large data responses
+except ImportError:
+    json_parser = json
+
+API_BASE_URL = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv/'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cruise_data', 'm2m_cache')
+
+
+class ResponseCache(object):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, refresh=False):
+        self.cache_dir = cache_dir
+        self.refresh = refresh
+
+    def path(self, url, params):
+        key = hashlib.sha1(json.dumps([url, params], sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json.gz')
+
+    def get(self, url, params, ttl=None):
+        # Returns the cached payload, or None if it isn't cached, has expired or refresh was requested
+        f = self.path(url, params)
+        if self.refresh or not os.path.isfile(f):
+            return None
+        try:
+            with gzip.open(f, 'rb') as fh:
+                cached = json.loads(fh.read().decode('utf-8'))
+        except (IOError, ValueError):
+            return None  # incomplete or corrupt cache file, request it again
+        if ttl is not None and time.time() - cached['time'] > ttl:
+            return None
+        return cached['payload']
+
+    def put(self, url, params, payload):
+        f = self.path(url, params)
+        if not os.path.isdir(os.path.dirname(f)):
+            try:
+                os.makedirs(os.path.dirname(f))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(f)):
+                    raise
+        tmp = '{}.{}.tmp'.format(f, os.getpid())
+        with gzip.open(tmp, 'wb') as fh:
+            cached = {'url': url, 'params': params, 'time': time.time(), 'payload': payload}
+            fh.write(json.dumps(cached).encode('utf-8'))
+        os.rename(tmp, f)
+
+    def clear(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.json.gz'):
+                    os.remove(os.path.join(root, f))
+
+
+def request_ttl(params, ttl):
+    # Data requested for a time window that has already ended won't change, keep it indefinitely. The ISO 8601
+    # timestamps are compared as strings (strptime isn't thread-safe on Python 2).
+    try:
+        end = params['endDT']
+    except (TypeError, KeyError):
+        return ttl
+    if end < datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'):
+        return None
+    return ttl
+
+
+class M2MClient(object):
+    def __init__(self, username, token, base_url=API_BASE_URL, workers=8, timeout=120, retries=3, backoff=1.0,
+                 cache_dir=DEFAULT_CACHE_DIR, inventory_ttl=86400, refresh=False):
+        self.auth = (username, token)
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.timings = []
+        self.cache = ResponseCache(cache_dir, refresh) if cache_dir else None
+        self.inventory_ttl = inventory_ttl
+
+        self.session = requests.session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def refdes_url(self, rd):
+        return '{:s}{:s}/{:s}/{:s}-{:s}'.format(self.base_url, rd[0], rd[1], rd[2], rd[3])
+
+    def data_url(self, rd, method, stream):
+        return '{:s}/{:s}/{:s}'.format(self.refdes_url(rd), method, stream)
+
+    def get(self, url, params=None):
+        # Returns the response, or None if the server couldn't be reached after all the retries
+        r = None
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                with instrumentation.span('http request'):
+                    r = self.session.get(url, params=params, auth=self.auth, timeout=self.timeout)
+                status = r.status_code
+                instrumentation.count('bytes downloaded', len(r.content))
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                r = None
+                status = type(e).__name__
+            self.timings.append(OrderedDict([('url', url), ('params', params), ('status', status),
+                                             ('seconds', round(time.time() - start, 3)), ('attempt', attempt),
+                                             ('cached', False)]))
+            if r is not None and r.status_code < 500:
+                break
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        if r is None:
+            print 'Request failed: {} ({})'.format(url, status)
+        return r
+
+    def fetch(self, url, params=None):
+        # Returns the status code and the decoded JSON of a request, from the cache if possible. Only successful
+        # responses are cached. The status is None if the server couldn't be reached.
+        if self.cache:
+            start = time.time()
+            with instrumentation.span('read cache'):
+                payload = self.cache.get(url, params, request_ttl(params, self.inventory_ttl))
+            if payload is not None:
+                instrumentation.count('cached responses')
+                self.timings.append(OrderedDict([('url', url), ('params', params), ('status', 200),
+                                                 ('seconds', round(time.time() - start, 3)), ('attempt', 0),
+                                                 ('cached', True)]))
+                return 200, payload
+
+        r = self.get(url, params)
+        if r is None:
+            return None, None
+        try:
+            with instrumentation.span('parse json'):
+                payload = json_parser.loads(r.content)
+        except ValueError:
+            payload = None
+        if self.cache and r.status_code == 200 and payload is not None:
+            with instrumentation.span('write cache'):
+                self.cache.put(url, params, payload)
+        return r.status_code, payload
+
+    def fetch_many(self, requests_list):
+        # Fetch (url, params) requests concurrently. Returns (status, json) in the same order as the requests.
+        return self.map(lambda req: self.fetch(*req), requests_list)
+
+    def get_json(self, url, params=None):
+        status, payload = self.fetch(url, params)
+        if status == 200:
+            return payload
+        else:
+            print 'Request failed'
+
+    def get_many(self, requests_list):
+        # Send (url, params) requests concurrently. Returns the responses in the same order as the requests.
+        return self.map(lambda req: self.get(*req), requests_list)
+
+    def map(self, func, items):
+        if len(items) < 2 or self.workers < 2:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def inventory(self, rd, method=None):
+        # Delivery methods available for a reference designator, or the streams available for a delivery method
+        url = self.refdes_url(rd)
+        if method:
+            url = '{:s}/{:s}'.format(url, method)
+        return self.get_json(url)
+
+    def instruments(self, platform):
+        # All of the reference designators on a platform listed in uFrame
+        nodes = self.get_json('{:s}{:s}'.format(self.base_url, platform)) or []
+        sensors = self.map(lambda n: self.get_json('{:s}{:s}/{:s}'.format(self.base_url, platform, n)) or [], nodes)
+        return ['-'.join((platform, n, sensor)) for n, node_sensors in zip(nodes, sensors) for sensor in node_sensors]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+@brief: Profile plots of the cruise shipboard CTD casts vs. the uFrame profiler data, rendered off the main process.
+Plots are submitted to a RenderQueue and drawn by a pool of renderer processes with the headless Agg backend. Each
+renderer keeps one figure per plot layout (two panels or a single panel) and only updates the line data, labels and
+title between casts instead of building a new figure for every plot.
+
+@usage:
+renderer = RenderQueue(processes=4)  # processes=0 renders in this process, enabled=False skips the plots
+renderer.submit('panel', refdes, cast_args, uF_args, units, labels, ptitle, sfile, uFdate)
+renderer.submit('single', refdes, cast_args, uF_args, units, label, ptitle, sfile, uFdate)
+renderer.close()  # waits for the plots, returns a list of (file, error)
+"""
+
+import numpy as np
+from multiprocessing import Pool
+import instrumentation
+
+_templates = {}  # figure templates of this process, by layout
+
+
+def xy(values, pres):
+    # Line data as floats (missing values as NaN). A variable that wasn't found in the cast isn't drawn.
+    x = np.asarray(values, dtype=np.float64).ravel()
+    y = np.asarray(pres, dtype=np.float64).ravel()
+    if len(x) != len(y):
+        return [], []
+    return x, y
+
+
+def rescale(ax):
+    ax.relim()
+    ax.autoscale_view()
+    if not ax.yaxis_inverted():
+        ax.invert_yaxis()
+
+
+def pyplot():
+    # matplotlib is only imported by the processes that render plots, with the headless Agg backend
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def title(refdes, ptitle, uFdate):
+    return '{} vs. Shipboard CTD'.format(refdes) + '\n' + ptitle + '\n' + 'uFrame Profiler data: {}'.format(uFdate)
+
+
+class PanelTemplate(object):
+    # Two panels sharing the pressure axis
+    def __init__(self):
+        self.fig, (self.ax1, self.ax2) = pyplot().subplots(1, 2, sharey=True)
+        self.cast1, = self.ax1.plot([], [], 'b')
+        self.uF1, = self.ax1.plot([], [], 'r.', markersize=.75)
+        self.ax1.grid()
+        self.cast2, = self.ax2.plot([], [], 'b', label='Cruise CTD')
+        self.uF2, = self.ax2.plot([], [], 'r.', markersize=.75, label='Profiler')
+        self.ax2.legend()
+        self.ax2.grid()
+        self.suptitle = self.fig.suptitle('', fontsize=10)
+        self.fig.subplots_adjust(top=0.875)
+
+    def render(self, refdes, cast_args, uF_args, units, labels, ptitle, sfile, uFdate):
+        self.cast1.set_data(*xy(cast_args[1], cast_args[0]))
+        self.uF1.set_data(*xy(uF_args[1], uF_args[0]))
+        self.cast2.set_data(*xy(cast_args[2], cast_args[0]))
+        self.uF2.set_data(*xy(uF_args[2], uF_args[0]))
+        self.ax1.set_ylabel('Pressure ({})'.format(units[0]))
+        self.ax1.set_xlabel(labels[0] + ' ({})'.format(units[1]))
+        self.ax2.set_xlabel(labels[1] + ' ({})'.format(units[2]))
+        for ax in [self.ax1, self.ax2]:
+            rescale(ax)
+        self.suptitle.set_text(title(refdes, ptitle, uFdate))
+        self.fig.savefig(str(sfile))
+
+
+class SingleTemplate(object):
+    def __init__(self):
+        self.fig, self.ax = pyplot().subplots()
+        self.cast, = self.ax.plot([], [], 'b', label='Cruise CTD')
+        self.uF, = self.ax.plot([], [], 'r.', markersize=1.5, label='Profiler')
+        self.ax.legend()
+        self.ax.grid()
+        self.title = self.ax.set_title('', fontsize=10)
+
+    def render(self, refdes, cast_args, uF_args, units, label, ptitle, sfile, uFdate):
+        self.cast.set_data(*xy(cast_args[1], cast_args[0]))
+        self.uF.set_data(*xy(uF_args[1], uF_args[0]))
+        self.ax.set_ylabel('Pressure ({})'.format(units[0]))
+        self.ax.set_xlabel(label + ' ({})'.format(units[1]))
+        rescale(self.ax)
+        self.title.set_text(title(refdes, ptitle, uFdate))
+        self.fig.savefig(str(sfile))
+
+
+TEMPLATES = {'panel': PanelTemplate, 'single': SingleTemplate}
+
+
+def render(job):
+    # Render one plot with the figure template of this process. Errors are returned so one plot doesn't stop the rest.
+    layout, args = job
+    sfile = args[6]
+    try:
+        with instrumentation.span('plot'):
+            if layout not in _templates:
+                _templates[layout] = TEMPLATES[layout]()
+            _templates[layout].render(*args)
+        return sfile, ''
+    except Exception as e:
+        return sfile, '{}: {}'.format(type(e).__name__, e)
+
+
+def render_task(job):
+    # render() in a renderer process, with the time spent so it can be added to the run of the main process
+    return render(job), instrumentation.drain()
+
+
+def profile_plot_panel(refdes, cast_args, uF_args, units, labels, ptitle, sfile, uFdate):
+    return render(('panel', (refdes, cast_args, uF_args, units, labels, ptitle, sfile, uFdate)))
+
+
+def profile_plot_single(refdes, cast_args, uF_args, units, label, ptitle, sfile, uFdate):
+    return render(('single', (refdes, cast_args, uF_args, units, label, ptitle, sfile, uFdate)))
+
+
+class RenderQueue(object):
+    def __init__(self, processes=4, enabled=True):
+        # processes=0 renders each plot when it is submitted (e.g. in a worker process that can't start a pool)
+        self.processes = processes
+        self.enabled = enabled
+        self.pool = None
+        self.pending = []
+        self.results = []
+
+    def submit(self, layout, *args):
+        if not self.enabled:
+            return
+        if self.processes > 0:
+            if self.pool is None:
+                self.pool = Pool(self.processes)
+            self.pending.append(self.pool.apply_async(render_task, ((layout, args),)))
+        else:
+            self.results.append(render((layout, args)))
+
+    def close(self):
+        # Wait for all of the submitted plots. Returns a list of (file, error), error is '' if the plot was saved.
+        if self.pool is not None:
+            self.pool.close()
+            for p in self.pending:
+                result, stages = p.get()
+                instrumentation.current_run().merge(stages)
+                self.results.append(result)
+            self.pool.join()
+            self.pool = None
+            self.pending = []
+        for sfile, error in self.results:
+            if error:
+                print 'Failed to plot {}: {}'.format(sfile, error)
+        return self.results
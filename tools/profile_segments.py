@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+@brief: Reduce dense profiler data from uFrame before it is plotted. A multi-day window of profiler data can have
+hundreds of thousands of points, so:
+    - segment_profiles splits the time series into individual down (pressure increasing) and up casts, so that only the
+    profiles closest in time to the cruise CTD cast are plotted (closest_profiles)
+    - decimate keeps the points with the minimum and maximum value of each variable in each pressure bin, which keeps
+    the shape and the spread of the profiles with a fixed maximum number of points
+Everything is done with NumPy array operations, no loops over the data points. The changes of direction are found
+with hysteresis (a turn counts only after the pressure has moved min_range dbar back), so noisy pressure doesn't split
+the profiles.
+
+@usage:
+segments = segment_profiles(uF['time'], uF['pres'])  # array of [start, stop) index pairs, one row per profile
+ind = closest_profiles(uF['time'], segments, cast_time, n=2)  # indices of the points of the 2 closest profiles
+ind = decimate(uF['pres'], [uF['cond'], uF['temp']], max_points=20000, ind=ind)  # indices to plot
+"""
+
+import numpy as np
+
+DEFAULT_MAX_POINTS = 20000
+
+
+def turning_point(pres, k, direction, min_range, window=4096):
+    # Index of the next turning point after k when the pressure goes in direction (1: increasing, -1: decreasing): the
+    # extreme reached before the pressure has moved back min_range dbar from it. None if it never moves back.
+    while True:
+        x = direction * pres[k:k + window]
+        back = np.flatnonzero(np.maximum.accumulate(x) - x >= min_range)
+        if len(back):
+            return k + int(np.argmax(x[:back[0]]))
+        if k + window >= len(pres):
+            return None
+        window *= 2
+
+
+def direction_changes(pres, min_range):
+    # Indices where the profiler turns around, with hysteresis: a change of direction only counts once the pressure
+    # has moved min_range dbar back from the deepest (or shallowest) point since the last turn, so noise and short
+    # excursions (e.g. the profiler parked at the top or bottom) are treated as part of the surrounding profile.
+    # Only the turning points are looped over, each search is done with array operations.
+    pres = np.asarray(pres, dtype=np.float64)
+    if len(pres) < 2:
+        return np.empty(0, dtype=np.int64)
+
+    # the first direction is the first excursion of min_range from the lowest or highest pressure so far
+    rise = np.flatnonzero(pres - np.minimum.accumulate(pres) >= min_range)
+    fall = np.flatnonzero(np.maximum.accumulate(pres) - pres >= min_range)
+    if len(rise) == 0 and len(fall) == 0:
+        return np.empty(0, dtype=np.int64)
+    direction = 1 if len(fall) == 0 or (len(rise) and rise[0] < fall[0]) else -1
+
+    breaks = []
+    k = 0
+    while True:
+        k = turning_point(pres, k, direction, min_range)
+        if k is None:
+            break
+        breaks.append(k)
+        direction = -direction
+    return np.array(breaks, dtype=np.int64)
+
+
+def segment_profiles(time, pres, min_range=5.0, max_gap=3600):
+    # Split the profiler data into profiles: at every change of direction and at every gap in time longer than max_gap
+    # seconds. Returns an array of [start, stop) index pairs.
+    pres = np.asarray(pres, dtype=np.float64)
+    n = len(pres)
+    if n == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    valid = np.flatnonzero(np.isfinite(pres))
+    if len(valid) < 2:
+        return np.array([[0, n]])
+
+    breaks = valid[direction_changes(pres[valid], min_range)]
+    t = np.asarray(time).astype('datetime64[s]').astype(np.int64)
+    gaps = np.flatnonzero(np.diff(t) > max_gap) + 1
+    breaks = np.union1d(breaks, gaps)
+    edges = np.r_[0, breaks, n].astype(np.int64)
+    return np.column_stack((edges[:-1], edges[1:]))
+
+
+def closest_profiles(time, segments, t0, n=2):
+    # Indices of the points of the n profiles closest in time to t0 (e.g. the time of the cruise CTD cast)
+    if len(segments) == 0:
+        return np.empty(0, dtype=np.int64)
+    t = np.asarray(time).astype('datetime64[s]').astype(np.int64)
+    t0 = np.datetime64(t0, 's').astype(np.int64)
+    start = t[segments[:, 0]]
+    stop = t[segments[:, 1] - 1]
+    # 0 if t0 is during the profile, otherwise the time to the closest end of the profile
+    distance = np.maximum(np.maximum(start - t0, t0 - stop), 0)
+    closest = np.sort(np.argsort(distance, kind='mergesort')[:n])
+    counts = segments[closest, 1] - segments[closest, 0]
+    offsets = np.repeat(segments[closest, 0] - np.r_[0, np.cumsum(counts)[:-1]], counts)
+    return np.arange(counts.sum()) + offsets
+
+
+def decimate(pres, columns, max_points=DEFAULT_MAX_POINTS, ind=None):
+    # Indices (in time order) of at most about max_points points: the points with the minimum and maximum value of
+    # each column in each pressure bin. Points with a missing pressure are dropped.
+    pres = np.asarray(pres, dtype=np.float64)
+    ind = np.arange(len(pres)) if ind is None else np.asarray(ind)
+    ind = ind[np.isfinite(pres[ind])]
+    if len(ind) <= max_points:
+        return ind
+
+    columns = [np.asarray(c, dtype=np.float64) for c in columns if len(c) == len(pres)]
+    nbins = max(1, max_points // (2 * max(1, len(columns))))
+    p = pres[ind]
+    bins = np.minimum(((p - p.min()) / (p.max() - p.min() or 1) * nbins).astype(np.int64), nbins - 1)
+
+    keep = []
+    for values in columns:
+        v = values[ind]
+        finite = np.isfinite(v)
+        b, v, i = bins[finite], v[finite], ind[finite]
+        if len(i) == 0:
+            continue
+        order = np.lexsort((v, b))
+        b = b[order]
+        first = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+        last = np.r_[first[1:] - 1, len(b) - 1]
+        keep.append(i[order[first]])
+        keep.append(i[order[last]])
+    if not keep:
+        return ind[np.linspace(0, len(ind) - 1, max_points).astype(np.int64)]
+    return np.unique(np.concatenate(keep))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+@brief: Comparison statistics between a cruise shipboard CTD cast and profiler data from uFrame. Both profiles are
+averaged onto a common pressure grid (bins of bin_size dbar over the pressure range covered by both), and the bias
+(uFrame - cruise CTD), root-mean-square difference and correlation of the binned profiles are calculated for each
+variable. The binning is done with np.bincount, so profiles with tens of thousands of points don't need Python loops.
+
+@usage:
+stats = compare_profiles(cast_pres, cast_vars, uf_pres, uf_vars)  # cast_vars/uf_vars: {'temp': array, ...}
+stats['temp_bias'], stats['temp_rmse'], stats['temp_r'], stats['temp_nbins']
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_BIN_SIZE = 1.0  # dbar
+VARIABLES = ['temp', 'cond', 'sal', 'den', 'chla']
+STATS = ['bias', 'rmse', 'r', 'nbins']
+
+
+def as_float(values):
+    # masked arrays (e.g. from seabird) and lists with None to float arrays with NaN for missing values
+    if values is None:
+        return np.empty(0)
+    return np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan).ravel()
+
+
+def pressure_grid(cast_pres, uf_pres, bin_size=DEFAULT_BIN_SIZE):
+    # Bin edges over the pressure range covered by both profiles. Returns None if the profiles don't overlap.
+    cast_pres = cast_pres[np.isfinite(cast_pres)]
+    uf_pres = uf_pres[np.isfinite(uf_pres)]
+    if len(cast_pres) == 0 or len(uf_pres) == 0:
+        return None
+    lo = max(cast_pres.min(), uf_pres.min())
+    hi = min(cast_pres.max(), uf_pres.max())
+    if lo > hi:
+        return None
+    lo = np.floor(lo / bin_size) * bin_size
+    nbins = int(np.floor((hi - lo) / bin_size)) + 1
+    return lo + bin_size * np.arange(nbins + 1)
+
+
+def bin_profile(pres, values, edges):
+    # Mean of the values in each pressure bin (NaN for empty bins)
+    nbins = len(edges) - 1
+    if len(values) != len(pres):
+        return np.full(nbins, np.nan)
+    ind = np.searchsorted(edges, pres, side='right') - 1
+    valid = np.isfinite(pres) & np.isfinite(values) & (ind >= 0) & (ind < nbins)
+    counts = np.bincount(ind[valid], minlength=nbins)
+    sums = np.bincount(ind[valid], weights=values[valid], minlength=nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def difference_stats(cast_binned, uf_binned):
+    valid = np.isfinite(cast_binned) & np.isfinite(uf_binned)
+    x = cast_binned[valid]
+    y = uf_binned[valid]
+    stats = OrderedDict([('bias', np.nan), ('rmse', np.nan), ('r', np.nan), ('nbins', int(valid.sum()))])
+    if len(x) == 0:
+        return stats
+    diff = y - x
+    stats['bias'] = diff.mean()
+    stats['rmse'] = np.sqrt(np.mean(diff ** 2))
+    if len(x) > 2 and x.std() > 0 and y.std() > 0:
+        stats['r'] = np.corrcoef(x, y)[0, 1]
+    return stats
+
+
+def compare_profiles(cast_pres, cast_vars, uf_pres, uf_vars, bin_size=DEFAULT_BIN_SIZE, variables=None):
+    # Statistics for each variable found in both profiles, as {variable}_{stat}. Variables that are missing or empty
+    # in the cruise CTD cast get NaN statistics.
+    cast_pres = as_float(cast_pres)
+    uf_pres = as_float(uf_pres)
+    if variables is None:
+        variables = [v for v in VARIABLES if v in cast_vars and v in uf_vars]
+    edges = pressure_grid(cast_pres, uf_pres, bin_size)
+
+    stats = OrderedDict()
+    if edges is not None:
+        stats['pres_range'] = '{}-{}'.format(edges[0], edges[-1])
+    for v in variables:
+        if edges is None:
+            vstats = difference_stats(np.empty(0), np.empty(0))
+        else:
+            vstats = difference_stats(bin_profile(cast_pres, as_float(cast_vars[v]), edges),
+                                      bin_profile(uf_pres, as_float(uf_vars[v]), edges))
+        for s in STATS:
+            stats['_'.join((v, s))] = vstats[s]
+    return stats
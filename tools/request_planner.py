@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+@brief: Request planner for uFrame M2M data requests. uFrame decimates any request that would return more than the
+limit (10000) of data points. Each time range is requested whole first; a range (or shard) that returns the limit is
+split in half and requested again, until every shard is under the limit. The shards are fetched concurrently. Set
+shard_hours to split the ranges into shards of at most shard_hours up front instead (e.g. for ranges that are known to
+be dense). The shards of each time range are decoded as they arrive, then copied in time order into preallocated arrays,
+dropping the points that were returned by two adjacent shards.
+
+@usage:
+results = fetch_ranges(client, [(url, refdes, begin, end), ...])  # begin, end: datetime. list of (status, message, uF)
+status, message, uF = fetch_range(client, url, refdes, begin, end)
+"""
+
+import datetime
+from collections import OrderedDict
+import numpy as np
+from uframe_decode import decode_records, FIELD_MAPPING, instrument_class
+import instrumentation
+
+DEFAULT_LIMIT = 10000  # maximum number of data points uFrame returns without decimating
+
+
+def iso_str(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(dt.microsecond // 1000)
+
+
+def plan_windows(begin, end, shard_hours=None):
+    # Split the time range into consecutive windows of at most shard_hours (None = one window for the whole range)
+    if shard_hours is None:
+        return [(begin, end)] if begin < end else []
+    shard = datetime.timedelta(hours=shard_hours)
+    windows = []
+    start = begin
+    while start < end:
+        stop = min(start + shard, end)
+        windows.append((start, stop))
+        start = stop
+    return windows
+
+
+def split_window(window):
+    start, stop = window
+    middle = start + datetime.timedelta(seconds=int((stop - start).total_seconds() // 2))
+    return [(start, middle), (middle, stop)]
+
+
+def merge_shards(shards, names):
+    # Copy the decoded shards (list of (window, uF), in time order) into one array for each variable. A point on the
+    # boundary between two windows is kept in the later window only.
+    keep = []
+    for i, (window, uF) in enumerate(shards):
+        t = uF['time']
+        mask = t >= np.datetime64(window[0], 's')
+        if i < len(shards) - 1:
+            mask &= t < np.datetime64(window[1], 's')
+        keep.append(mask)
+
+    n = sum(int(m.sum()) for m in keep)
+    merged = OrderedDict()
+    for name in names:
+        merged[name] = np.empty(n, dtype='datetime64[s]' if name == 'time' else np.float64)
+    pos = 0
+    for (window, uF), mask in zip(shards, keep):
+        k = int(mask.sum())
+        for name in names:
+            merged[name][pos:pos + k] = uF[name][mask]
+        pos += k
+
+    # uFrame returns the data in time order, but check in case it didn't
+    if n > 1 and (np.diff(merged['time'].astype(np.int64)) < 0).any():
+        order = np.argsort(merged['time'], kind='mergesort')
+        for name in names:
+            merged[name] = merged[name][order]
+    return merged
+
+
+def fetch_ranges(client, ranges, limit=DEFAULT_LIMIT, shard_hours=None, min_shard_minutes=1):
+    # Fetch the data for each (url, refdes, begin, end) time range. Returns a list of (status, message, uF) in the same
+    # order as the ranges: status is 200 if every shard was fetched, otherwise the status and message of the first
+    # shard that failed (or 404 if none of the shards had data).
+    pending = []
+    for r, (url, refdes, begin, end) in enumerate(ranges):
+        pending.extend((r, w) for w in plan_windows(begin, end, shard_hours))
+    shards = [[] for _ in ranges]
+    errors = [None] * len(ranges)
+    nodata = [None] * len(ranges)
+    min_shard = datetime.timedelta(minutes=min_shard_minutes)
+    batch = max(1, client.workers * 2)  # number of shards held in memory as JSON at once
+
+    while pending:
+        current, pending = pending[:batch], pending[batch:]
+        requests_list = [(ranges[r][0], {'beginDT': iso_str(w[0]), 'endDT': iso_str(w[1]), 'limit': limit})
+                         for r, w in current]
+        for (r, w), (status, data) in zip(current, client.fetch_many(requests_list)):
+            if errors[r] is not None:
+                continue
+            if status == 200:
+                if len(data) >= limit and w[1] - w[0] > min_shard:
+                    # the shard was decimated, request each half
+                    pending.extend((r, half) for half in split_window(w))
+                    continue
+                with instrumentation.span('decode'):
+                    shards[r].append((w, decode_records(data, ranges[r][1])))
+                instrumentation.count('records decoded', len(data))
+            elif status == 404:
+                # no data in this shard
+                if nodata[r] is None:
+                    nodata[r] = data['message'] if isinstance(data, dict) and 'message' in data else 'No data'
+            elif status is None:
+                errors[r] = (status, 'Request failed')
+            else:
+                if isinstance(data, dict) and 'message' in data:
+                    errors[r] = (status, data['message'])
+                else:
+                    errors[r] = (status, 'Request failed with status {}'.format(status))
+        # don't request the rest of the ranges that failed, or keep the shards that were already decoded
+        failed = set(r for r, w in current if errors[r] is not None)
+        if failed:
+            pending = [(r, w) for r, w in pending if r not in failed]
+            for r in failed:
+                shards[r] = []
+
+    results = []
+    for r, (url, refdes, begin, end) in enumerate(ranges):
+        if errors[r] is not None:
+            results.append((errors[r][0], errors[r][1], None))
+        elif not shards[r]:
+            results.append((404, nodata[r] or 'No data', None))
+        else:
+            names = list(FIELD_MAPPING[instrument_class(refdes)].keys())
+            ordered = sorted(shards[r], key=lambda s: s[0][0])
+            with instrumentation.span('merge shards'):
+                results.append((200, 'Data request successful', merge_shards(ordered, names)))
+        if len(shards[r]) > 1:
+            print 'Merged {} requests for {} {} to {}'.format(len(shards[r]), refdes, iso_str(begin), iso_str(end))
+    return results
+
+
+def fetch_range(client, url, refdes, begin, end, limit=DEFAULT_LIMIT, shard_hours=None):
+    return fetch_ranges(client, [(url, refdes, begin, end)], limit, shard_hours)[0]
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+@brief: Decode uFrame M2M JSON data responses into typed NumPy columns. Each instrument class has a field mapping table
+(FIELD_MAPPING: short variable name -> uFrame parameter name), the records are read in a single pass and the NTP
+timestamps are converted to numpy datetime64 all at once.
+
+@usage:
+uF = decode_records(data, refdes)  # {'time': datetime64[s] array, 'pres': float array, ...}
+"""
+
+from collections import OrderedDict
+from operator import itemgetter
+import numpy as np
+
+NTP_UNIX_OFFSET = 2208988800  # seconds between the NTP epoch (1900-01-01) and the Unix epoch (1970-01-01)
+
+FIELD_MAPPING = {
+    'CTDPF': OrderedDict([('time', 'time'),
+                          ('pres', 'ctdpf_ckl_seawater_pressure'),
+                          ('temp', 'ctdpf_ckl_seawater_temperature'),
+                          ('cond', 'ctdpf_ckl_seawater_conductivity'),
+                          ('sal', 'practical_salinity'),
+                          ('den', 'density')]),
+    'FLORT': OrderedDict([('time', 'time'),
+                          ('pres', 'int_ctd_pressure'),
+                          ('chla', 'fluorometric_chlorophyll_a')]),
+}
+
+
+def instrument_class(refdes):
+    for inst, key in [('CTDPF', 'CTD'), ('FLORT', 'FLOR')]:
+        if key in refdes:
+            return inst
+
+
+def ntp_to_datetime64(ntp_seconds):
+    # NTP seconds to datetime64, truncated to the second. Missing (NaN) values are NaT.
+    seconds = np.floor(np.asarray(ntp_seconds, dtype=np.float64) - NTP_UNIX_OFFSET)
+    finite = np.isfinite(seconds)
+    times = np.where(finite, seconds, 0).astype(np.int64).astype('datetime64[s]')
+    times[~finite] = np.datetime64('NaT')
+    return times
+
+
+def decode_records(data, refdes=None, mapping=None):
+    # Returns a dictionary of arrays, one for each variable in the field mapping of the instrument class. Missing or
+    # null values are NaN.
+    if mapping is None:
+        mapping = FIELD_MAPPING[instrument_class(refdes)]
+    names = list(mapping.keys())
+    fields = list(mapping.values())
+
+    if len(data) == 0:
+        values = np.empty((0, len(fields)))
+    else:
+        try:
+            values = np.array([itemgetter(*fields)(rec) for rec in data], dtype=np.float64)
+        except KeyError:
+            values = np.array([[rec.get(f) for f in fields] for rec in data], dtype=np.float64)
+        values = values.reshape(len(data), len(fields))
+
+    uF = OrderedDict()
+    for i, name in enumerate(names):
+        if name == 'time':
+            uF[name] = ntp_to_datetime64(values[:, i])
+        else:
+            uF[name] = values[:, i]
+    return uF
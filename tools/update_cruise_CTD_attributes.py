@@ -5,40 +5,107 @@ Created on Apr 24 2018
 @author: Lori Garzio
 @brief: update https://github.com/seagrinch/data-team-python/tree/master/cruise_data/cruise_CTDs.csv with the time, lat,
 lon from the cruise .cnv files. Requires server connection to alfresco.ooi.rutgers.edu on local machine to directly 
-access the shipboard CTD files.
+access the shipboard CTD files. The time, lat and lon are read from the .cnv file header only; the full file is parsed
+with seabird.cnv.fCNV only when they can't be found in the header.
 
 @usage:
 sDir: directory where output is saved
+manifest: local manifest of the .cnv files that were already read (see cnv_cache.py). The time, lat and lon of files
+that haven't changed since they were last read are taken from the manifest. Set to None to read every file.
+use_hash: also compare the md5 of files whose modification time changed
+catalog: CruiseCatalog the cruise CTD sheet is read from (default: the OOI Datateam Database on GitHub, downloaded
+again on every run so the updated sheet doesn't overwrite recent edits with stale rows)
+stage: CNVStage the .cnv files are read through (see cnv_staging.py). Set to None (default) to read them directly from
+the mount.
+profile, trace_memory: profile the run with cProfile and/or trace the memory allocations (see instrumentation.py). The
+time spent in each stage of the run is saved to sDir.
 """
 
-import pandas as pd
-from seabird.cnv import fCNV
 import os
 import datetime
+from collections import OrderedDict
+from cnv_cache import CNVCache, DEFAULT_MANIFEST
+from cnv_reader import read_cnv_attributes
+from cruise_catalog import CruiseCatalog
+import instrumentation
 
 
-def main(sDir):
-    file = 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/cruise_data/cruise_CTDs.csv'
-    df = pd.read_csv(file).fillna('')
+def manifest_attributes(f, cache):
+    # The time, lat and lon of a .cnv file from the manifest, or None if the file has changed since it was last read.
+    # Also returns the fingerprint of the file.
+    if cache:
+        entry, fp = cache.lookup(f)
+        if entry and all(k in entry['attributes'] for k in ['CTD_Date', 'CTD_lat', 'CTD_lon']):
+            return entry['attributes'], fp
+        return None, fp
+    return None, None
+
+
+def read_attributes(f, cache, fp, local=None):
+    # Read the time, lat and lon from a .cnv file (or from its local copy) and record them in the manifest
+    local = local or f
+
+    # read the header up to *END*, and only parse the whole file if the header is ambiguous
+    with instrumentation.span('read header'):
+        header = read_cnv_attributes(local)
+    if None in header.values():
+        from seabird.cnv import fCNV  # only imported when a header can't be read
+        with instrumentation.span('parse'):
+            header = fCNV(local).attributes
+    instrumentation.count('files read')
+
+    attributes = {'CTD_Date': header['datetime'].strftime('%Y-%m-%dT%H:%M:%S'),
+                  'CTD_lat': header['LATITUDE'],
+                  'CTD_lon': header['LONGITUDE']}
+    if cache:
+        cache.record(f, fp, attributes=attributes)
+    return attributes
+
+
+def main(sDir, manifest=DEFAULT_MANIFEST, use_hash=False, catalog=None, stage=None, profile=False,
+         trace_memory=False):
+    run = instrumentation.start_run('cruise_CTD_attributes', profile, trace_memory)
+    cache = CNVCache(manifest, use_hash) if manifest else None
+    df = (catalog or CruiseCatalog(refresh=True)).casts.copy()
     df['update_notes'] = ''
+
+    # rows with a missing time, lat or lon, by .cnv file
+    files = OrderedDict()
     for row in df.iterrows():
         if row[-1]['CTD_rawdata_filepath'].endswith('.cnv'):
             if row[-1]['CTD_Date'] == '' or row[-1]['CTD_lat'] == '' or row[-1]['CTD_lon'] == '':
                 f = ''.join((row[-1]['filepath_primary'], row[-1]['CTD_rawdata_filepath']))
-                profile = fCNV(f)
-
-                if row[-1]['CTD_Date'] == '':
-                    df.loc[row[0], 'CTD_Date'] = profile.attributes['datetime'].strftime('%Y-%m-%dT%H:%M:%S')
-                    df.loc[row[0], 'update_notes'] = 'Updated row'
-                if row[-1]['CTD_lat'] == '':
-                    df.loc[row[0], 'CTD_lat'] = profile.attributes['LATITUDE']
-                    df.loc[row[0], 'update_notes'] = 'Updated row'
-                if row[-1]['CTD_lon'] == '':
-                    df.loc[row[0], 'CTD_lon'] = profile.attributes['LONGITUDE']
-                    df.loc[row[0], 'update_notes'] = 'Updated row'
+                files.setdefault(f, []).append(row[0])
+
+    # only read the files that changed since they were last read, through the staging directory if there is one
+    attributes = {}
+    fingerprints = OrderedDict()
+    for f in files:
+        attributes[f], fp = manifest_attributes(f, cache)
+        if attributes[f] is None:
+            fingerprints[f] = fp
+    paths = stage.staged(list(fingerprints)) if stage else ((f, f) for f in fingerprints)
+    for f, local in paths:
+        try:
+            attributes[f] = read_attributes(f, cache, fingerprints[f], local)
+        finally:
+            if stage:
+                stage.release(f)
+
+    for f, labels in files.items():
+        for label in labels:
+            for var in ['CTD_Date', 'CTD_lat', 'CTD_lon']:
+                if df.loc[label, var] == '':
+                    df.loc[label, var] = attributes[f][var]
+                    df.loc[label, 'update_notes'] = 'Updated row'
+
+    if cache:
+        cache.save()
 
     fname = 'cruise_CTDs_{}.csv'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
-    df.to_csv(os.path.join(sDir,fname), index=False)
+    with instrumentation.span('write'):
+        df.to_csv(os.path.join(sDir,fname), index=False)
+    run.finish(sDir)
 
 
 if __name__ == '__main__':
@@ -5,19 +5,39 @@ Created on Apr 20 2018
 @author: Lori Garzio
 @brief: update https://github.com/seagrinch/data-team-python/tree/master/cruise_data/platform_CTDcast_mapping.csv
 with the latest information from the asset management deployment sheets:
-https://github.com/ooi-integration/asset-management/tree/master/deployment. Currently only updates Pioneer and Global
+https://github.com/ooi-integration/asset-management/tree/master/deployment. By default only updates Pioneer and Global
 platforms.
 
 @usage:
 AMdir: deployment directory in a clone of the OOI asset management repo on local machine
 (https://github.com/ooi-integration/asset-management/tree/master/deployment)
 sDir: directory where output is saved
+arrays: prefixes of the deployment sheets to read (default ('CP', 'G') = Pioneer and Global; see ARRAY_CODES for all of
+the arrays)
+workers: number of deployment sheets read in parallel (default 1 = read serially in this process)
+state: local state of the deployment sheets that were already read (see am_cache.py). Only the sheets that were added or
+changed since the last run are read again. Set to None to read every sheet.
+use_hash: also compare the md5 of sheets whose modification time changed (e.g. after a fresh git checkout)
+match_km, match_days: suggest the closest cast in cruise_CTDs.csv done within match_km and match_days of the asset
+management date and location for the deployments/recoveries without a CTD cast (see cast_index.py). The suggestions are
+saved in the suggested_CTD_CruiseName, suggested_CTD_CruiseLeg and suggested_CTDcast columns to be checked manually, the
+CTD cast columns are left blank. Default None = no suggestions.
+catalog: CruiseCatalog the mapping and cruise CTD sheets are read from (default: the OOI Datateam Database on GitHub,
+downloaded again on every run so the updated sheet doesn't overwrite recent edits with stale rows)
+profile, trace_memory: profile the run with cProfile and/or trace the memory allocations (see instrumentation.py). The
+time spent in each stage of the run is saved to sDir.
 """
 
 import pandas as pd
 import os
 from collections import OrderedDict
 import datetime
+from multiprocessing import Pool
+from cruise_catalog import CruiseCatalog, key_str
+from am_cache import AMSheetCache, DEFAULT_STATE
+import instrumentation
+
+SUGGESTED_COLUMNS = ['CTD_CruiseName', 'CTD_CruiseLeg', 'CTDcast']  # cast columns of the suggested_* columns
 
 
 def append_deploymentsheet_info(dct, var, date, lat, lon, CUID):
@@ -29,18 +49,19 @@ def append_deploymentsheet_info(dct, var, date, lat, lon, CUID):
     dct[var]['AM_Date'] = str(date).strip('[]')
 
 
+ARRAY_CODES = {'GA': 'Global_Argentine_basin',
+               'GI': 'Global_Irminger',
+               'GP': 'Global_Papa',
+               'GS': 'Global_Southern_Ocean',
+               'CP': 'Coastal_Pioneer',
+               'CE': 'Coastal_Endurance',
+               'RS': 'Cabled_Array'}
+UPDATE_VARS = ['CUID', 'AM_Date', 'lat', 'lon']  # platform_CTDcast_mapping columns updated from asset management
+AM_COLUMNS = ['deploymentNumber', 'lat', 'lon', 'CUID', 'AM_Date']  # entries of append_deploymentsheet_info
+
+
 def define_array(key):
-    code = key[0:2]
-    code_mapping = {'GA': 'Global_Argentine_basin',
-                    'GI': 'Global_Irminger',
-                    'GP': 'Global_Papa',
-                    'GS': 'Global_Southern_Ocean',
-                    'CP': 'Coastal_Pioneer',
-                    'CE': 'Coastal_Endurance'}
-    for c, a in code_mapping.iteritems():
-        if code == c:
-            array = a
-    return array
+    return ARRAY_CODES[key[0:2]]
 
 
 def format_deploy_str(d):
@@ -49,89 +70,180 @@ def format_deploy_str(d):
     return deploys
 
 
-def update_dataframe(match, df, var, am_info):
-    if str(match.iloc[0][var]) != am_info[var]:
-        df.loc[match.index, var] = am_info[var]  # update the variable
-        i = match.index[0]
-        if df['update_notes'][i] == '':
-            df.loc[match.index, 'update_notes'] = 'Manually check cruise CTD info. Updated {}'.format(var)
-        else:
-            df.loc[match.index, 'update_notes'] = df['update_notes'][i] + ', {}'.format(var)
+def asset_management_records(dfile_dict):
+    # Asset management info for each platform deployment/recovery as one DataFrame. The columns are the same when
+    # there aren't any entries (e.g. no deployment sheets matched the arrays), so reconcile finds no changes.
+    am = pd.DataFrame.from_dict(dfile_dict, orient='index').reindex(columns=AM_COLUMNS)
+    am['platform'] = [k.split('_')[0] for k in am.index]
+    am['Deployment'] = [k.split('_')[1] for k in am.index]
+    return am.reset_index(drop=True)
 
 
-def main(rootdir, sDir):
+def reconcile(df, am):
+    # Update the platform_CTDcast_mapping records that changed in asset management and add the records that are new,
+    # with one merge on (platform, Deployment)
+    df = df.copy()
+    df['update_notes'] = ''
+    keys = ['platform', 'Deployment']
+
+    # existing records: compare each variable column-wise
+    m = df[keys].merge(am, on=keys, how='left', indicator=True)
+    m.index = df.index
+    matched = m['_merge'] == 'both'
+    updated = pd.Series('', index=df.index)
+    for var in UPDATE_VARS:
+        changed = matched & (df[var].map(str) != m[var])
+        df.loc[changed, var] = m.loc[changed, var]
+        updated[changed] = updated[changed] + ', ' + var
+    has_updates = updated != ''
+    df.loc[has_updates, 'update_notes'] = 'Manually check cruise CTD info. Updated ' + updated[has_updates].str[2:]
+
+    # new records
+    new = am.merge(df[keys].drop_duplicates(), on=keys, how='left', indicator=True)
+    new = new[new['_merge'] == 'left_only']
+    if not new.empty:
+        print 'Adding {} rows to platform_CTDcast_mapping.csv'.format(len(new))
+        new['Array'] = new['platform'].map(define_array)
+        new['update_notes'] = 'New entry. Need to manually check cruise CTD info'
+        cols = ['Array', 'platform', 'deploymentNumber', 'Deployment', 'lat', 'lon', 'CUID', 'AM_Date', 'update_notes']
+        df = pd.concat([df, new[cols]], ignore_index=True)[df.columns.tolist()].fillna('')
+
+    return df
+
+
+def suggest_casts(df, index, km, days):
+    # Suggest the closest cast done within km and days for the deployments/recoveries that don't have a CTD cast, in
+    # the suggested_* columns
+    for col in SUGGESTED_COLUMNS:
+        df['suggested_' + col] = ''
+    missing = df[df['CTDcast'].map(key_str) == '']
+    if missing.empty or len(index) == 0:
+        return df
+    best = index.match(missing, km, days).drop_duplicates('mapping')
+    if best.empty:
+        return df
+
+    print 'Suggested CTD casts for {} of {} deployments without one'.format(len(best), len(missing))
+    labels = best['mapping'].values
+    for col in SUGGESTED_COLUMNS:
+        df.loc[labels, 'suggested_' + col] = best[col].map(key_str).values
+    notes = ['Suggested CTD cast ({} km, {} days from AM_Date), check manually'.format(round(d, 2), round(t, 2))
+             for d, t in zip(best['distance_km'], best['days'])]
+    previous = df.loc[labels, 'update_notes'].values
+    df.loc[labels, 'update_notes'] = ['. '.join((p, n)) if p else n for p, n in zip(previous, notes)]
+    return df
+
+
+def read_deployment_sheet(f):
+    # Returns the platform deployment/recovery entries of one asset management deployment sheet
     dfile_dict = {}
+    dfile = pd.read_csv(f).fillna('')
+    platform = os.path.basename(f).split('_')[0]
+    deployments = dfile['deploymentNumber'].unique().tolist()
+    stimes = dfile['startDateTime'].unique().tolist()
+    etimes = dfile['stopDateTime'].unique().tolist()
+
+    # Check to make sure there is the same number of deployment numbers, startDateTimes, stopDateTimes
+    # in asset management
+    length = len(deployments)
+    if any(len(lst) != length for lst in [stimes, etimes]):
+        raise ValueError("The number of unique entries in one or more asset management fields doesn't match. "
+                         "Check {}: deploymentNumber, startDate, stopDate".format(os.path.basename(f)))
+
+    # get rid of lines that are commented out and split the sheet by deployment in one pass
+    dfile = dfile[~dfile['CUID_Deploy'].astype(str).str.startswith('#')]
+    groups = dict(list(dfile.groupby('deploymentNumber', sort=False)))
+    for i in range(len(deployments)):
+        d = deployments[i]
+        dfile_filtered = groups.get(d, dfile.iloc[0:0])
+        lat = dfile_filtered['lat'].astype(str).unique().tolist()
+        lon = dfile_filtered['lon'].astype(str).unique().tolist()
+        dCUID = dfile_filtered['CUID_Deploy'].unique().tolist()
+        rCUID = dfile_filtered['CUID_Recover'].unique().tolist()
+        deploys = format_deploy_str(d)
+        for x in deploys:
+            if x.startswith('D'):
+                d_platform_deploy = '_'.join((platform, x))
+                append_deploymentsheet_info(dfile_dict, d_platform_deploy, stimes[i], lat, lon, dCUID)
+            if x.startswith('R'):
+                d_platform_deploy = '_'.join((platform, x))
+                append_deploymentsheet_info(dfile_dict, d_platform_deploy, etimes[i], lat, lon, rCUID)
+    return dfile_dict
+
+
+def read_sheet(f):
+    with instrumentation.span('read sheet'):
+        records = read_deployment_sheet(f)
+    instrumentation.count('bytes read', os.path.getsize(f))
+    instrumentation.count('rows parsed', len(records))
+    return f, records, instrumentation.drain()
+
+
+def main(rootdir, sDir, arrays=('CP', 'G'), workers=1, state=DEFAULT_STATE, use_hash=False, match_km=None,
+         match_days=14, catalog=None, profile=False, trace_memory=False):
+    run = instrumentation.start_run('platform_CTDcast_mapping', profile, trace_memory)
+    sheets = []
     for root, dirs, files in os.walk(rootdir):
         for f in files:
-            if f.startswith(('CP', 'G')):
-                print f
-                dfile = pd.read_csv(os.path.join(root,f)).fillna('')
-                platform = f.split('_')[0]
-                deployments = dfile['deploymentNumber'].unique().tolist()
-                stimes = dfile['startDateTime'].unique().tolist()
-                etimes = dfile['stopDateTime'].unique().tolist()
-
-                # Check to make sure there is the same number of deployment numbers, startDateTimes, stopDateTimes
-                # in asset management
-                length = len(deployments)
-                if any(len(lst) != length for lst in [stimes, etimes]):
-                    raise ValueError("The number of unique entries in one or more asset management fields doesn't match. "
-                                     "Check {}: deploymentNumber, startDate, stopDate".format(f))
-
-                for i in range(len(deployments)):
-                    d = deployments[i]
-                    # filter on deployment and get rid of lines that are commented out
-                    dfile_filtered = dfile[(dfile['deploymentNumber'] == d) & (~dfile['CUID_Deploy'].str.startswith('#'))]
-                    lat = dfile_filtered['lat'].astype(str).unique().tolist()
-                    lon = dfile_filtered['lon'].astype(str).unique().tolist()
-                    dCUID = dfile_filtered['CUID_Deploy'].unique().tolist()
-                    rCUID = dfile_filtered['CUID_Recover'].unique().tolist()
-                    deploys = format_deploy_str(d)
-                    for x in deploys:
-                        if x.startswith('D'):
-                            d_platform_deploy = '_'.join((platform, x))
-                            append_deploymentsheet_info(dfile_dict, d_platform_deploy, stimes[i], lat, lon, dCUID)
-                        if x.startswith('R'):
-                            d_platform_deploy = '_'.join((platform, x))
-                            append_deploymentsheet_info(dfile_dict, d_platform_deploy, etimes[i], lat, lon, rCUID)
-
-    cruisedata_repo = 'https://raw.githubusercontent.com/seagrinch/data-team-python/master/cruise_data'
-    df = pd.read_csv('/'.join((cruisedata_repo, 'platform_CTDcast_mapping.csv'))).fillna('')
-    df['update_notes'] = ''
-
-    for key in dfile_dict.keys():
-        am_info = dfile_dict[key]
-        match = df.loc[(df['platform'] == key.split('_')[0]) & (df['Deployment'] == key.split('_')[1])]
-
-        # if the record in asset management doesn't exist in platform_CTDcast_mapping, add it
-        if match.empty:
-            print 'Adding row to platform_CTDcast_mapping.csv'
-            cols = ['Array', 'platform', 'deploymentNumber', 'Deployment', 'lat', 'lon', 'CUID', 'AM_Date', 'update_notes']
-            newrow = key.split('_')
-            newrow.insert(0, define_array(key))
-
-            for ii, value in dfile_dict[key].iteritems():
-                if ii == 'deploymentNumber':
-                    newrow.insert(2, value)
-                else:
-                    newrow.append(value)
-
-            newrow.append('New entry. Need to manually check cruise CTD info')
-            new_row = pd.DataFrame([newrow], columns=cols)
-            df = df.append(new_row)[df.columns.tolist()]
-
-        # if the record in asset management exists in platform_CTDcast_mapping, update it if necessary
-        else:
-            update_vars = ['CUID', 'AM_Date', 'lat', 'lon']
-            for u in update_vars:
-                update_dataframe(match, df, u, am_info)
+            if f.startswith(tuple(arrays)):
+                sheets.append(os.path.join(root, f))
+    sheets.sort()
+
+    # only read the sheets that were added or changed since the last run
+    cache = AMSheetCache(state, use_hash) if state else None
+    fingerprints = {}
+    changed = []
+    for f in sheets:
+        if cache:
+            entry, fingerprints[f] = cache.lookup(f)
+            if entry is not None:
+                continue
+        changed.append(f)
+    print '{} of {} deployment sheets are new or have changed since the last run'.format(len(changed), len(sheets))
+
+    if workers > 1 and len(changed) > 1:
+        pool = Pool(min(workers, len(changed)))
+        try:
+            results = pool.map(read_sheet, changed)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [read_sheet(f) for f in changed]
+    for f, records, stages in results:
+        run.merge(stages)
+
+    if cache:
+        for f, records, stages in results:
+            print os.path.basename(f)
+            cache.record(f, fingerprints[f], records)
+        for f in cache.prune():
+            print 'Removed deleted sheet {}'.format(f)
+        cache.save()
+        dfile_dict = cache.records(sheets)
+    else:
+        dfile_dict = {}
+        for f, records, stages in results:
+            print os.path.basename(f)
+            dfile_dict.update(records)
+
+    catalog = catalog or CruiseCatalog(refresh=True)
+    mapping = catalog.mapping
+    with instrumentation.span('reconcile'):
+        df = reconcile(mapping, asset_management_records(dfile_dict))
+    if match_km is not None:
+        with instrumentation.span('match casts'):
+            df = suggest_casts(df, catalog.cast_index, match_km, match_days)
 
     dfs = df.sort_values(['platform', 'deploymentNumber', 'Deployment'])
     fname = 'platform_CTDcast_mapping_{}.csv'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
-    dfs.to_csv(os.path.join(sDir, fname), index=False)
+    with instrumentation.span('write'):
+        dfs.to_csv(os.path.join(sDir, fname), index=False)
+    run.finish(sDir)
 
 
 if __name__ == '__main__':
     AMdir = '/Users/lgarzio/Documents/repo/lgarzio/ooi-integration-fork/asset-management/deployment'
     sDir = '/Users/lgarzio/Documents/repo/lgarzio/seagrinch-fork/data-team-python/cruise_data/'
-    main(AMdir, sDir)
+    workers = 4
+    main(AMdir, sDir, workers=workers)